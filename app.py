@@ -1,23 +1,116 @@
 #!/usr/bin/env python
+import atexit
 import json
 import logging
 import os
+import random
 import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
+from typing import Iterable, Iterator
 
-import pylark
+import httpx
 import requests
-from flask import Flask, request
-from sqlalchemy import create_engine
+from flask import Flask, Response, request
 
-from domain import CardSet, RollRecord
-from repo import CardSetORM, CardSetRepo, RollRecordORM, RollRecordRepo
+from dedup import EventDeduper
+from domain import Card, CardSet, RollRecord
+from feishu import FeishuClient, TokenManager
+from intent import CommandReader, parse_intent
+from logs import LazyPayload, setup_logging
+from metrics import Counter, Histogram, MultiProcessCollector, reset_registry
+from pipeline import EventPipeline, KeyedLock, fan_out
+from migrate import migrate
+from repo import (
+    CardSetRepo,
+    EventDedupRepo,
+    RollRecordRepo,
+    TranslationCacheRepo,
+    create_db_engine,
+    ping_db,
+    stat_day,
+)
+from ratelimit import TokenBucket
+from resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded
+from retention import RetentionJob
+from token_store import FileTokenStore
+from translation import TranslationCache
 
 
-FEISHU_BASE_URL = "https://open.feishu.cn/open-apis"
+FEISHU_BASE_URL = os.environ.get("FEISHU_BASE_URL", "https://open.feishu.cn/open-apis")
 FEISHU_APP_OPEN_ID = os.environ["FEISHU_APP_OPEN_ID"]
+# inline: 在 webhook 请求内处理事件; queue: 入队后立即返回，由后台线程池处理
+EVENT_DISPATCH_MODE = os.environ.get("EVENT_DISPATCH_MODE", "inline")
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "256"))
+EVENT_QUEUE_PUT_TIMEOUT = float(os.environ.get("EVENT_QUEUE_PUT_TIMEOUT", "0.5"))
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", "8"))
+EVENT_DRAIN_TIMEOUT = float(os.environ.get("EVENT_DRAIN_TIMEOUT", "25"))
+# 单个事件的处理时限（秒），所有出站调用的超时都不超过剩余时间
+EVENT_DEADLINE = float(os.environ.get("EVENT_DEADLINE", "20"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "15"))
+# 回答只需要一行指令，限制生成长度（0 不限制）；流式读取时第一行读完（或能看出不是指令）就断开
+OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "64"))
+OPENAI_STREAM = os.environ.get("OPENAI_STREAM", "1") == "1"
+# 连续失败（超过 OPENAI_SLOW_CALL 秒的调用也算失败）OPENAI_BREAKER_FAILURES 次后熔断，
+# OPENAI_BREAKER_COOLDOWN 秒内自然语言消息直接回复指令说明
+OPENAI_SLOW_CALL = float(os.environ.get("OPENAI_SLOW_CALL", "8"))
+OPENAI_BREAKER_FAILURES = int(os.environ.get("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get("OPENAI_BREAKER_COOLDOWN", "30"))
+# /ls 每页内容的字节上限（按回复请求体计算，飞书富文本消息上限 30KB，留出标题和页脚的余量）
+LS_PAGE_BYTES = int(os.environ.get("LS_PAGE_BYTES", "20000"))
+LS_TOP_N = int(os.environ.get("LS_TOP_N", "10"))
+# /stats 不指定天数时统计最近多少天
+STATS_DAYS = int(os.environ.get("STATS_DAYS", "30"))
+MAX_ROLL_NUM = int(os.environ.get("MAX_ROLL_NUM", "10"))
+SIDE_EFFECT_WORKERS = int(os.environ.get("SIDE_EFFECT_WORKERS", "8"))
+EVENT_DEDUP_TTL = float(os.environ.get("EVENT_DEDUP_TTL", str(12 * 3600)))
+CARD_SET_CACHE_SIZE = int(os.environ.get("CARD_SET_CACHE_SIZE", "1024"))
+# 超过回应窗口的抽卡记录、软删除超过保留期的集合会被后台任务清理
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))
+ROLL_RECORD_TTL_DAYS = float(os.environ.get("ROLL_RECORD_TTL_DAYS", "30"))
+DELETED_SET_TTL_DAYS = float(os.environ.get("DELETED_SET_TTL_DAYS", "30"))
+TRANSLATION_CACHE_TTL = float(os.environ.get("TRANSLATION_CACHE_TTL", str(7 * 86400)))
+TRANSLATION_CACHE_MAX_ROWS = int(os.environ.get("TRANSLATION_CACHE_MAX_ROWS", "10000"))
+# 每个进程发消息/加表情的频率上限（次/秒），飞书的限制按应用计算，需要除以 worker 数
+FEISHU_REPLY_RATE = float(os.environ.get("FEISHU_REPLY_RATE", "10"))
+FEISHU_REACTION_RATE = float(os.environ.get("FEISHU_REACTION_RATE", "10"))
+FEISHU_RATE_BURST = float(os.environ.get("FEISHU_RATE_BURST", "10"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# sync: 在请求线程里直接写日志; queue: 放进队列由后台线程格式化、写出
+LOG_MODE = os.environ.get("LOG_MODE", "sync")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# 日志里的事件/回复内容超过这个长度截断（0 不截断），按比例采样输出
+LOG_PAYLOAD_MAX_LEN = int(os.environ.get("LOG_PAYLOAD_MAX_LEN", "2000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "1"))
+# 各 worker 定期把指标写到这个目录，/metrics 汇总所有 worker；为空时只输出当前进程
+METRICS_DIR = os.environ.get("METRICS_DIR", "data/metrics")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+EVENT_TYPES = (
+    "im.message.receive_v1",
+    "im.message.reaction.created_v1",
+    "im.message.reaction.deleted_v1",
+)
+COMMANDS = ("/add", "/ls", "/del", "/roll", "/weight", "/stats", "/help")
+
+event_histogram = Histogram(
+    "event_handle_seconds", "事件处理耗时", ("event_type", "command")
+)
+event_error_counter = Counter(
+    "event_errors_total", "事件处理出错次数", ("event_type", "command")
+)
+side_effect_error_counter = Counter("side_effect_errors_total", "抽卡后续操作失败次数")
+openai_histogram = Histogram("openai_request_seconds", "OpenAI 接口调用耗时", ("status",))
+openai_breaker = CircuitBreaker(
+    "openai",
+    failure_threshold=OPENAI_BREAKER_FAILURES,
+    slow_call_duration=OPENAI_SLOW_CALL,
+    cooldown=OPENAI_BREAKER_COOLDOWN,
+)
 
 
 class EmojiType:
@@ -29,72 +122,311 @@ class EmojiType:
 class CustomAdapter(logging.LoggerAdapter):
     """
     This example adapter expects the passed in dict-like object to have a
-    'req_id' key, whose value in brackets is prepended to the log message.
+    'req_id' key, which is attached to every record as the req_id field
+    (rendered by the formatter, see logs.py).
     """
 
     def process(self, msg, kwargs):
-        return (
-            "[{}] {}".format(self.extra["req_id"], msg),
-            kwargs,
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+
+# 系统提示词每次调用都要发送，保持精简。只要求输出一行指令，配合流式读取，第一行读完就结束
+GPT_PROMPT = """
+把用户的话翻译成抽卡工具的一条指令，只输出这一行指令，无法翻译时回复"无法理解"。
+指令：
+/add 集合 成员1 成员2 ... 向集合添加成员
+/ls 列出所有集合
+/ls 集合 列出集合成员
+/del 集合 成员 删除成员
+/roll 集合 [数量] 从集合抽卡，可一次抽多张
+/weight 集合 成员 调整成员权重
+/stats 集合 [天数] 查看抽卡统计
+/help 使用说明
+示例：
+吃饭可以去老乡鸡、和府捞面 -> /add 吃饭 老乡鸡 和府捞面
+从吃饭里删掉老乡鸡 -> /del 吃饭 老乡鸡
+从吃饭里抽3张 -> /roll 吃饭 3
+""".strip()
+
+
+def help_lines() -> list:
+    lines = []
+    lines.append(
+        [
+            {
+                "tag": "text",
+                "text": "向集合里添加成员，请说：向吃饭集合里添加老乡鸡、和府捞面。（或使用指令：/add 吃饭 老乡鸡 和府捞面）",
+            }
+        ]
+    )
+    lines.append([{"tag": "text", "text": "列出所有集合，请说：查看。（或使用指令：/ls）"}])
+    lines.append([{"tag": "text", "text": "列出集合内成员，请说：查看吃饭集合。（或使用指令：/ls 吃饭）"}])
+    lines.append([{"tag": "text", "text": "成员较多时翻页：/ls 吃饭 2，只看权重最高的成员：/ls 吃饭 top"}])
+    # lines.append([{"tag": "text", "text": "删除集合，请说：删掉吃饭集合。（或使用指令：/del 吃饭）"}])
+    lines.append(
+        [
+            {
+                "tag": "text",
+                "text": "删除集合内的成员，请说：从吃饭集合里删掉老乡鸡。（或使用指令：/del 吃饭 老乡鸡）",
+            }
+        ]
+    )
+    lines.append(
+        [{"tag": "text", "text": "从集合里随机抽一个成员，请说：从吃饭集合里抽一张。（或使用指令：/roll 吃饭）"}]
+    )
+    lines.append(
+        [{"tag": "text", "text": "从集合里一次抽多个不重复的成员，请说：从吃饭集合里抽3张。（或使用指令：/roll 吃饭 3）"}]
+    )
+    lines.append(
+        [
+            {
+                "tag": "text",
+                "text": "调整集合里的成员权重，请说：调整吃饭里老乡鸡的权重。（或使用指令：/weight 吃饭 老乡鸡）",
+            }
+        ]
+    )
+    lines.append([{"tag": "text", "text": "查看各成员被抽中和赞/踩的次数：/stats 吃饭，只看最近7天：/stats 吃饭 7"}])
+    lines.append([{"tag": "text", "text": "查看使用说明，请说：怎么使用。（或使用指令：/help）"}])
+    return lines
+
+
+def roll_post_lines(verb: str, card_set: CardSet, card: Card) -> list:
+    lines = [
+        [
+            {"tag": "text", "text": "从"},
+            {"tag": "text", "text": card_set.name, "style": ["bold"]},
+            {"tag": "text", "text": verb},
+            {"tag": "text", "text": card.name, "style": ["bold"]},
+            {"tag": "text", "text": ", 权重"},
+            {"tag": "text", "text": str(card.weight)},
+        ]
+    ]
+    lines.append([{"tag": "text", "text": "-----------------"}])
+    lines.append([{"tag": "text", "text": "在本条消息中回应赞/踩可增减1点权重"}])
+    return lines
+
+
+def card_set_list_lines(summaries: Iterable[tuple[str, int]]) -> Iterator[list]:
+    """summaries 为 (集合名, 成员数)，逐行生成"""
+    for name, count in summaries:
+        yield [{"tag": "text", "text": "{} ({}个成员)".format(name, count)}]
+
+
+def card_lines(cards: Iterable[Card]) -> Iterator[list]:
+    for card in cards:
+        yield [{"tag": "text", "text": "{} (权重{})".format(card.name, card.weight)}]
+
+
+def stats_lines(stats: Iterable[tuple]) -> Iterator[list]:
+    """stats 为 (成员名, 抽中次数, 赞, 踩, 回应带来的权重变化)"""
+    for name, draws, up, down, weight_delta in stats:
+        text = "{}：抽中{}次，赞{} 踩{}，权重{:+d}".format(
+            name, draws, up, down, weight_delta
         )
+        yield [{"tag": "text", "text": text}]
+
 
+def line_size(line: list) -> int:
+    """一行在回复请求体里占的字节数：content 是 JSON 字符串，放进请求体时会再转义一次"""
+    text = json.dumps(line, ensure_ascii=False)
+    return len(json.dumps(text, ensure_ascii=False).encode("utf-8"))
 
-class TokenManager:
-    feishu_cli: pylark.Lark = None
-    lock: threading.Lock = None
-    token: str = ""
-    expire_time: int = 0
 
-    def __init__(self, app_id: str, app_secret: str):
-        self.lock = threading.Lock()
-        self.feishu_cli = pylark.Lark(app_id=app_id, app_secret=app_secret)
+def paginate(lines: Iterable[list], page: int, budget: int) -> tuple[list, bool]:
+    """
+    把逐行生成的内容按字节预算分页，返回第 page 页（从 1 开始）的行，以及后面是否还有内容。
+    前面的页只计算大小不保留，读到下一页的第一行就停止，不会读完所有行。
+    """
+    res, current, size = [], 1, 0
+    for line in lines:
+        n = line_size(line)
+        if size and size + n > budget:
+            if current == page:
+                return res, True
+            current, size = current + 1, 0
+        size += n
+        if current == page:
+            res.append(line)
+    return res, False
+
+
+def page_lines(lines: list, total: str, more_command: str) -> list:
+    """在一页内容后面加上总数和翻页提示，没有下一页时 more_command 为空"""
+    footer = total
+    if more_command:
+        footer += "，发送 {} 查看下一页".format(more_command)
+    return lines + [
+        [{"tag": "text", "text": "-----------------"}],
+        [{"tag": "text", "text": footer}],
+    ]
+
+
+def post_content(title: str, lines: list) -> str:
+    content = {
+        "zh_cn": {
+            "title": title,
+            "content": lines,
+        }
+    }
+    return json.dumps(content, ensure_ascii=False)
 
-    def get_token(self) -> str:
-        with self.lock:
-            if self.token and (time.time() + 60) < self.expire_time:
-                return self.token
-            expire, _ = self.feishu_cli.auth.get_tenant_access_token()
-            self.token = expire.token
-            self.expire_time = time.time() + expire.expire
-            return self.token
 
-    def get_header(self) -> dict:
-        token = self.get_token()
-        return {"Authorization": "Bearer " + token}
+def parse_roll_num(argv: list[str]) -> int:
+    """/roll 集合 [数量]，数量不合法时返回 None"""
+    if len(argv) < 2:
+        return 1
+    if not argv[1].isdigit() or not 1 <= int(argv[1]) <= MAX_ROLL_NUM:
+        return None
+    return int(argv[1])
+
+
+class OpenAIError(Exception):
+    pass
 
 
 class OpenAI:
     api_key = os.environ["OPENAI_API_KEY"]
     api_base_url = os.environ["OPENAI_API_BASE_URL"]
+    url = api_base_url + "/v1/chat/completions"
+    headers = {"Authorization": "Bearer " + api_key}
 
     @classmethod
-    def recognize(self, prompt: str, text: str) -> str:
-        head = {"Authorization": "Bearer " + self.api_key}
+    def request_args(self, prompt: str, text: str) -> dict:
         data = {
             "model": "gpt-3.5-turbo",
             "messages": [
-                {"role": "system", "content": f"{prompt}"},
+                {"role": "system", "content": prompt},
                 {"role": "user", "content": text},
             ],
         }
-        url = self.api_base_url + "/v1/chat/completions"
-        resp = requests.post(url, headers=head, json=data)
+        if OPENAI_MAX_TOKENS > 0:
+            data["max_tokens"] = OPENAI_MAX_TOKENS
+        if OPENAI_STREAM:
+            data["stream"] = True
+        return {"url": self.url, "headers": self.headers, "json": data}
+
+    @classmethod
+    def timeout(self, deadline: Deadline = None) -> float:
+        """本次调用的超时，熔断时抛出 CircuitOpenError"""
+        timeout = deadline.timeout(OPENAI_TIMEOUT) if deadline else OPENAI_TIMEOUT
+        if not openai_breaker.allow():
+            raise CircuitOpenError("openai circuit breaker is open")
+        return timeout
+
+    @classmethod
+    def observe(self, resp, seconds: float, deadline: Deadline = None):
+        status = str(resp.status_code) if resp is not None else "error"
+        openai_histogram.observe(seconds, status=status)
+        if resp is None and deadline is not None and deadline.remaining() <= 0:
+            # 事件时限用完（排队太久，超时被缩短到剩余时间）导致的失败不是上游的问题，
+            # 不计入熔断，否则积压时健康的上游也会被熔断
+            return
+        # 超时、连接失败、429 和 5xx 说明上游不可用，其他状态码不影响熔断
+        ok = resp is not None and resp.status_code < 500 and resp.status_code != 429
+        openai_breaker.record(ok, seconds)
+
+    @classmethod
+    def is_stream(self, resp) -> bool:
+        # 不支持流式的兼容接口会忽略 stream 参数，直接返回完整的 JSON
+        return resp.headers.get("Content-Type", "").startswith("text/event-stream")
+
+    @classmethod
+    def parse_response(self, resp) -> str:
         if resp.status_code != 200:
-            print(resp.status_code, resp.text)
-        assert resp.status_code == 200
-        return resp.json()["choices"][0]["message"]["content"]
+            raise OpenAIError(
+                "openai status {}: {}".format(resp.status_code, resp.text[:200])
+            )
+        choice = resp.json()["choices"][0]
+        reader = CommandReader()
+        reader.add(choice["message"]["content"], choice.get("finish_reason"))
+        return reader.result()
+
+    @classmethod
+    def recognize(self, prompt: str, text: str, deadline: Deadline = None) -> str:
+        timeout = self.timeout(deadline)
+        start, resp, done = time.perf_counter(), None, False
+        try:
+            resp = requests.post(
+                timeout=timeout, stream=True, **self.request_args(prompt, text)
+            )
+            if resp.status_code != 200 or not self.is_stream(resp):
+                done = True
+                return self.parse_response(resp)
+            reader = CommandReader()
+            # 按字节切行再解码，SSE 没有声明 charset 时 requests 会按 latin-1 解码
+            for line in resp.iter_lines():
+                # 读超时只限制两个数据块的间隔，总时长按事件时限检查
+                if deadline is not None:
+                    deadline.check()
+                if reader.feed(line.decode("utf-8")):
+                    break
+            done = True
+            return reader.result()
+        finally:
+            # 读流中途出错（超时、连接断开）也算调用失败
+            self.observe(resp if done else None, time.perf_counter() - start, deadline)
+            if resp is not None:
+                # 提前结束时断开连接，上游不再继续生成
+                resp.close()
+
+    @classmethod
+    async def recognize_async(
+        self,
+        client: httpx.AsyncClient,
+        prompt: str,
+        text: str,
+        deadline: Deadline = None,
+    ) -> str:
+        timeout = self.timeout(deadline)
+        start, resp, done = time.perf_counter(), None, False
+        try:
+            async with client.stream(
+                "POST", timeout=timeout, **self.request_args(prompt, text)
+            ) as resp:
+                if resp.status_code != 200 or not self.is_stream(resp):
+                    await resp.aread()
+                    done = True
+                    return self.parse_response(resp)
+                reader = CommandReader()
+                async for line in resp.aiter_lines():
+                    if deadline is not None:
+                        deadline.check()
+                    if reader.feed(line):
+                        break
+                done = True
+                return reader.result()
+        finally:
+            self.observe(resp if done else None, time.perf_counter() - start, deadline)
 
 
 class EventHandler:
     logger: CustomAdapter = None
     data: dict = None
-    token_manager: TokenManager = None
+    feishu: FeishuClient = None
+    command: str = ""
+    log_payload: bool = True
+    deadline: Deadline = None
 
-    def __init__(self, data: dict, token_manager: TokenManager) -> None:
+    def __init__(self, data: dict, feishu: FeishuClient) -> None:
         self.data = data
-        self.token_manager = token_manager
+        self.feishu = feishu
+        # 从收到事件开始计时，排队等待的时间也算在内
+        self.deadline = Deadline(EVENT_DEADLINE)
         req_id = datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4())[:8]
         self.logger = CustomAdapter(_logger, {"req_id": req_id})
+        # 按事件采样：同一个事件的收发日志要么都有数据，要么都没有
+        self.log_payload = random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+    def payload(self, value):
+        """日志里的大块数据：输出时才序列化，过长截断，未被采样的事件不输出"""
+        if not self.log_payload:
+            return "<not sampled>"
+        return LazyPayload(value, LOG_PAYLOAD_MAX_LEN)
+
+    @property
+    def event_id(self) -> str:
+        return self.data.get("header", {}).get("event_id", "")
 
     @property
     def chat_type(self) -> str:
@@ -145,400 +477,525 @@ class EventHandler:
         assert res != ""
         return res
 
+    @property
+    def schedule_key(self) -> str:
+        """同一个 key 的事件串行处理：消息按会话，表情回应按被回应的消息"""
+        event = self.data.get("event")
+        if not isinstance(event, dict):
+            return ""
+        message = event.get("message")
+        if isinstance(message, dict) and message.get("chat_id"):
+            return message["chat_id"]
+        return event.get("message_id", "")
+
+    def is_valid(self) -> bool:
+        header = self.data.get("header")
+        if not isinstance(header, dict) or not header.get("event_type"):
+            return False
+        return isinstance(self.data.get("event"), dict)
+
+    def message_text(self) -> str:
+        """取出需要机器人处理的消息文本，不需要处理的消息返回 None"""
+        content = json.loads(self.data["event"]["message"]["content"])
+        text: str = content["text"]
+
+        mentions = self.data["event"]["message"].get("mentions", [])
+        if len(mentions) > 1:
+            # 如果at了多个人，则忽略
+            return None
+        elif len(mentions) == 1:
+            if mentions[0]["id"]["open_id"] != FEISHU_APP_OPEN_ID:
+                # 如果at的不是机器人，则忽略
+                return None
+            # 如果at了机器人，则去掉at
+            text = text.replace(mentions[0]["key"], "")
+        elif self.chat_type == "group":
+            if not text.startswith("/"):
+                # 如果群聊内的消息不是at机器人，也不是命令，则忽略
+                return None
+        return text.strip()
+
+    def reaction_delta(self, reverse=False) -> int:
+        """用户的赞/踩对应的权重变化，其他回应返回 0"""
+        if self.reaction_emoji not in [EmojiType.THUMBSUP, EmojiType.THUMBSDOWN]:
+            return 0
+        if self.reaction_operator_type != "user":
+            return 0
+        num = -1 if reverse else 1
+        if self.reaction_emoji == EmojiType.THUMBSDOWN:
+            num = -num
+        return num
+
+    def reaction_column(self) -> str:
+        """赞/踩在统计表里对应的列"""
+        return "up" if self.reaction_emoji == EmojiType.THUMBSUP else "down"
+
+    def set_command(self, cmd: str):
+        """记录本次事件执行的命令，作为指标标签（第一次设置为准）"""
+        if self.command:
+            return
+        known = cmd in COMMANDS or cmd in ("nl", "reaction", "ignored")
+        self.command = cmd if known else "other"
+
+    def observe(self, seconds: float, error: bool):
+        event_type = self.data.get("header", {}).get("event_type", "")
+        labels = {
+            "event_type": event_type if event_type in EVENT_TYPES else "other",
+            "command": self.command or "none",
+        }
+        event_histogram.observe(seconds, **labels)
+        if error:
+            event_error_counter.inc(**labels)
+
     def handle(self):
+        start, error = time.perf_counter(), False
         try:
             resp = self._handle()
-            self.logger.info("response data: %s", json.dumps(resp, ensure_ascii=False))
+            self.logger.info("response data: %s", self.payload(resp))
             return resp
+        except DeadlineExceeded as e:
+            error = True
+            self.logger.warning("give up event: %s", e)
+            return {"msg": "error"}
         except Exception as e:
+            error = True
             self.logger.exception(e)
             return {"msg": "error"}
+        finally:
+            self.observe(time.perf_counter() - start, error)
 
     def _handle(self):
-        self.logger.info("receive data: %s", json.dumps(self.data, ensure_ascii=False))
+        self.logger.info("receive data: %s", self.payload(self.data))
+        action = self.route()
+        if action:
+            func, arg = action
+            func(arg)
+        return {"msg": "ok"}
+
+    def route(self):
+        """事件对应的处理方法和参数 (func, arg)，不需要处理的事件返回 None"""
         if self.event_type == "im.message.receive_v1":
-            content = json.loads(self.data["event"]["message"]["content"])
-            text: str = content["text"]
-
-            mentions = self.data["event"]["message"].get("mentions", [])
-            if len(mentions) > 1:
-                # 如果at了多个人，则忽略
-                return {"msg": "ok"}
-            elif len(mentions) == 1:
-                if mentions[0]["id"]["open_id"] != FEISHU_APP_OPEN_ID:
-                    # 如果at的不是机器人，则忽略
-                    return {"msg": "ok"}
-                # 如果at了机器人，则去掉at
-                text = text.replace(mentions[0]["key"], "")
-            elif self.chat_type == "group":
-                if not text.startswith("/"):
-                    # 如果群聊内的消息不是at机器人，也不是命令，则忽略
-                    return {"msg": "ok"}
-            text = text.strip()
+            text = self.message_text()
+            if text is None:
+                self.set_command("ignored")
+                return None
             if text.startswith("/"):
-                self.handle_text(text)
-            else:
-                self.handle_text_gpt(text)
+                return self.handle_text, text
+            return self.handle_text_gpt, text
         elif self.event_type == "im.message.reaction.created_v1":
-            self.handle_reaction()
+            return self.handle_reaction, False
         elif self.event_type == "im.message.reaction.deleted_v1":
-            self.handle_reaction(reverse=True)
-        else:
-            self.logger.warning("unknown event type: %s", self.event_type)
-        return {"msg": "ok"}
+            return self.handle_reaction, True
+        self.logger.warning("unknown event type: %s", self.event_type)
+        return None
 
     def handle_reaction(self, reverse=False):
-        if self.reaction_emoji not in [EmojiType.THUMBSUP, EmojiType.THUMBSDOWN]:
-            return
-        if self.reaction_operator_type != "user":
+        self.set_command("reaction")
+        num = self.reaction_delta(reverse)
+        if num == 0:
             return
         record = roll_record_repo.get_roll_record(self.msg_id)
         if not record:
             # self.logger.warning("roll record not found: %s", self.data)
             return
-        card_set = card_set_repo.get_card_set(record.chat_id, record.card_set_name)
-        if not card_set:
-            self.logger.warning("card set not found: %s", self.data)
-            return
-        card = card_set.get_card(record.card_name)
-        if not card:
-            self.logger.warning("card not found: %s", self.data)
-            return
-        num = -1 if reverse else 1
-        if self.reaction_emoji == EmojiType.THUMBSUP:
-            num = num
-        elif self.reaction_emoji == EmojiType.THUMBSDOWN:
-            num = -num
-        else:
-            self.logger.warning("unknown reaction emoji: %s", self.reaction_emoji)
-            return
-        card_set.set_wight(card.name, card.weight + num)
-        card_set_repo.create_or_update_card_set(card_set)
-        self.logger.info("update card weight: %s, %d", card, num)
-
-    def handle_text(self, text: str) -> None:
-        argv = text.split()
-        cmd = argv[0]
-        if cmd == "/add":
-            return self.handle_add(argv[1:])
-        elif cmd == "/ls":
-            return self.handle_ls(argv[1:])
-        elif cmd == "/del":
-            return self.handle_del(argv[1:])
-        elif cmd == "/roll":
-            return self.handle_roll(argv[1:])
-        elif cmd == "/weight":
-            return self.handle_weight(argv[1:])
-        else:
-            return self.reply_help()
-
-    def reply_help(self):
-        lines = []
-        lines.append(
-            [
-                {
-                    "tag": "text",
-                    "text": "向集合里添加成员，请说：向吃饭集合里添加老乡鸡、和府捞面。（或使用指令：/add 吃饭 老乡鸡 和府捞面）",
-                }
-            ]
+        res = card_set_repo.change_card_weight(
+            record.chat_id, record.card_set_name, record.card_name, num
         )
-        lines.append([{"tag": "text", "text": "列出所有集合，请说：查看。（或使用指令：/ls）"}])
-        lines.append([{"tag": "text", "text": "列出集合内成员，请说：查看吃饭集合。（或使用指令：/ls 吃饭）"}])
-        # lines.append([{"tag": "text", "text": "删除集合，请说：删掉吃饭集合。（或使用指令：/del 吃饭）"}])
-        lines.append(
-            [
-                {
-                    "tag": "text",
-                    "text": "删除集合内的成员，请说：从吃饭集合里删掉老乡鸡。（或使用指令：/del 吃饭 老乡鸡）",
-                }
-            ]
-        )
-        lines.append(
-            [{"tag": "text", "text": "从集合里随机抽一个成员，请说：从吃饭集合里抽一张。（或使用指令：/roll 吃饭）"}]
+        if res is None:
+            self.logger.warning(
+                "card set or card not found: %s", self.payload(self.data)
+            )
+            return
+        old_weight, weight = res
+        roll_record_repo.record_reaction(
+            record, weight - old_weight, None if reverse else self.reaction_column()
         )
-        lines.append(
-            [
-                {
-                    "tag": "text",
-                    "text": "调整集合里的成员权重，请说：调整吃饭里老乡鸡的权重。（或使用指令：/weight 吃饭 老乡鸡）",
-                }
-            ]
+        self.logger.info(
+            "update card weight: %s, %d -> %d", record.card_name, num, weight
         )
-        lines.append([{"tag": "text", "text": "查看使用说明，请说：怎么使用。（或使用指令：/help）"}])
-        self.reply_post("使用说明", lines)
+
+    def handle_text(self, text: str) -> None:
+        self.reply_built(*self.build_text(text))
 
     def handle_text_gpt(self, text: str) -> None:
-        prompt = """
-        有一个抽卡工具，可以用指令创建/修改集合，并随机从集合内抽取元素。支持的指令如下：
-- 向集合内增加一个或多个成员：/add 集合名称 成员名称1 成员名称2 ...
-- 列出所有集合：/ls
-- 列出集合内的成员：/ls 集合名称
-- 删除集合内的成员：/del 集合名称 成员名称
-- 从集合中抽卡: /roll 集合名称
-- 调整集合内成员的权重：/weight 集合名称 成员名称
-- 查看使用说明： /help
-
-你现在扮演一个翻译的角色，将自然语言翻译成具体指令。示例：
-"吃饭可以去老乡鸡、和府捞面" -> "/add 吃饭 老乡鸡 和府捞面"
-"查看所有集合" -> "/ls"
-"查看吃饭集合" -> "/ls 吃饭"
-"从吃饭里删掉老乡鸡" -> "/del 吃饭 老乡鸡"
-"从吃饭里抽一张" -> "/roll 吃饭"
-"调整吃饭里老乡鸡的权重" -> "/weight 吃饭 老乡鸡
-"怎么使用" -> "/help"
-
-现在，请将下面的自然语言翻译成具体指令。如果无法翻译，请回复"无法理解"
-"{}" """
+        reply = self.build_nl(text)
+        if reply[0] == "gpt":
+            reply = self.recognize(text)
+        self.reply_built(*reply)
+
+    def recognize(self, text: str) -> tuple[str, object]:
+        """调用 OpenAI 把自然语言翻译成指令，返回要发送的回复"""
         try:
-            new_text = OpenAI.recognize(prompt, text)
+            new_text = OpenAI.recognize(GPT_PROMPT, text, self.deadline)
         except Exception as e:
-            self.logger.exception(e)
-            self.reply_text("自然语言识别失败，请重试或使用指令操作")
-            return
+            return self.recognize_error(e)
+        return self.build_gpt(text, new_text)
+
+    def recognize_error(self, e: Exception) -> tuple[str, object]:
+        if isinstance(e, CircuitOpenError):
+            self.logger.warning("openai circuit breaker is open, reply help")
+            return "post", ("自然语言识别暂不可用，请使用指令操作", help_lines())
+        self.logger.exception(e)
+        return "text", "自然语言识别失败，请重试或使用指令操作"
+
+    def reply_built(self, msg_type: str, content):
+        """发送 build_* 生成的回复"""
+        if msg_type == "text":
+            self.reply_text(content)
+        elif msg_type == "post":
+            self.reply_post(*content)
+        elif msg_type == "done":
+            self.fan_out(
+                (self.reply_reaction, EmojiType.DONE), (self.reply_text, content)
+            )
+        elif msg_type == "roll":
+            # 多张卡的结果消息按顺序发送，之后的记录和回应全部并发
+            verb, card_set, cards = content
+            calls = []
+            for title, card in cards:
+                msg_id = self.reply_roll_post(title, verb, card_set, card)
+                if msg_id:
+                    calls.extend(self.roll_side_effects(card_set, card, msg_id))
+            self.fan_out(*calls)
+        else:
+            self.reply_post("使用说明", help_lines())
+
+    # build_* 只读写数据库、不发消息，返回要发送的回复 (类型, 内容)：
+    # ("text", 文本)、("post", (标题, 行))、("done", 文本) 回复文本并加上完成的表情、
+    # ("roll", (动词, 集合, [(标题, 成员)])) 逐条发送抽卡结果、("help", None)。
+    # asgi 版本把它们放到线程池里调用，只重写发送消息的部分
+
+    def build_text(self, text: str) -> tuple[str, object]:
+        argv = text.split()
+        cmd = argv[0]
+        self.set_command(cmd)
+        builders = {
+            "/add": self.build_add,
+            "/ls": self.build_ls,
+            "/del": self.build_del,
+            "/roll": self.build_roll,
+            "/weight": self.build_weight,
+            "/stats": self.build_stats,
+        }
+        if cmd not in builders:
+            return "help", None
+        return builders[cmd](argv[1:])
+
+    def build_nl(self, text: str) -> tuple[str, object]:
+        """本地规则或翻译缓存能识别时直接执行，否则返回 ("gpt", None) 交给 OpenAI"""
+        self.set_command("nl")
+        set_names = card_set_repo.get_card_set_names(self.chat_id)
+        command = parse_intent(text, set_names)
+        if command:
+            self.logger.info("local intent: %s", command)
+            return self.build_text(command)
+        new_text = translation_cache.get(text)
+        if new_text is None:
+            return "gpt", None
+        self.logger.info("translation cache hit: %s", new_text)
+        return self.build_command(new_text)
+
+    def build_gpt(self, text: str, new_text: str) -> tuple[str, object]:
         self.logger.info("gpt response: %s", new_text)
+        translation_cache.put(text, new_text)
+        return self.build_command(new_text)
+
+    def build_command(self, new_text: str) -> tuple[str, object]:
         lines = new_text.strip().split("\n")
         if len(lines) == 0 or len(lines) > 1 or not lines[0].startswith("/"):
-            self.reply_help()
-            return
-        self.handle_text(lines[0])
+            return "help", None
+        return self.build_text(lines[0])
 
-    def handle_add(self, argv: list[str]):
-        if len(argv) >= 2:
-            name = argv[0]
-            card_set = card_set_repo.get_card_set(self.chat_id, name)
-            if not card_set:
-                card_set = CardSet(self.chat_id, name, create_by=self.sender_id)
-            for item in argv[1:]:
-                card_set.add_card(item)
-            card_set_repo.create_or_update_card_set(card_set)
-            self.reply_reaction(EmojiType.DONE)
-            text = '集合"{}"已添加成员：{}'.format(name, ", ".join(argv[1:]))
-            self.reply_text(text)
-            return
-        return self.reply_help()
+    def build_add(self, argv: list[str]) -> tuple[str, object]:
+        if len(argv) < 2:
+            return "help", None
+        name = argv[0]
+        card_set_repo.add_cards(self.chat_id, name, argv[1:], self.sender_id)
+        return "done", '集合"{}"已添加成员：{}'.format(name, ", ".join(argv[1:]))
 
-    def handle_ls(self, argv: list[str]):
-        if len(argv) == 0:
-            card_set_list = card_set_repo.get_card_set_list(self.chat_id)
-            if not card_set_list:
-                self.reply_text("没有集合")
-                return
-            title = "集合列表"
-            lines = []
-            for card_set in card_set_list:
-                line = []
-                line.append(
-                    {
-                        "tag": "text",
-                        "text": "{} ({}个成员)".format(
-                            card_set.name, len(card_set.get_cards())
-                        ),
-                    }
-                )
-                lines.append(line)
-            self.reply_post(title, lines)
-            return
-        elif len(argv) == 1:
-            name = argv[0]
-            card_set = card_set_repo.get_card_set(self.chat_id, name)
-            if not card_set:
-                self.reply_text("集合不存在")
-                return
-            title = "集合 {} 的成员".format(card_set.name)
-            lines = []
-            for card in card_set.get_cards():
-                line = []
-                line.append(
-                    {
-                        "tag": "text",
-                        "text": "{} (权重{})".format(card.name, card.weight),
-                    }
-                )
-                lines.append(line)
-            self.reply_post(title, lines)
-            return
-        self.reply_help()
+    def build_ls(self, argv: list[str]) -> tuple[str, object]:
+        """/ls [集合] [页码|top]，列出集合或集合内的成员"""
+        if len(argv) > 2:
+            return "help", None
+        # 纯数字的参数优先当作集合名，没有这个集合时才当作集合列表的页码
+        if not argv or (
+            len(argv) == 1
+            and argv[0].isdigit()
+            and not card_set_repo.has_card_set(self.chat_id, argv[0])
+        ):
+            page = int(argv[0]) if argv else 1
+            total = card_set_repo.count_card_sets(self.chat_id)
+            if total == 0:
+                return "text", "没有集合"
+            with closing(card_set_repo.iter_card_set_summaries(self.chat_id)) as rows:
+                lines, more = paginate(card_set_list_lines(rows), page, LS_PAGE_BYTES)
+            if not lines:
+                return "text", "页码超出范围"
+            title = "集合列表" if page == 1 else "集合列表 (第{}页)".format(page)
+            more_command = "/ls {}".format(page + 1) if more else ""
+            total_text = "共{}个集合".format(total)
+            return "post", (title, page_lines(lines, total_text, more_command))
+
+        name = argv[0]
+        stats = card_set_repo.card_set_stats(self.chat_id, name)
+        if stats is None:
+            return "text", "集合不存在"
+        count, total_weight = stats
+        if len(argv) == 2 and argv[1] == "top":
+            cards = card_set_repo.top_cards(self.chat_id, name, LS_TOP_N)
+            title = "集合 {} 权重最高的{}个成员".format(name, len(cards))
+            total_text = "共{}个成员，总权重{}".format(count, total_weight)
+            return "post", (title, page_lines(list(card_lines(cards)), total_text, ""))
+        page = 1
+        if len(argv) == 2:
+            if not argv[1].isdigit() or int(argv[1]) < 1:
+                return "text", "页码需要是正整数，或者使用 top 查看权重最高的成员"
+            page = int(argv[1])
+        if count == 0:
+            return "text", "集合为空"
+        with closing(card_set_repo.iter_cards(self.chat_id, name)) as cards:
+            lines, more = paginate(card_lines(cards), page, LS_PAGE_BYTES)
+        if not lines:
+            return "text", "页码超出范围"
+        title = "集合 {} 的成员".format(name)
+        if page > 1:
+            title += " (第{}页)".format(page)
+        more_command = "/ls {} {}".format(name, page + 1) if more else ""
+        total_text = "共{}个成员".format(count)
+        return "post", (title, page_lines(lines, total_text, more_command))
+
+    def build_stats(self, argv: list[str]) -> tuple[str, object]:
+        """/stats 集合 [天数]，从按天汇总的统计表读取"""
+        if len(argv) not in (1, 2):
+            return "help", None
+        days = STATS_DAYS
+        if len(argv) == 2:
+            if not argv[1].isdigit() or int(argv[1]) < 1:
+                return "text", "天数需要是正整数"
+            days = int(argv[1])
+        name = argv[0]
+        if not card_set_repo.has_card_set(self.chat_id, name):
+            return "text", "集合不存在"
+        since_day = stat_day(time.time() - (days - 1) * 86400)
+        stats = roll_record_repo.roll_stats(self.chat_id, name, since_day)
+        if not stats:
+            return "text", "最近{}天没有抽卡记录".format(days)
+        lines, more = paginate(stats_lines(stats), 1, LS_PAGE_BYTES)
+        total_text = "最近{}天共抽卡{}次".format(days, sum(x[1] for x in stats))
+        if more:
+            total_text += "，只显示前{}个成员".format(len(lines))
+        title = "集合 {} 的抽卡统计".format(name)
+        return "post", (title, page_lines(lines, total_text, ""))
 
-    def handle_del(self, argv: list[str]):
+    def build_del(self, argv: list[str]) -> tuple[str, object]:
         if len(argv) == 1:
             name = argv[0]
             card_set = card_set_repo.get_card_set(self.chat_id, name)
             if not card_set:
-                self.reply_text("集合不存在")
-                return
+                return "text", "集合不存在"
             # if len(card_set.get_cards()) > 0:
             # self.reply_text("集合内有{}个成员, 无法删除非空集合".format(len(card_set.get_cards())))
             # return
             card_set_repo.remove_card_set(self.chat_id, name)
-            self.reply_text("已删除集合{}，集合内有{}个成员".format(name, len(card_set.get_cards())))
-            self.reply_reaction(EmojiType.DONE)
-            return
+            return "done", "已删除集合{}，集合内有{}个成员".format(
+                name, len(card_set.get_cards())
+            )
         elif len(argv) == 2:
             name, item = argv[0], argv[1]
-            card_set = card_set_repo.get_card_set(self.chat_id, name)
-            if not card_set:
-                self.reply_text("集合不存在")
-                return
-            removed = card_set.remove_card(item)
+            if not card_set_repo.has_card_set(self.chat_id, name):
+                return "text", "集合不存在"
+            removed = card_set_repo.remove_card(self.chat_id, name, item)
             if not removed:
-                self.reply_text("成员不存在")
-                return
-            card_set_repo.create_or_update_card_set(card_set)
-            self.reply_reaction(EmojiType.DONE)
-            self.reply_text("已删除成员{}, 权重{}".format(removed.name, removed.weight))
-            return
-        return self.reply_help()
+                return "text", "成员不存在"
+            return "done", "已删除成员{}, 权重{}".format(removed.name, removed.weight)
+        return "help", None
 
-    def handle_roll(self, argv: list[str]):
+    def build_roll(self, argv: list[str]) -> tuple[str, object]:
         if len(argv) == 0:
             card_set_list = card_set_repo.get_card_set_list(self.chat_id)
             if len(card_set_list) == 1:
-                return self.handle_roll([card_set_list[0].name])
+                return self.build_roll([card_set_list[0].name])
             elif len(card_set_list) == 0:
-                self.reply_text(
-                    "没有指定集合，当前可选集合：" + ", ".join(x.name for x in card_set_list)
+                return "text", "没有指定集合，当前可选集合：" + ", ".join(
+                    x.name for x in card_set_list
                 )
-                return
-        if len(argv) == 1:
-            name = argv[0]
-            card_set = card_set_repo.get_card_set(self.chat_id, name)
-            if not card_set:
-                self.reply_text("集合不存在")
-                return
-            card = card_set.roll()
-            if not card:
-                self.reply_text("集合为空")
-                return
-            title = "抽卡结果"
-            lines = [
-                [
-                    {"tag": "text", "text": "从"},
-                    {"tag": "text", "text": card_set.name, "style": ["bold"]},
-                    {"tag": "text", "text": "里抽到了"},
-                    {"tag": "text", "text": card.name, "style": ["bold"]},
-                    {"tag": "text", "text": ", 权重"},
-                    {"tag": "text", "text": str(card.weight)},
-                ]
+        if len(argv) not in (1, 2):
+            return "help", None
+        name, num = argv[0], parse_roll_num(argv)
+        if num is None:
+            return "text", "抽卡数量需要是1到{}之间的整数".format(MAX_ROLL_NUM)
+        card_set = card_set_repo.get_card_set(self.chat_id, name)
+        if not card_set:
+            return "text", "集合不存在"
+        cards = card_set.roll_many(num) if num > 1 else [card_set.roll()]
+        cards = [x for x in cards if x]
+        if not cards:
+            if card_set.get_cards():
+                return "text", "集合内成员的权重都为0"
+            return "text", "集合为空"
+        titles = ["抽卡结果"]
+        if len(cards) > 1:
+            titles = [
+                "抽卡结果 ({}/{})".format(i + 1, len(cards)) for i in range(len(cards))
             ]
-            lines.append([{"tag": "text", "text": "-----------------"}])
-            lines.append([{"tag": "text", "text": "在本条消息中回应赞/踩可增减1点权重"}])
-            resp = self.reply_post(title, lines)
-            msg_id = resp.get("data", {}).get("message_id", "")
-            if msg_id:
-                record = RollRecord(
-                    self.chat_id,
-                    card_set.name,
-                    card.name,
-                    msg_id,
-                    self.sender_id,
-                )
-                roll_record_repo.create_roll_record(record)
-                self.reply_reaction(EmojiType.THUMBSUP, msg_id)
-                self.reply_reaction(EmojiType.THUMBSDOWN, msg_id)
-            return
-        return self.reply_help()
+        return "roll", ("里抽到了", card_set, list(zip(titles, cards)))
 
-    def handle_weight(self, argv: list[str]):
+    def build_weight(self, argv: list[str]) -> tuple[str, object]:
         if len(argv) != 2:
-            return self.reply_help()
+            return "help", None
         set_name, card_name = argv[0], argv[1]
         card_set = card_set_repo.get_card_set(self.chat_id, set_name)
         if not card_set:
-            self.reply_text("集合不存在")
-            return
+            return "text", "集合不存在"
         card = card_set.get_card(card_name)
         if not card:
-            self.reply_text("成员不存在")
-            return
+            return "text", "成员不存在"
+        return "roll", ("里取出了", card_set, [("调整权重", card)])
 
-        title = "调整权重"
-        lines = [
-            [
-                {"tag": "text", "text": "从"},
-                {"tag": "text", "text": card_set.name, "style": ["bold"]},
-                {"tag": "text", "text": "里取出了"},
-                {"tag": "text", "text": card.name, "style": ["bold"]},
-                {"tag": "text", "text": ", 权重"},
-                {"tag": "text", "text": str(card.weight)},
-            ]
+    def reply_roll_post(
+        self, title: str, verb: str, card_set: CardSet, card: Card
+    ) -> str:
+        """发送抽卡/取卡结果，返回消息 id，用户可以在这条消息上回应赞/踩"""
+        resp = self.reply_post(title, roll_post_lines(verb, card_set, card))
+        return resp.get("data", {}).get("message_id", "")
+
+    def roll_record(self, card_set: CardSet, card: Card, msg_id: str) -> RollRecord:
+        return RollRecord(
+            self.chat_id,
+            card_set.name,
+            card.name,
+            msg_id,
+            self.sender_id,
+        )
+
+    def roll_side_effects(
+        self, card_set: CardSet, card: Card, msg_id: str
+    ) -> list[tuple]:
+        record = self.roll_record(card_set, card, msg_id)
+        return [
+            (roll_record_repo.create_roll_record, record),
+            (self.reply_reaction, EmojiType.THUMBSUP, msg_id),
+            (self.reply_reaction, EmojiType.THUMBSDOWN, msg_id),
         ]
-        lines.append([{"tag": "text", "text": "-----------------"}])
-        lines.append([{"tag": "text", "text": "在本条消息中回应赞/踩可增减1点权重"}])
-        resp = self.reply_post(title, lines)
-        msg_id = resp.get("data", {}).get("message_id", "")
-        if msg_id:
-            record = RollRecord(
-                self.chat_id,
-                card_set.name,
-                card.name,
-                msg_id,
-                self.sender_id,
-            )
-            roll_record_repo.create_roll_record(record)
-            self.reply_reaction(EmojiType.THUMBSUP, msg_id)
-            self.reply_reaction(EmojiType.THUMBSDOWN, msg_id)
+
+    def fan_out(self, *calls) -> list[Exception]:
+        """并发执行互不依赖的调用（每项为 (func, *args)），等待全部完成，逐个记录失败"""
+        errors = fan_out(side_effect_executor, calls)
+        for func, e in errors:
+            self.logger.exception("%s failed: %s", func.__name__, e, exc_info=e)
+            side_effect_error_counter.inc()
+        return [e for _, e in errors]
 
     def reply_reaction(self, emoji_type: str, msg_id: str = None):
         if not msg_id:
             msg_id = self.msg_id
-        url = "{}/im/v1/messages/{}/reactions".format(FEISHU_BASE_URL, msg_id)
-        data = {"reaction_type": {"emoji_type": emoji_type}}
-        resp = requests.post(url, headers=self.token_manager.get_header(), json=data)
-        self.logger.info("send reaction %s, response: %s", emoji_type, resp.text)
+        resp = self.feishu.create_reaction(msg_id, emoji_type, self.deadline)
+        self.logger.info(
+            "send reaction %s, response: %s", emoji_type, self.payload(resp)
+        )
 
     def reply_text(self, msg: str):
-        url = "{}/im/v1/messages/{}/reply".format(FEISHU_BASE_URL, self.msg_id)
-        data = {
-            # "content": '{{"text":"<at user_id=\\"{}\\"></at> {}"}}'.format(
-            # self.sender_id, msg
-            # ),
-            "content": '{{"text":"{}"}}'.format(msg),
-            "msg_type": "text",
-        }
-        resp = requests.post(url, headers=self.token_manager.get_header(), json=data)
-        self.logger.info("send reply %s, response: %s", msg, resp.text)
+        # content = {"text": '<at user_id="{}"></at> {}'.format(self.sender_id, msg)}
+        content = {"text": msg}
+        resp = self.feishu.reply_message(self.msg_id, "text", content, self.deadline)
+        self.logger.info(
+            "send reply %s, response: %s", self.payload(msg), self.payload(resp)
+        )
 
     def reply_post(self, title: str, lines: list) -> dict:
-        url = "{}/im/v1/messages/{}/reply".format(FEISHU_BASE_URL, self.msg_id)
-        content = {
-            "zh_cn": {
-                "title": title,
-                "content": lines,
-            }
-        }
-        data = {
-            "content": json.dumps(content, ensure_ascii=False),
-            "msg_type": "post",
-        }
-        resp = requests.post(url, headers=self.token_manager.get_header(), json=data)
-        self.logger.info("send post reply %s, response: %s", data["content"], resp.text)
+        content = post_content(title, lines)
+        resp = self.feishu.reply_message(self.msg_id, "post", content, self.deadline)
+        self.logger.info(
+            "send post reply %s, response: %s",
+            self.payload(content),
+            self.payload(resp),
+        )
         return resp.json()
 
 
 def init_db():
-    global card_set_repo, roll_record_repo
-    engine = create_engine("sqlite:///data/sqlite3.db", echo=True, future=True)
-    card_set_repo = CardSetRepo(engine)
+    global card_set_repo, roll_record_repo, event_deduper, translation_cache
+    engine = create_db_engine()
+    card_set_repo = CardSetRepo(engine, cache_size=CARD_SET_CACHE_SIZE)
     roll_record_repo = RollRecordRepo(engine)
-    CardSetORM.metadata.create_all(engine)
-    RollRecordORM.metadata.create_all(engine)
+    event_deduper = EventDeduper(EventDedupRepo(engine), ttl=EVENT_DEDUP_TTL)
+    translation_cache = TranslationCache(
+        TranslationCacheRepo(engine),
+        ttl=TRANSLATION_CACHE_TTL,
+        max_rows=TRANSLATION_CACHE_MAX_ROWS,
+    )
+    migrate(engine)
+    # 迁移用过的连接不留给 fork 出来的 worker
+    engine.dispose()
+
+
+def init_retention():
+    global retention_job
+    retention_job = None
+    if RETENTION_INTERVAL <= 0:
+        return
+    retention_job = RetentionJob(
+        card_set_repo.engine,
+        roll_record_ttl=ROLL_RECORD_TTL_DAYS * 86400,
+        deleted_set_ttl=DELETED_SET_TTL_DAYS * 86400,
+        interval=RETENTION_INTERVAL,
+    )
+    retention_job.start()
+
+
+def init_metrics():
+    global metrics_collector
+    metrics_collector = MultiProcessCollector(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+    if METRICS_DIR:
+        atexit.register(metrics_collector.flush)
 
 
 def init_logging():
-    logging.basicConfig(
-        format="%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s",
-        datefmt="%Y-%m-%d:%H:%M:%S",
-        level=logging.INFO,
+    global _logger, log_listener
+    first = log_listener is None
+    log_listener = setup_logging(
+        level=logging.getLevelName(LOG_LEVEL),
+        mode=LOG_MODE,
+        fmt=LOG_FORMAT,
+        queue_size=LOG_QUEUE_SIZE,
     )
-    global _logger
+    if log_listener is not None and first:
+        atexit.register(stop_logging)
     _logger = logging.getLogger(__name__)
     # _logger.addHandler(logging.StreamHandler())
 
 
+def stop_logging():
+    # worker 里重新 setup 过，停的是当前进程自己的 listener
+    if log_listener is not None:
+        log_listener.stop()
+
+
 token_manager = TokenManager(
-    os.environ["FEISHU_APP_ID"], os.environ["FEISHU_APP_SECRET"]
+    os.environ["FEISHU_APP_ID"],
+    os.environ["FEISHU_APP_SECRET"],
+    store=FileTokenStore(
+        os.environ.get("FEISHU_TOKEN_CACHE", "data/feishu_token.json")
+    ),
+)
+feishu_client = FeishuClient(
+    token_manager,
+    base_url=FEISHU_BASE_URL,
+    connect_timeout=float(os.environ.get("FEISHU_CONNECT_TIMEOUT", "3.05")),
+    read_timeout=float(os.environ.get("FEISHU_READ_TIMEOUT", "10")),
+    rate_limits={
+        "reply_message": TokenBucket(FEISHU_REPLY_RATE, FEISHU_RATE_BURST),
+        "create_reaction": TokenBucket(FEISHU_REACTION_RATE, FEISHU_RATE_BURST),
+    },
+)
+
+side_effect_executor = ThreadPoolExecutor(
+    max_workers=SIDE_EFFECT_WORKERS, thread_name_prefix="side-effect"
 )
 
+# inline 模式下同一会话的事件在本进程内互斥
+chat_locks = KeyedLock()
+
 app = Flask(__name__)
 
 
@@ -549,12 +1006,121 @@ def index():
     data: dict = request.get_json()
     if data.get("challenge"):  # 飞书机器人验证
         return {"challenge": data["challenge"]}
-    handler = EventHandler(data, token_manager)
-    return handler.handle()
+    handler = EventHandler(data, feishu_client)
+    if event_pipeline is not None and not handler.is_valid():
+        return {"msg": "invalid event"}, 400
+    if event_deduper.is_duplicate(handler.event_id):
+        handler.logger.info("duplicate event: %s", handler.event_id)
+        return {"msg": "ok"}
+    if event_pipeline is None:
+        with chat_locks.hold(handler.schedule_key):
+            return handler.handle()
+    if not event_pipeline.submit(handler):
+        # 队列已满，返回 503 让飞书稍后重推
+        event_deduper.forget(handler.event_id)
+        return {"msg": "busy"}, 503
+    return {"msg": "ok"}
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(
+        metrics_collector.render(), content_type="text/plain; version=0.0.4"
+    )
+
+
+@app.route("/healthz")
+def healthz():
+    return health()
+
+
+@app.before_request
+def before_request():
+    # 没有走 gunicorn post_worker_init 钩子时（如 flask run），在第一个请求里初始化
+    init_worker()
+
+
+def health() -> tuple[dict, int]:
+    """就绪检查：数据库可用、事件队列在接收。token 和熔断器状态只作参考"""
+    checks = {
+        "db": ping_db(card_set_repo.engine),
+        "pipeline": event_pipeline is None or event_pipeline.accepting,
+    }
+    ready = all(checks.values())
+    return {
+        "status": "ok" if ready else "unavailable",
+        "pid": os.getpid(),
+        "checks": checks,
+        "token": token_manager.has_token(),
+        "openai": openai_breaker.state,
+    }, (200 if ready else 503)
+
+
+def init_pipeline():
+    global event_pipeline
+    event_pipeline = None
+    if EVENT_DISPATCH_MODE != "queue":
+        return
+    event_pipeline = EventPipeline(
+        lambda handler: handler.handle(),
+        workers=EVENT_WORKERS,
+        max_size=EVENT_QUEUE_SIZE,
+        put_timeout=EVENT_QUEUE_PUT_TIMEOUT,
+        key_func=lambda handler: handler.schedule_key,
+    )
+    event_pipeline.start()
+    atexit.register(drain_pipeline)
+
+
+def drain_pipeline():
+    if event_pipeline is not None:
+        event_pipeline.drain(EVENT_DRAIN_TIMEOUT)
+
+
+def init_app():
+    """
+    进程级初始化：日志、建表和迁移、指标。gunicorn --preload 时只在 master 里执行一次，
+    worker fork 出来后直接复用，不再重复迁移。
+    """
+    global app_pid
+    app_pid = os.getpid()
+    init_logging()
+    init_db()
+    init_metrics()
+
+
+def init_worker():
+    """
+    worker 级初始化，fork 之后在每个进程里执行一次（gunicorn post_worker_init 钩子，
+    或者第一个请求）。线程和连接不能跨 fork 使用：数据库连接池丢掉父进程的连接，
+    后台线程（日志、指标、token 刷新、事件队列、数据清理）在本进程里启动。
+    """
+    global worker_pid
+    pid = os.getpid()
+    if worker_pid == pid:
+        return
+    with worker_lock:
+        if worker_pid == pid:
+            return
+        if app_pid != pid:
+            reset_registry()
+            card_set_repo.engine.dispose(close=False)
+            if LOG_MODE == "queue":
+                init_logging()
+        metrics_collector.start()
+        token_manager.start()
+        init_pipeline()
+        init_retention()
+        worker_pid = pid
 
 
-init_db()
-init_logging()
+app_pid = 0
+worker_pid = 0
+worker_lock = threading.Lock()
+log_listener = None
+event_pipeline = None
+init_app()
 
 if __name__ == "__main__":
+    init_worker()
     app.run(host="::", port=8080, debug=True)
@@ -0,0 +1,315 @@
+#!encoding:utf-8
+# ASGI 入口：飞书/OpenAI 的出站请求走 asyncio，一个进程可以同时挂起大量等待中的请求。
+# 数据库仍然是同步的 SQLAlchemy，放到线程池里执行。
+# SERVER_MODE=async gunicorn  （见 gunicorn.conf.py）
+import asyncio
+import contextlib
+import inspect
+import json
+import logging
+import os
+import time
+
+import httpx
+
+import app as bot
+from app import (
+    GPT_PROMPT,
+    EmojiType,
+    EventHandler,
+    OpenAI,
+    help_lines,
+    post_content,
+    roll_post_lines,
+    side_effect_error_counter,
+)
+from domain import Card, CardSet
+from feishu import AsyncFeishuClient
+from pipeline import queue_wait_histogram
+from resilience import DeadlineExceeded
+
+# 同时在后台处理的事件数上限，超过后返回 503 让飞书稍后重推
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get("ASYNC_MAX_IN_FLIGHT", "1000"))
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "100"))
+
+
+def db(func, *args):
+    return asyncio.to_thread(func, *args)
+
+
+class AsyncEventHandler(EventHandler):
+    """
+    EventHandler 的 asyncio 版本：事件解析和 build_* 沿用父类（数据库操作放到线程池），
+    只把发送消息、调用 OpenAI 改为协程
+    """
+
+    feishu: AsyncFeishuClient = None
+    openai: httpx.AsyncClient = None
+
+    def __init__(
+        self, data: dict, feishu: AsyncFeishuClient, openai: httpx.AsyncClient
+    ) -> None:
+        super().__init__(data, feishu)
+        self.openai = openai
+
+    async def handle(self):
+        start, error = time.perf_counter(), False
+        try:
+            resp = await self._handle()
+            self.logger.info("response data: %s", self.payload(resp))
+            return resp
+        except DeadlineExceeded as e:
+            error = True
+            self.logger.warning("give up event: %s", e)
+            return {"msg": "error"}
+        except Exception as e:
+            error = True
+            self.logger.exception(e)
+            return {"msg": "error"}
+        finally:
+            self.observe(time.perf_counter() - start, error)
+
+    async def _handle(self):
+        self.logger.info("receive data: %s", self.payload(self.data))
+        action = self.route()
+        if action:
+            func, arg = action
+            await func(arg)
+        return {"msg": "ok"}
+
+    async def handle_reaction(self, reverse=False):
+        await db(super().handle_reaction, reverse)
+
+    async def handle_text(self, text: str) -> None:
+        await self.reply_built(*await db(self.build_text, text))
+
+    async def handle_text_gpt(self, text: str) -> None:
+        reply = await db(self.build_nl, text)
+        if reply[0] == "gpt":
+            reply = await self.recognize(text)
+        await self.reply_built(*reply)
+
+    async def recognize(self, text: str) -> tuple[str, object]:
+        try:
+            new_text = await OpenAI.recognize_async(
+                self.openai, GPT_PROMPT, text, self.deadline
+            )
+        except Exception as e:
+            return self.recognize_error(e)
+        return await db(self.build_gpt, text, new_text)
+
+    async def reply_built(self, msg_type: str, content):
+        if msg_type == "text":
+            await self.reply_text(content)
+        elif msg_type == "post":
+            await self.reply_post(*content)
+        elif msg_type == "done":
+            await self.fan_out(
+                (self.reply_reaction, EmojiType.DONE), (self.reply_text, content)
+            )
+        elif msg_type == "roll":
+            verb, card_set, cards = content
+            calls = []
+            for title, card in cards:
+                msg_id = await self.reply_roll_post(title, verb, card_set, card)
+                if msg_id:
+                    calls.extend(self.roll_side_effects(card_set, card, msg_id))
+            await self.fan_out(*calls)
+        else:
+            await self.reply_post("使用说明", help_lines())
+
+    async def reply_roll_post(
+        self, title: str, verb: str, card_set: CardSet, card: Card
+    ) -> str:
+        resp = await self.reply_post(title, roll_post_lines(verb, card_set, card))
+        return resp.get("data", {}).get("message_id", "")
+
+    async def fan_out(self, *calls) -> list[Exception]:
+        """并发等待互不依赖的调用，协程直接等待，同步的数据库操作放到线程池"""
+        aws = []
+        for func, *args in calls:
+            if inspect.iscoroutinefunction(func):
+                aws.append(func(*args))
+            else:
+                aws.append(db(func, *args))
+        results = await asyncio.gather(*aws, return_exceptions=True)
+        errors = []
+        for (func, *_), res in zip(calls, results):
+            if isinstance(res, Exception):
+                self.logger.exception("%s failed: %s", func.__name__, res, exc_info=res)
+                side_effect_error_counter.inc()
+                errors.append(res)
+        return errors
+
+    async def reply_reaction(self, emoji_type: str, msg_id: str = None):
+        if not msg_id:
+            msg_id = self.msg_id
+        resp = await self.feishu.create_reaction(msg_id, emoji_type, self.deadline)
+        self.logger.info(
+            "send reaction %s, response: %s", emoji_type, self.payload(resp)
+        )
+
+    async def reply_text(self, msg: str):
+        content = {"text": msg}
+        resp = await self.feishu.reply_message(
+            self.msg_id, "text", content, self.deadline
+        )
+        self.logger.info(
+            "send reply %s, response: %s", self.payload(msg), self.payload(resp)
+        )
+
+    async def reply_post(self, title: str, lines: list) -> dict:
+        content = post_content(title, lines)
+        resp = await self.feishu.reply_message(
+            self.msg_id, "post", content, self.deadline
+        )
+        self.logger.info(
+            "send post reply %s, response: %s",
+            self.payload(content),
+            self.payload(resp),
+        )
+        return resp.json()
+
+
+class AsyncKeyedLock:
+    """
+    KeyedLock 的 asyncio 版本。asyncio.Lock 按等待的先后唤醒，
+    同一个 key 的事件按到达顺序逐个执行，不同 key 并发
+    """
+
+    locks: dict = None
+
+    def __init__(self):
+        self.locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        item = self.locks.get(key)
+        if item is None:
+            # [锁, 持有或等待的协程数]
+            item = self.locks[key] = [asyncio.Lock(), 0]
+        item[1] += 1
+        start = time.perf_counter()
+        try:
+            async with item[0]:
+                queue_wait_histogram.observe(time.perf_counter() - start)
+                yield
+        finally:
+            item[1] -= 1
+            if item[1] == 0:
+                del self.locks[key]
+
+
+class Server:
+    """
+    最小的 ASGI 应用：收到事件后立即应答飞书，事件在后台 task 里处理。
+    lifespan 启动时创建连接池，关闭时等待进行中的事件处理完。
+    """
+
+    feishu: AsyncFeishuClient = None
+    openai: httpx.AsyncClient = None
+    tasks: set = None
+    chat_locks: AsyncKeyedLock = None
+
+    def __init__(self):
+        self.tasks = set()
+        self.chat_locks = AsyncKeyedLock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def startup(self):
+        bot.init_worker()
+        # httpx 会为每个请求打一条 INFO 日志，回复结果已经由 handler 记录
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        self.feishu = AsyncFeishuClient(
+            bot.token_manager,
+            base_url=bot.FEISHU_BASE_URL,
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            connect_timeout=bot.feishu_client.timeout[0],
+            read_timeout=bot.feishu_client.timeout[1],
+            # 和同步客户端共用令牌桶，本进程的发送频率不会超过配置
+            rate_limits=bot.feishu_client.rate_limits,
+        )
+        self.openai = httpx.AsyncClient(
+            timeout=bot.OPENAI_TIMEOUT,
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS),
+        )
+
+    async def shutdown(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=bot.EVENT_DRAIN_TIMEOUT)
+        await self.feishu.aclose()
+        await self.openai.aclose()
+
+    async def http(self, scope, receive, send):
+        if scope["path"] == "/metrics":
+            body = await asyncio.to_thread(bot.metrics_collector.render)
+            return await respond(send, 200, body, b"text/plain; version=0.0.4")
+        if scope["path"] == "/healthz":
+            body, status = await db(bot.health)
+            return await respond(send, status, body)
+        if scope["path"] != "/":
+            return await respond(send, 404, {"msg": "not found"})
+        if scope["method"] == "GET":
+            return await respond(send, 200, "<p>Hello, World!</p>")
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        data: dict = json.loads(body or b"{}")
+        if data.get("challenge"):  # 飞书机器人验证
+            return await respond(send, 200, {"challenge": data["challenge"]})
+        handler = AsyncEventHandler(data, self.feishu, self.openai)
+        if not handler.is_valid():
+            return await respond(send, 400, {"msg": "invalid event"})
+        if await db(bot.event_deduper.is_duplicate, handler.event_id):
+            handler.logger.info("duplicate event: %s", handler.event_id)
+            return await respond(send, 200, {"msg": "ok"})
+        if len(self.tasks) >= ASYNC_MAX_IN_FLIGHT:
+            await db(bot.event_deduper.forget, handler.event_id)
+            return await respond(send, 503, {"msg": "busy"})
+        task = asyncio.create_task(self.process(handler))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        await respond(send, 200, {"msg": "ok"})
+
+    async def process(self, handler: AsyncEventHandler):
+        async with self.chat_locks.hold(handler.schedule_key):
+            await handler.handle()
+
+
+async def respond(send, status: int, body, content_type: bytes = None):
+    if isinstance(body, str):
+        content_type = content_type or b"text/html; charset=utf-8"
+        payload = body.encode()
+    else:
+        content_type = b"application/json"
+        payload = json.dumps(body, ensure_ascii=False).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": payload})
+
+
+app = Server()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# 用已有的抽卡记录回填 roll_stat 的抽卡次数，可重复执行：python backfill.py [数据库 URL]
+# 只覆盖抽卡记录还在的日期，已被清理的日期保留增量统计的结果；赞/踩没有明细记录，无法回填。
+# 执行期间新增的抽卡可能被覆盖掉，在低峰时执行
+import logging
+import sys
+from collections import Counter
+
+from sqlalchemy.engine import Engine
+
+from migrate import migrate
+from repo import RollRecordRepo, create_db_engine, stat_day
+
+_logger = logging.getLogger(__name__)
+
+
+def backfill_roll_stats(engine: Engine, batch_size: int = 1000) -> int:
+    """按天重新统计抽卡次数并写入 roll_stat，返回写入的行数"""
+    repo = RollRecordRepo(engine)
+    counts = Counter()
+    for chat_id, card_set_name, card_name, created_at in repo.iter_roll_records(
+        batch_size
+    ):
+        counts[(chat_id, card_set_name, stat_day(created_at), card_name)] += 1
+    keys = list(counts)
+    for i in range(0, len(keys), batch_size):
+        repo.set_draws({x: counts[x] for x in keys[i : i + batch_size]})
+    return len(keys)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    db_url = sys.argv[1] if len(sys.argv) > 1 else None
+    db_engine = create_db_engine(db_url)
+    migrate(db_engine)
+    _logger.info("backfilled %d roll stat rows", backfill_roll_stats(db_engine))
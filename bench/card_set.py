@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# CardSet 单次操作耗时：原来的线性扫描实现 vs 按成员名索引的实现
+# python bench/card_set.py
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from domain import Card, CardSet
+
+SIZES = [10, 1_000, 100_000]
+OPS = 1_000
+
+
+@dataclass
+class ListCard:
+    name: str
+    weight: int
+
+
+class ListCardSet:
+    """原实现：成员存在 list 里，所有操作线性扫描"""
+
+    def __init__(self, names: list[str]):
+        self.cards = [ListCard(x, 10) for x in names]
+
+    def get_card(self, name: str):
+        for card in self.cards:
+            if card.name == name:
+                return card
+        return None
+
+    def add_card(self, name: str, weight: int = 10):
+        if self.get_card(name):
+            return
+        self.cards.append(ListCard(name, weight))
+
+    def remove_card(self, name: str):
+        for card in self.cards:
+            if card.name == name:
+                self.cards.remove(card)
+                return card
+        return None
+
+    def set_wight(self, name: str, weight: int):
+        card = self.get_card(name)
+        if card:
+            card.weight = max(weight, 0)
+
+
+def build(size: int):
+    names = ["card_{}".format(i) for i in range(size)]
+    new = CardSet("chat", "bench", create_by="u")
+    for name in names:
+        new.add_card(name)
+    return names, ListCardSet(names), new
+
+
+def per_op_us(func, args: list) -> float:
+    start = time.perf_counter()
+    for x in args:
+        func(x)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def main():
+    print(
+        "{:>8} {:<10} {:>12} {:>12} {:>8}".format(
+            "size", "op", "list us", "dict us", "x"
+        )
+    )
+    for size in SIZES:
+        names, old, new = build(size)
+        lookups = [random.choice(names) for _ in range(OPS)]
+        adds = ["new_{}".format(i) for i in range(OPS)]
+        cases = [
+            ("get_card", lookups, old.get_card, new.get_card),
+            (
+                "set_wight",
+                lookups,
+                lambda x: old.set_wight(x, 20),
+                lambda x: new.set_wight(x, 20),
+            ),
+            ("add_card", adds, old.add_card, new.add_card),
+            ("remove", adds, old.remove_card, new.remove_card),
+        ]
+        for op, args, old_func, new_func in cases:
+            old_cost = per_op_us(old_func, args)
+            new_cost = per_op_us(new_func, args)
+            print(
+                "{:>8} {:<10} {:>12.2f} {:>12.2f} {:>8.0f}".format(
+                    size, op, old_cost, new_cost, old_cost / new_cost
+                )
+            )
+    print(
+        "bytes per card: __dict__ {} __slots__ {}".format(
+            sys.getsizeof(ListCard("a", 1)) + sys.getsizeof(ListCard("a", 1).__dict__),
+            sys.getsizeof(Card("a", 1)),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
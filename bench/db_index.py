@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# 索引前后的查询延迟和 SQLite 查询计划对比
+# python bench/db_index.py [roll_record 行数] [card_set 行数]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+
+from migrate import migrate_indexes
+from repo import CardSetORM, CardSetRepo, RollRecordRepo
+
+LOOKUPS = 200
+
+
+def fill(engine, roll_records: int, card_sets: int):
+    CardSetORM.metadata.create_all(engine)
+    with engine.begin() as conn:
+        # 先去掉索引，模拟旧库
+        for table in CardSetORM.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(text("DROP INDEX IF EXISTS {}".format(index.name)))
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        now = int(time.time())
+        cur.executemany(
+            "INSERT INTO roll_record (chat_id, card_set_name, card_name, msg_id,"
+            " created_by, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    "chat_{}".format(i % 1000),
+                    "吃饭",
+                    "麦当劳",
+                    "om_{}".format(i),
+                    "u",
+                    now,
+                )
+                for i in range(roll_records)
+            ),
+        )
+        cur.executemany(
+            "INSERT INTO card_set (name, chat_id, items, created_at, created_by,"
+            " deleted) VALUES (?, ?, '[]', ?, 'u', ?)",
+            (
+                ("set_{}".format(i), "chat_{}".format(i % 1000), now, i % 5 == 0)
+                for i in range(card_sets)
+            ),
+        )
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def query_plans(engine):
+    sqls = [
+        "SELECT * FROM roll_record WHERE msg_id = 'om_1'",
+        "SELECT * FROM card_set WHERE chat_id = 'chat_1' AND name = 'set_1'"
+        " AND deleted = 0",
+    ]
+    with engine.connect() as conn:
+        for sql in sqls:
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+            print("  {}\n    -> {}".format(sql, "; ".join(row[-1] for row in plan)))
+
+
+def measure(engine, roll_records: int, card_sets: int):
+    roll_repo = RollRecordRepo(engine)
+    card_set_repo = CardSetRepo(engine)
+    for name, func in [
+        (
+            "get_roll_record",
+            lambda: roll_repo.get_roll_record(
+                "om_{}".format(random.randrange(roll_records))
+            ),
+        ),
+        (
+            "get_card_set",
+            lambda: card_set_repo.get_card_set(
+                "chat_{}".format(random.randrange(1000)),
+                "set_{}".format(random.randrange(card_sets)),
+            ),
+        ),
+    ]:
+        cost = []
+        for _ in range(LOOKUPS):
+            start = time.perf_counter()
+            func()
+            cost.append(time.perf_counter() - start)
+        cost.sort()
+        print(
+            "  {:<16} p50 {:8.3f}ms  p99 {:8.3f}ms".format(
+                name, cost[len(cost) // 2] * 1000, cost[int(len(cost) * 0.99)] * 1000
+            )
+        )
+
+
+def main():
+    roll_records = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    card_sets = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine("sqlite:///" + path, future=True)
+    start = time.time()
+    fill(engine, roll_records, card_sets)
+    print(
+        "filled {} roll records, {} card sets in {:.1f}s".format(
+            roll_records, card_sets, time.time() - start
+        )
+    )
+    print("before:")
+    query_plans(engine)
+    measure(engine, roll_records, card_sets)
+    start = time.time()
+    created = migrate_indexes(engine)
+    print("created {} in {:.1f}s".format(", ".join(created), time.time() - start))
+    print("after:")
+    query_plans(engine)
+    measure(engine, roll_records, card_sets)
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
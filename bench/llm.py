@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# 自然语言翻译成指令的耗时（time-to-command）：原来的长提示词 + 等完整回答 vs 精简提示词 + 流式提前结束
+# 本地桩服务模拟模型：提示词越长首个 token 越慢，回答逐 token 生成
+# python bench/llm.py --token-latency 0.02 --runs 20
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stubs import StubServer
+from token_store import FileTokenStore
+
+# 改动前的系统提示词
+LEGACY_PROMPT = """
+        有一个抽卡工具，可以用指令创建/修改集合，并随机从集合内抽取元素。支持的指令如下：
+- 向集合内增加一个或多个成员：/add 集合名称 成员名称1 成员名称2 ...
+- 列出所有集合：/ls
+- 列出集合内的成员：/ls 集合名称
+- 删除集合内的成员：/del 集合名称 成员名称
+- 从集合中抽卡: /roll 集合名称
+- 从集合中一次抽多张不重复的卡: /roll 集合名称 数量
+- 调整集合内成员的权重：/weight 集合名称 成员名称
+- 查看使用说明： /help
+
+你现在扮演一个翻译的角色，将自然语言翻译成具体指令。示例：
+"吃饭可以去老乡鸡、和府捞面" -> "/add 吃饭 老乡鸡 和府捞面"
+"查看所有集合" -> "/ls"
+"查看吃饭集合" -> "/ls 吃饭"
+"从吃饭里删掉老乡鸡" -> "/del 吃饭 老乡鸡"
+"从吃饭里抽一张" -> "/roll 吃饭"
+"从吃饭里抽3张" -> "/roll 吃饭 3"
+"调整吃饭里老乡鸡的权重" -> "/weight 吃饭 老乡鸡
+"怎么使用" -> "/help"
+
+现在，请将下面的自然语言翻译成具体指令。如果无法翻译，请回复"无法理解"
+"{}" """
+
+# 模型经常在指令后面附带解释
+ANSWERS = {
+    "command": "/roll 吃饭 3\n\n这条指令会从“吃饭”集合中一次抽取3张不重复的卡片，"
+    "每张卡片被抽中的概率和它的权重成正比。",
+    "not command": "无法理解。你可以试试说“从吃饭里抽一张”或者“查看所有集合”。",
+}
+
+
+def setup_env(base_url: str):
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        {
+            "OPENAI_API_BASE_URL": base_url,
+            "FEISHU_BASE_URL": base_url,
+            "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "llm.db"),
+            "FEISHU_TOKEN_CACHE": os.path.join(workdir, "feishu_token.json"),
+            "METRICS_DIR": "",
+            "RETENTION_INTERVAL": "0",
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    for key in ["FEISHU_APP_ID", "FEISHU_APP_SECRET", "OPENAI_API_KEY"]:
+        os.environ.setdefault(key, "bench")
+    os.environ.setdefault("FEISHU_APP_OPEN_ID", "ou_bot")
+    # 预先放一个有效的 token，不会去请求真实的飞书
+    FileTokenStore(os.environ["FEISHU_TOKEN_CACHE"]).save(
+        "stub-token", time.time() + 86400
+    )
+
+
+def measure(bot, prompt: str, stream: bool, max_tokens: int, runs: int) -> tuple:
+    bot.OPENAI_STREAM = stream
+    bot.OPENAI_MAX_TOKENS = max_tokens
+    res = []
+    for i in range(runs):
+        start = time.perf_counter()
+        command = bot.OpenAI.recognize(prompt, "从吃饭里抽3张 {}".format(i))
+        res.append((time.perf_counter() - start) * 1000)
+    return res, command
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="网络往返，秒")
+    parser.add_argument(
+        "--prompt-latency", type=float, default=0.1, help="每 1000 个提示词字符，秒"
+    )
+    parser.add_argument(
+        "--token-latency", type=float, default=0.02, help="每生成一个 token，秒"
+    )
+    args = parser.parse_args()
+
+    stub = StubServer(
+        latency=args.latency,
+        prompt_latency=args.prompt_latency,
+        token_latency=args.token_latency,
+    ).start()
+    setup_env(stub.base_url)
+    import app as bot
+
+    variants = [
+        ("原实现（长提示词，等完整回答）", LEGACY_PROMPT, False, 0),
+        ("精简提示词 + max_tokens", bot.GPT_PROMPT, False, bot.OPENAI_MAX_TOKENS),
+        ("精简提示词 + 流式提前结束", bot.GPT_PROMPT, True, bot.OPENAI_MAX_TOKENS),
+    ]
+    print(
+        "prompt chars: legacy {}, compact {}".format(
+            len(LEGACY_PROMPT), len(bot.GPT_PROMPT)
+        )
+    )
+    for answer_name, answer in ANSWERS.items():
+        stub.gpt_answer = answer
+        print("\nanswer: {}".format(answer_name))
+        for name, prompt, stream, max_tokens in variants:
+            values, command = measure(bot, prompt, stream, max_tokens, args.runs)
+            print(
+                "  p50 {:>8.1f} ms  max {:>8.1f} ms  {}  -> {!r}".format(
+                    statistics.median(values), max(values), name, command[:20]
+                )
+            )
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
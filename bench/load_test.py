@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# 回放/合成飞书事件压测：本地桩服务扮演飞书和 OpenAI，按目标 RPS 打真实的 app，输出 JSON 报告
+# python bench/load_test.py --mode queue --rps 50 --duration 20 --latency 0.05 \
+#     --events requests.jsonl --out bench/reports/queue.json
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests
+
+from bench.stubs import StubServer
+from token_store import FileTokenStore
+
+CHATS = 8
+SET_NAME = "吃饭"
+MEMBERS = ["麦当劳", "肯德基", "老乡鸡", "和府捞面", "沙县小吃", "兰州拉面"]
+GPT_TEXTS = ["随便推荐一个", "今天吃点什么好", "帮我看看都有什么", "来点建议"]
+
+# 合成事件的比例：(权重, 类型)
+MIX = [
+    (25, "/roll"),
+    (5, "/roll N"),
+    (10, "/ls"),
+    (10, "/ls set"),
+    (5, "/add"),
+    (2, "/del"),
+    (3, "/weight"),
+    (10, "nl local"),
+    (10, "nl gpt"),
+    (15, "reaction.created"),
+    (5, "reaction.deleted"),
+]
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(int(len(values) * q), len(values) - 1)] * 1000, 3)
+
+    return {
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def message_event(event_id: str, msg_id: str, chat_id: str, text: str) -> dict:
+    chat_type = "group" if text.startswith("/") else "p2p"
+    return {
+        "header": {"event_type": "im.message.receive_v1", "event_id": event_id},
+        "event": {
+            "message": {
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                "message_id": msg_id,
+                "content": json.dumps({"text": text}, ensure_ascii=False),
+            },
+            "sender": {"sender_id": {"open_id": "ou_load"}},
+        },
+    }
+
+
+def reaction_event(event_id: str, msg_id: str, emoji: str, deleted: bool) -> dict:
+    event_type = "im.message.reaction.{}_v1".format("deleted" if deleted else "created")
+    return {
+        "header": {"event_type": event_type, "event_id": event_id},
+        "event": {
+            "message_id": msg_id,
+            "reaction_type": {"emoji_type": emoji},
+            "operator_type": "user",
+        },
+    }
+
+
+def command_label(data: dict) -> str:
+    event_type = data.get("header", {}).get("event_type", "")
+    if event_type.startswith("im.message.reaction."):
+        return event_type[len("im.message.") : -len("_v1")]
+    try:
+        text = json.loads(data["event"]["message"]["content"])["text"].strip()
+    except (KeyError, TypeError, ValueError):
+        return "other"
+    return text.split()[0] if text.startswith("/") else "nl"
+
+
+def load_replay(path: str) -> list[dict]:
+    """
+    每行一个事件：完整的 webhook 数据（带 header）原样回放；
+    其他行取 text（或 title）作为一条自然语言消息。
+    """
+    res = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if "header" in data:
+                res.append(data)
+            elif data.get("text") or data.get("title"):
+                res.append({"text": data.get("text") or data["title"]})
+    return res
+
+
+class EventSource:
+    """按 MIX 合成事件，按 replay_ratio 的比例插入回放事件"""
+
+    def __init__(self, stub: StubServer, replay: list[dict], replay_ratio: float):
+        self.stub = stub
+        self.replay = replay
+        self.replay_ratio = replay_ratio if replay else 0
+        self.num = 0
+        self.added = []
+        self.lock = threading.Lock()
+
+    def next(self) -> dict:
+        with self.lock:
+            self.num += 1
+            num = self.num
+        event_id, msg_id = "ev_load_{}".format(num), "om_load_{}".format(num)
+        chat_id = "oc_load_{}".format(num % CHATS)
+        if random.random() < self.replay_ratio:
+            data = json.loads(json.dumps(self.replay[num % len(self.replay)]))
+            if "text" in data:
+                return message_event(event_id, msg_id, chat_id, data["text"])
+            # 换掉 event_id/message_id，避免被去重
+            data["header"]["event_id"] = event_id
+            if "message" in data.get("event", {}):
+                data["event"]["message"]["message_id"] = msg_id
+            return data
+
+        kind = random.choices([x[1] for x in MIX], [x[0] for x in MIX])[0]
+        if kind.startswith("reaction."):
+            targets = self.stub.roll_reply_ids()
+            if targets:
+                emoji = random.choice(["THUMBSUP", "ThumbsDown"])
+                deleted = kind == "reaction.deleted"
+                return reaction_event(event_id, random.choice(targets), emoji, deleted)
+            kind = "/roll"
+        if kind == "/roll":
+            text = "/roll {}".format(SET_NAME)
+        elif kind == "/roll N":
+            text = "/roll {} {}".format(SET_NAME, random.randint(2, 4))
+        elif kind == "/ls":
+            text = "/ls"
+        elif kind == "/ls set":
+            text = "/ls {}".format(SET_NAME)
+        elif kind == "/add":
+            name = "新店{}".format(num)
+            with self.lock:
+                self.added.append((chat_id, name))
+            text = "/add {} {}".format(SET_NAME, name)
+        elif kind == "/del":
+            with self.lock:
+                chat_id, name = self.added.pop() if self.added else (chat_id, "无")
+            text = "/del {} {}".format(SET_NAME, name)
+        elif kind == "/weight":
+            text = "/weight {} {}".format(SET_NAME, random.choice(MEMBERS))
+        elif kind == "nl local":
+            text = "从{}里抽一张".format(SET_NAME)
+        else:
+            text = random.choice(GPT_TEXTS)
+        return message_event(event_id, msg_id, chat_id, text)
+
+
+def setup_env(args, stub: StubServer, workdir: str):
+    env = {
+        "FEISHU_BASE_URL": stub.base_url,
+        "OPENAI_API_BASE_URL": stub.base_url,
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "load.db"),
+        "FEISHU_TOKEN_CACHE": os.path.join(workdir, "feishu_token.json"),
+        "EVENT_DISPATCH_MODE": "queue" if args.mode == "queue" else "inline",
+        "RETENTION_INTERVAL": "0",
+        "SQL_ECHO": "0",
+        # 默认放开本地限流，测的是事件处理；需要时用 --reply-rate/--reaction-rate 打开
+        "FEISHU_REPLY_RATE": str(args.reply_rate),
+        "FEISHU_REACTION_RATE": str(args.reaction_rate),
+        "FEISHU_RATE_BURST": str(max(args.reply_rate, args.reaction_rate)),
+    }
+    os.environ.update(env)
+    for key in ["FEISHU_APP_ID", "FEISHU_APP_SECRET", "OPENAI_API_KEY"]:
+        os.environ.setdefault(key, "load-test")
+    os.environ.setdefault("FEISHU_APP_OPEN_ID", "ou_bot")
+    # 预先放一个有效的 token，token 管理器直接复用，不会去请求真实的飞书
+    FileTokenStore(env["FEISHU_TOKEN_CACHE"]).save("stub-token", time.time() + 86400)
+
+
+def start_server(mode: str) -> str:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    if mode == "async":
+        import uvicorn
+
+        import asgi
+
+        config = uvicorn.Config(asgi.app, log_level="warning", lifespan="on")
+        server = uvicorn.Server(config)
+        threading.Thread(
+            target=server.run, kwargs={"sockets": [sock]}, daemon=True
+        ).start()
+        while not server.started:
+            time.sleep(0.01)
+    else:
+        from werkzeug.serving import make_server
+
+        import app
+
+        sock.close()
+        server = make_server("127.0.0.1", port, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}/".format(port)
+
+
+class DBCounter:
+    """统计 app 发出的 SQL 语句数"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.num = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self.count)
+
+    def count(self, *args):
+        with self.lock:
+            self.num += 1
+
+
+def settle(stub: StubServer, db: DBCounter, quiet: float = 0.3, timeout: float = 60):
+    """等后台处理（队列、异步任务、副作用）都结束：桩服务和数据库一段时间内都没有新调用"""
+    deadline = time.time() + timeout
+    last = None
+    while time.time() < deadline:
+        current = (len(stub.snapshot()), db.num)
+        if current == last:
+            return
+        last = current
+        time.sleep(quiet)
+
+
+def calibrate(url: str, source: EventSource, stub, db) -> dict:
+    """每类命令单独发一次，统计一次处理产生的 SQL 语句数和出站调用数"""
+    res = {}
+    session = requests.Session()
+    for _ in range(200):
+        data = source.next()
+        label = command_label(data)
+        if label in res:
+            continue
+        settle(stub, db)
+        calls, queries = len(stub.snapshot()), db.num
+        session.post(url, json=data)
+        settle(stub, db)
+        res[label] = {
+            "db_queries": db.num - queries,
+            "outbound_calls": len(stub.snapshot()) - calls,
+        }
+    return res
+
+
+def run_load(url: str, source: EventSource, rps: float, duration: float, workers: int):
+    """
+    开环压测：第 i 个事件在 t0 + i/rps 发出，延迟从计划发出时间算起，
+    服务端变慢时排队时间也会计入，不会被客户端的等待掩盖。
+    """
+    local = threading.local()
+    sent = []
+    lock = threading.Lock()
+
+    def send(data: dict, scheduled: float):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            status = local.session.post(url, json=data, timeout=30).status_code
+        except requests.RequestException:
+            status = 0
+        ack = time.perf_counter() - scheduled
+        with lock:
+            sent.append((data, scheduled, ack, status))
+
+    total = int(rps * duration)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    start = time.perf_counter()
+    for i in range(total):
+        scheduled = start + i / rps
+        wait = scheduled - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        pool.submit(send, source.next(), scheduled)
+    pool.shutdown(wait=True)
+    return sent, time.perf_counter() - start
+
+
+RATE_LIMITED_ENDPOINTS = ("reply_message", "create_reaction")
+
+
+def rate_limit_waits() -> dict:
+    """{接口: (排队次数, 总等待秒数)}，取自本地限流器的指标"""
+    from feishu import rate_limit_wait_histogram
+
+    return {
+        x: rate_limit_wait_histogram.get(endpoint=x) for x in RATE_LIMITED_ENDPOINTS
+    }
+
+
+def build_report(
+    args, sent, elapsed, stub, db, db_before, calls_before, calibration, waits_before
+):
+    calls = stub.snapshot()[calls_before:]
+    # 出站调用归属到触发它的事件：回复挂在原消息上，回应挂在回复消息上
+    origin = {x.reply_id: x.msg_id for x in calls if x.reply_id}
+    last_call = {}
+    outbound = defaultdict(lambda: defaultdict(int))
+    for call in calls:
+        msg_id = origin.get(call.msg_id, call.msg_id)
+        if not msg_id:
+            continue
+        last_call[msg_id] = max(last_call.get(msg_id, 0), call.at)
+        outbound[msg_id][call.endpoint] += 1
+        if call.status != 200:
+            outbound[msg_id]["errors"] += 1
+
+    gpt_calls = sum(1 for x in calls if x.endpoint == "openai")
+    commands = defaultdict(lambda: {"ack": [], "e2e": [], "count": 0, "non_200": 0})
+    outbound_by_cmd = defaultdict(lambda: defaultdict(int))
+    for data, scheduled, ack, status in sent:
+        label = command_label(data)
+        item = commands[label]
+        item["count"] += 1
+        item["ack"].append(ack)
+        if status != 200:
+            item["non_200"] += 1
+        # 只有消息事件能从出站调用算出端到端延迟，回应事件没有出站调用
+        msg_id = data.get("event", {}).get("message", {}).get("message_id", "")
+        if msg_id and msg_id in last_call:
+            item["e2e"].append(max(last_call[msg_id] - scheduled, ack))
+            for endpoint, num in outbound[msg_id].items():
+                outbound_by_cmd[label][endpoint] += num
+    if gpt_calls:
+        outbound_by_cmd["nl"]["openai"] += gpt_calls
+
+    report = {
+        "config": vars(args),
+        "elapsed": round(elapsed, 3),
+        "sent": len(sent),
+        "throughput": round(len(sent) / elapsed, 2),
+        "non_200": sum(1 for x in sent if x[3] != 200),
+        "ack": percentiles([x[2] for x in sent]),
+        "db_queries": db.num - db_before,
+        "outbound": dict(Counter(x.endpoint for x in calls)),
+        "outbound_errors": sum(1 for x in calls if x.status != 200),
+        "rate_limit_wait": {},
+        "commands": {},
+    }
+    for endpoint, (count, total) in rate_limit_waits().items():
+        count -= waits_before[endpoint][0]
+        total -= waits_before[endpoint][1]
+        report["rate_limit_wait"][endpoint] = {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 3) if count else None,
+            "total_s": round(total, 3),
+        }
+    for label, item in sorted(commands.items()):
+        report["commands"][label] = {
+            "count": item["count"],
+            "non_200": item["non_200"],
+            "ack": percentiles(item["ack"]),
+            "e2e": percentiles(item["e2e"]),
+            "outbound": dict(outbound_by_cmd[label]),
+            "per_event": calibration.get(label, {}),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["sync", "queue", "async"], default="sync")
+    parser.add_argument("--rps", type=float, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=64, help="客户端并发连接数")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="桩服务固定延迟(秒)"
+    )
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--gpt-answer", default="/ls")
+    parser.add_argument("--events", default=os.path.join(ROOT, "requests.jsonl"))
+    parser.add_argument("--replay-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--reply-rate", type=float, default=10000, help="每秒回复数限制，默认不限"
+    )
+    parser.add_argument(
+        "--reaction-rate",
+        type=float,
+        default=10000,
+        help="每秒表情回应数限制，默认不限",
+    )
+    parser.add_argument("--out", default="")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    stub = StubServer(
+        args.latency, args.jitter, args.error_rate, args.error_status, args.gpt_answer
+    ).start()
+    workdir = tempfile.mkdtemp()
+    setup_env(args, stub, workdir)
+
+    import logging
+
+    import app
+
+    logging.disable(logging.WARNING)
+    for i in range(CHATS):
+        app.card_set_repo.add_cards("oc_load_{}".format(i), SET_NAME, MEMBERS, "u")
+    db = DBCounter(app.card_set_repo.engine)
+    url = start_server(args.mode)
+
+    replay = load_replay(args.events) if os.path.exists(args.events) else []
+    source = EventSource(stub, replay, args.replay_ratio)
+    calibration = calibrate(url, source, stub, db)
+
+    settle(stub, db)
+    db_before, calls_before = db.num, len(stub.snapshot())
+    waits_before = rate_limit_waits()
+    sent, elapsed = run_load(url, source, args.rps, args.duration, args.workers)
+    settle(stub, db)
+    report = build_report(
+        args,
+        sent,
+        elapsed,
+        stub,
+        db,
+        db_before,
+        calls_before,
+        calibration,
+        waits_before,
+    )
+    report["replayed_events"] = len(replay)
+
+    out = args.out or os.path.join(
+        ROOT, "bench", "reports", "load_{}_{}.json".format(args.mode, int(time.time()))
+    )
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(
+        "{} events in {:.1f}s ({} rps), ack p50 {} p99 {} ms, report: {}".format(
+            report["sent"],
+            report["elapsed"],
+            report["throughput"],
+            report["ack"]["p50"],
+            report["ack"]["p99"],
+            out,
+        )
+    )
+    for label, item in report["commands"].items():
+        print(
+            "  {:<18} n={:<5} ack p99 {!s:>9} ms  e2e p50 {!s:>9} p95 {!s:>9} p99 {!s:>9} ms".format(
+                label,
+                item["count"],
+                item["ack"]["p99"],
+                item["e2e"]["p50"],
+                item["e2e"]["p95"],
+                item["e2e"]["p99"],
+            )
+        )
+    for endpoint, item in report["rate_limit_wait"].items():
+        print(
+            "  rate limit wait    {:<18} n={:<5} avg {!s:>9} ms  total {} s".format(
+                endpoint, item["count"], item["avg_ms"], item["total_s"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# 冷启动耗时：单进程 import app 的时间，以及 gunicorn 从启动到 /healthz 可用、所有 worker 就绪的时间
+# python bench/startup.py --workers 4 --runs 3
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from token_store import FileTokenStore
+
+
+def bench_env(workdir: str) -> dict:
+    env = dict(os.environ)
+    env.update(
+        {
+            "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "startup.db"),
+            "FEISHU_TOKEN_CACHE": os.path.join(workdir, "feishu_token.json"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+            "RETENTION_INTERVAL": "0",
+            "LOG_LEVEL": "WARNING",
+            "PYTHONPATH": ROOT,
+        }
+    )
+    for key in ["FEISHU_APP_ID", "FEISHU_APP_SECRET", "OPENAI_API_KEY"]:
+        env.setdefault(key, "bench")
+    env.setdefault("OPENAI_API_BASE_URL", "http://127.0.0.1:1")
+    env.setdefault("FEISHU_APP_OPEN_ID", "ou_bot")
+    # 预先放一个有效的 token，不会去请求真实的飞书
+    FileTokenStore(env["FEISHU_TOKEN_CACHE"]).save("bench-token", time.time() + 86400)
+    return env
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_time(env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        cwd=tempfile.mkdtemp(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def gunicorn_start(env: dict, workers: int, preload: bool, timeout: float) -> dict:
+    """返回 {"ready": 第一次 /healthz 成功的秒数, "all": 所有 worker 都响应过的秒数}"""
+    port = free_port()
+    env = dict(env, GUNICORN_PRELOAD="1" if preload else "0")
+    cmd = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-w",
+        str(workers),
+        "--bind",
+        "127.0.0.1:{}".format(port),
+        "--log-level",
+        "warning",
+    ]
+    url = "http://127.0.0.1:{}/healthz".format(port)
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, cwd=ROOT)
+    res, pids = {"ready": None, "all": None}, set()
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                # 每次新建连接，请求会分到不同的 worker
+                resp = requests.get(url, timeout=1, headers={"Connection": "close"})
+            except requests.RequestException:
+                time.sleep(0.01)
+                continue
+            if resp.status_code != 200:
+                time.sleep(0.01)
+                continue
+            elapsed = time.perf_counter() - start
+            if res["ready"] is None:
+                res["ready"] = elapsed
+            pids.add(resp.json().get("pid"))
+            if len(pids) >= workers:
+                res["all"] = elapsed
+                break
+    finally:
+        proc.terminate()
+        proc.wait(30)
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    env = bench_env(tempfile.mkdtemp())
+    imports = [import_time(env) for _ in range(args.runs)]
+    report = {"import_app_s": round(statistics.median(imports), 3)}
+    for preload in (False, True):
+        runs = [
+            gunicorn_start(env, args.workers, preload, args.timeout)
+            for _ in range(args.runs)
+        ]
+        for key in ("ready", "all"):
+            values = [x[key] for x in runs if x[key] is not None]
+            name = "{}_{}_s".format("preload" if preload else "no_preload", key)
+            report[name] = round(statistics.median(values), 3) if values else None
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!encoding:utf-8
+# 压测用的本地桩服务：飞书开放接口（回复、表情回应、鉴权）和 OpenAI chat completions
+# 可以配置固定延迟 + 随机抖动，以及按比例注入错误；OpenAI 支持流式回答（SSE），按 token 计生成耗时
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_REPLY = re.compile(r"/im/v1/messages/(?P<msg_id>[^/]+)/reply$")
+_REACTION = re.compile(r"/im/v1/messages/(?P<msg_id>[^/]+)/reactions$")
+
+
+class StubCall:
+    __slots__ = ("endpoint", "msg_id", "body", "status", "at", "reply_id")
+
+    def __init__(self, endpoint, msg_id, body, status, at, reply_id=""):
+        self.endpoint = endpoint
+        self.msg_id = msg_id
+        self.body = body
+        self.status = status
+        self.at = at
+        self.reply_id = reply_id
+
+
+class StubServer:
+    """
+    一个进程内的 HTTP 桩服务，同时扮演飞书和 OpenAI。
+    latency: 每个请求的固定延迟（秒），jitter: 额外的 [0, jitter) 随机延迟，
+    error_rate: 返回 error_status 的比例，gpt_answer: chat completions 的回答。
+    模拟模型耗时：prompt_latency 是每 1000 个提示词字符的处理时间（首个 token 之前），
+    token_latency 是每生成一个 token（这里按一个字符算）的时间，max_tokens 会截断回答。
+    所有请求按到达顺序记录在 calls 里。
+    """
+
+    latency: float = 0
+    jitter: float = 0
+    error_rate: float = 0
+    error_status: int = 500
+    gpt_answer: str = "/ls"
+    prompt_latency: float = 0
+    token_latency: float = 0
+    calls: list = None
+    lock: threading.Lock = None
+    server: ThreadingHTTPServer = None
+
+    def __init__(
+        self,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        error_status: int = 500,
+        gpt_answer: str = "/ls",
+        prompt_latency: float = 0,
+        token_latency: float = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.gpt_answer = gpt_answer
+        self.prompt_latency = prompt_latency
+        self.token_latency = token_latency
+        self.calls = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self) -> "StubServer":
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, resp = stub.handle(self.path, body)
+                if status == 200 and body.get("stream") and "choices" in resp:
+                    self.send_stream(stub.completion_chunks(body))
+                    return
+                payload = json.dumps(resp, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def send_stream(self, chunks):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for chunk in chunks:
+                        data = "data: {}\n\n".format(chunk).encode()
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端提前断开，停止生成
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, path: str, body: dict) -> tuple[int, dict]:
+        delay = self.latency + random.random() * self.jitter
+        if delay > 0:
+            time.sleep(delay)
+        if path.endswith("/chat/completions"):
+            endpoint, msg_id = "openai", ""
+        elif _REPLY.search(path):
+            endpoint, msg_id = "reply", _REPLY.search(path).group("msg_id")
+        elif _REACTION.search(path):
+            endpoint, msg_id = "reaction", _REACTION.search(path).group("msg_id")
+        else:
+            endpoint, msg_id = "other", ""
+
+        status, resp, reply_id = 200, {"code": 0}, ""
+        if random.random() < self.error_rate:
+            status, resp = self.error_status, {"code": -1, "msg": "injected error"}
+        elif endpoint == "openai":
+            prompt = "".join(x["content"] for x in body.get("messages", []))
+            time.sleep(self.prompt_latency * len(prompt) / 1000)
+            tokens, finish_reason = self.completion_tokens(body)
+            if not body.get("stream"):
+                time.sleep(self.token_latency * len(tokens))
+            message = {"content": "".join(tokens)}
+            resp = {"choices": [{"message": message, "finish_reason": finish_reason}]}
+        elif endpoint == "reply":
+            reply_id = "om_stub_{}".format(next(self.ids))
+            resp = {"code": 0, "data": {"message_id": reply_id}}
+        elif endpoint == "other" and "tenant_access_token" in path:
+            resp = {"code": 0, "tenant_access_token": "stub-token", "expire": 7200}
+        call = StubCall(endpoint, msg_id, body, status, time.perf_counter(), reply_id)
+        with self.lock:
+            self.calls.append(call)
+        return status, resp
+
+    def completion_tokens(self, body: dict) -> tuple[list[str], str]:
+        tokens = list(self.gpt_answer)
+        max_tokens = body.get("max_tokens")
+        if max_tokens and len(tokens) > max_tokens:
+            return tokens[:max_tokens], "length"
+        return tokens, "stop"
+
+    def completion_chunks(self, body: dict):
+        """流式回答的 SSE 数据，每个 token 一块"""
+        tokens, finish_reason = self.completion_tokens(body)
+        for token in tokens:
+            time.sleep(self.token_latency)
+            choice = {"delta": {"content": token}, "finish_reason": None}
+            yield json.dumps({"choices": [choice]}, ensure_ascii=False)
+        yield json.dumps({"choices": [{"delta": {}, "finish_reason": finish_reason}]})
+        yield "[DONE]"
+
+    def snapshot(self) -> list[StubCall]:
+        with self.lock:
+            return list(self.calls)
+
+    def counts(self) -> dict:
+        return dict(Counter(x.endpoint for x in self.snapshot()))
+
+    def roll_reply_ids(self) -> list[str]:
+        """抽卡结果消息的 id，压测时对这些消息发赞/踩"""
+        res = []
+        for call in self.snapshot():
+            if call.reply_id and "抽卡结果" in call.body.get("content", ""):
+                res.append(call.reply_id)
+        return res
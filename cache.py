@@ -0,0 +1,51 @@
+#!encoding:utf-8
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """线程安全的 LRU 缓存，每个条目有过期时间，超出容量时淘汰最久未使用的条目"""
+
+    max_size: int = 0
+    ttl: float = 0
+    data: OrderedDict = None
+    lock: threading.Lock = None
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            expire_at, value = item
+            if expire_at < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expire_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (expire_at, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
@@ -0,0 +1,79 @@
+#!encoding:utf-8
+import logging
+import time
+
+from cache import TTLCache
+from metrics import Counter
+from repo import EventDedupRepo
+
+_logger = logging.getLogger(__name__)
+
+dedup_counter = Counter(
+    "event_dedup_total", "事件去重检查次数，result=hit 表示重复事件", ("result",)
+)
+
+
+class EventDeduper:
+    """
+    两级事件去重：进程内 TTL/LRU 集合 + SQLite 表（多个 gunicorn worker 共享）。
+    以飞书 header.event_id 为键，重复事件在任何业务处理之前被丢弃。
+    """
+
+    repo: EventDedupRepo = None
+    seen: TTLCache = None
+    ttl: float = 0
+    purge_interval: float = 0
+    last_purge: float = 0
+
+    def __init__(
+        self,
+        repo: EventDedupRepo,
+        max_size: int = 4096,
+        ttl: float = 12 * 3600,
+        purge_interval: float = 600,
+    ):
+        self.repo = repo
+        self.seen = TTLCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.last_purge = time.time()
+
+    def is_duplicate(self, event_id: str) -> bool:
+        if not event_id:
+            return False
+        if self.seen.get(event_id):
+            dedup_counter.inc(result="hit")
+            return True
+        self.seen.set(event_id, True)
+        try:
+            first_seen = self.repo.mark_event(event_id)
+        except Exception as e:
+            # 去重表不可用时放行，宁可重复处理也不丢事件
+            _logger.exception(e)
+            first_seen = True
+        self._maybe_purge()
+        if not first_seen:
+            dedup_counter.inc(result="hit")
+            return True
+        dedup_counter.inc(result="miss")
+        return False
+
+    def forget(self, event_id: str):
+        """事件未被处理（如队列满被拒绝）时调用，让飞书重推的事件可以再次进入"""
+        if not event_id:
+            return
+        self.seen.pop(event_id)
+        try:
+            self.repo.remove_event(event_id)
+        except Exception as e:
+            _logger.exception(e)
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now - self.last_purge < self.purge_interval:
+            return
+        self.last_purge = now
+        try:
+            self.repo.purge_events(now - self.ttl)
+        except Exception as e:
+            _logger.exception(e)
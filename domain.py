@@ -1,12 +1,15 @@
 #!encoding:utf-8
 
 from dataclasses import dataclass
+import bisect
+import heapq
+import itertools
 import random
 
 DEFAULT_CARD_WIGHT = 10
 
 
-@dataclass
+@dataclass(slots=True)
 class Card:
     name: str
     weight: int
@@ -16,57 +19,93 @@ class Card:
 class CardSet:
     chat_id: str
     name: str
-    cards: list[Card]
+    cards: dict[str, Card]  # 成员名 -> 成员，dict 保持插入顺序
     create_by: str
 
     def __init__(self, chat_id: str, name: str, create_by: str):
         self.chat_id = chat_id
         self.name = name
-        self.cards = []
+        self.cards = {}
         self.create_by = create_by
+        # 抽卡用的累计权重表，成员或权重变化时 version 加一，下次抽卡时重建
+        self.version = 0
+        self.sampler = None
 
     def add_card(self, name: str, weight: int = DEFAULT_CARD_WIGHT):
-        if self.get_card(name):
+        if name in self.cards:
             return
-        card = Card(name, weight)
-        self.cards.append(card)
+        self.cards[name] = Card(name, weight)
+        self.version += 1
 
     def remove_card(self, name: str) -> Card:
-        for card in self.cards:
-            if card.name == name:
-                self.cards.remove(card)
-                return card
-        return None
+        card = self.cards.pop(name, None)
+        if card:
+            self.version += 1
+        return card
 
     def get_card(self, name: str) -> Card:
-        for card in self.cards:
-            if card.name == name:
-                return card
-        return None
+        return self.cards.get(name)
 
     def get_cards(self) -> list[Card]:
-        return self.cards
+        return list(self.cards.values())
+
+    def copy(self) -> "CardSet":
+        card_set = CardSet(self.chat_id, self.name, create_by=self.create_by)
+        card_set.cards = {x.name: Card(x.name, x.weight) for x in self.cards.values()}
+        # 权重表只存成员名，已经建好且没过期时在副本间共享；否则留给副本抽卡时再建，
+        # 只读成员的调用（/ls、/del）不需要付出构建的开销
+        if self.sampler is not None and self.sampler[0] == self.version:
+            card_set.sampler = (card_set.version,) + self.sampler[1:]
+        return card_set
 
     def flush_cards(self):
-        self.cards = []
+        self.cards = {}
+        self.version += 1
 
     def set_wight(self, name: str, weight: int) -> bool:
-        card = self.get_card(name)
+        card = self.cards.get(name)
         if card:
             card.weight = max(weight, 0)
+            self.version += 1
             return True
         return False
 
     def change_wight(self, name: str, wight: int) -> bool:
-        card = self.get_card(name)
+        card = self.cards.get(name)
         if card:
             card.weight += wight
+            self.version += 1
             return True
         return False
 
+    def get_sampler(self) -> tuple:
+        """(version, 权重大于 0 的成员名, 累计权重)"""
+        if self.sampler is None or self.sampler[0] != self.version:
+            names, weights = [], []
+            for card in self.cards.values():
+                if card.weight > 0:
+                    names.append(card.name)
+                    weights.append(card.weight)
+            cum_weights = list(itertools.accumulate(weights))
+            self.sampler = (self.version, names, cum_weights)
+        return self.sampler
+
     def roll(self) -> Card:
-        weights = [card.weight for card in self.cards]
-        return random.choices(self.cards, weights=weights)[0]
+        """按权重抽一张，集合为空或权重都为 0 时返回 None"""
+        _, names, cum_weights = self.get_sampler()
+        if not names:
+            return None
+        index = bisect.bisect_right(cum_weights, random.randrange(cum_weights[-1]))
+        return self.cards[names[index]]
+
+    def roll_many(self, num: int) -> list[Card]:
+        """
+        按权重不放回地抽 num 张（Efraimidis-Spirakis：key = u^(1/w) 取最大的 num 个），
+        一次遍历完成，结果按抽中顺序排列。
+        """
+        cards = [x for x in self.cards.values() if x.weight > 0]
+        keys = ((random.random() ** (1 / x.weight), x) for x in cards)
+        return [x for _, x in heapq.nlargest(num, keys, key=lambda k: k[0])]
 
 
 @dataclass
@@ -0,0 +1,477 @@
+#!encoding:utf-8
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from metrics import Counter, Histogram
+from resilience import Deadline, DeadlineExceeded
+
+DEFAULT_BASE_URL = "https://open.feishu.cn/open-apis"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_logger = logging.getLogger(__name__)
+
+feishu_request_histogram = Histogram(
+    "feishu_request_seconds", "飞书接口调用耗时（含重试）", ("endpoint", "status")
+)
+feishu_retry_counter = Counter(
+    "feishu_retries_total", "飞书接口重试次数", ("endpoint",)
+)
+rate_limit_wait_histogram = Histogram(
+    "feishu_rate_limit_wait_seconds", "发送接口在本地限流器前排队的时间", ("endpoint",)
+)
+token_refresh_counter = Counter(
+    "feishu_token_refresh_total",
+    "tenant_access_token 刷新次数，fetched: 请求了鉴权接口, shared: 复用其他进程的 token",
+    ("result",),
+)
+
+
+class TokenManager:
+    """
+    tenant_access_token 管理。token 缓存在 store 里供多个进程共享，
+    后台线程在过期前 refresh_ahead 秒提前刷新，请求线程一般不会等待鉴权接口。
+    """
+
+    app_id: str = ""
+    app_secret: str = ""
+    feishu_cli = None
+    lock: threading.Lock = None
+    token: str = ""
+    expire_time: float = 0
+    store = None
+    refresh_ahead: float = 0
+    refresher_pid: int = 0
+
+    def __init__(
+        self, app_id: str, app_secret: str, store=None, refresh_ahead: float = 300
+    ):
+        self.lock = threading.Lock()
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.store = store
+        self.refresh_ahead = refresh_ahead
+
+    def start(self):
+        """启动后台刷新线程，fork 之后需要在子进程里重新调用"""
+        pid = os.getpid()
+        if self.refresher_pid == pid:
+            return
+        self.refresher_pid = pid
+        threading.Thread(
+            target=self._refresh_loop, name="token-refresher", daemon=True
+        ).start()
+
+    def get_token(self) -> str:
+        if self._valid(60):
+            return self.token
+        with self.lock:
+            if not self._valid(60):
+                self._refresh(60)
+            return self.token
+
+    def get_header(self) -> dict:
+        token = self.get_token()
+        return {"Authorization": "Bearer " + token}
+
+    def has_token(self) -> bool:
+        """缓存的 token 是否可以直接使用，不需要等待鉴权接口"""
+        return self._valid(60)
+
+    def _valid(self, ahead: float) -> bool:
+        return bool(self.token) and (time.time() + ahead) < self.expire_time
+
+    def get_feishu_cli(self):
+        if self.feishu_cli is None:
+            # pylark 导入要 1 秒以上，只在真正需要请求鉴权接口时加载
+            import pylark
+
+            self.feishu_cli = pylark.Lark(
+                app_id=self.app_id, app_secret=self.app_secret
+            )
+        return self.feishu_cli
+
+    def _fetch(self):
+        try:
+            expire, _ = self.get_feishu_cli().auth.get_tenant_access_token()
+        except Exception:
+            token_refresh_counter.inc(result="error")
+            raise
+        token_refresh_counter.inc(result="fetched")
+        self.token = expire.token
+        self.expire_time = time.time() + expire.expire
+
+    def _refresh(self, min_ttl: float):
+        if self.store is None:
+            self._fetch()
+            return
+        with self.store.locked():
+            # 其他进程可能已经刷新过了
+            token, expire_time = self.store.load()
+            if token and (time.time() + min_ttl) < expire_time:
+                self.token, self.expire_time = token, expire_time
+                token_refresh_counter.inc(result="shared")
+                return
+            self._fetch()
+            self.store.save(self.token, self.expire_time)
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                with self.lock:
+                    if not self._valid(self.refresh_ahead):
+                        self._refresh(self.refresh_ahead)
+                wait = self.expire_time - self.refresh_ahead - time.time()
+                # 加一点抖动，避免多个进程同时醒来抢锁
+                time.sleep(min(max(wait, 1), 60) + random.random())
+            except Exception as e:
+                _logger.exception(e)
+                time.sleep(5)
+
+
+class DeadlineRetry(Retry):
+    """
+    urllib3 在调用线程里重试，每次重试用的还是最初的超时。
+    当前线程正在处理的事件剩余时间不够退避等待时，不再重试，返回最后一次的结果。
+    """
+
+    local = threading.local()
+
+    def increment(
+        self,
+        method=None,
+        url=None,
+        response=None,
+        error=None,
+        _pool=None,
+        _stacktrace=None,
+    ):
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        deadline = getattr(self.local, "deadline", None)
+        if (
+            deadline is not None
+            and deadline.remaining() <= new_retry.get_backoff_time()
+        ):
+            reason = error or ResponseError("event deadline exceeded")
+            raise MaxRetryError(_pool, url, reason) from reason
+        return new_retry
+
+
+class FeishuClient:
+    """
+    飞书开放接口客户端：每个进程一个连接池（keep-alive），显式连接/读取超时，
+    429/5xx 和连接失败指数退避重试，自动注入 tenant_access_token。
+    rate_limits 按 endpoint 给发送接口配令牌桶，超过频率的调用排队等待而不是被飞书 429。
+    传入 deadline 时连接/读取超时不超过事件剩余的处理时间。
+    """
+
+    base_url: str = ""
+    token_manager = None
+    timeout: tuple = None
+    pool_size: int = 0
+    retry: Retry = None
+    session: requests.Session = None
+    session_pid: int = 0
+    lock: threading.Lock = None
+    rate_limits: dict = None
+
+    def __init__(
+        self,
+        token_manager,
+        base_url: str = DEFAULT_BASE_URL,
+        pool_size: int = 16,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        rate_limits: dict = None,
+    ):
+        self.token_manager = token_manager
+        self.rate_limits = rate_limits or {}
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.retry = DeadlineRetry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS,
+            # 429/5xx 时 POST 也重试（回复消息带 uuid 去重）；
+            # 请求发出后读超时或连接断开不重试，飞书可能已经处理过了
+            allowed_methods=None,
+            read=0,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.lock = threading.Lock()
+
+    def get_session(self) -> requests.Session:
+        # fork 出来的子进程不能复用父进程的连接，按 pid 重建
+        pid = os.getpid()
+        if self.session is not None and self.session_pid == pid:
+            return self.session
+        with self.lock:
+            if self.session is None or self.session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=self.retry,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.session = session
+                self.session_pid = pid
+        return self.session
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: str = "other",
+        deadline: Deadline = None,
+        **kwargs
+    ) -> requests.Response:
+        headers = kwargs.pop("headers", {})
+        headers.update(self.token_manager.get_header())
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.base_url + path
+        bucket = self.rate_limits.get(endpoint)
+        if bucket is not None:
+            waited = bucket.acquire(max_wait(deadline))
+            if waited is None:
+                raise DeadlineExceeded("rate limit wait exceeds event deadline")
+            rate_limit_wait_histogram.observe(waited, endpoint=endpoint)
+        if deadline is not None:
+            kwargs["timeout"] = tuple(deadline.timeout(x) for x in kwargs["timeout"])
+        start, status = time.perf_counter(), "error"
+        DeadlineRetry.local.deadline = deadline
+        try:
+            resp = self.get_session().request(method, url, headers=headers, **kwargs)
+            status = str(resp.status_code)
+            retries = getattr(resp.raw, "retries", None)
+            history = retries.history if retries is not None else ()
+            if history:
+                feishu_retry_counter.inc(len(history), endpoint=endpoint)
+            limited = sum(1 for x in history if x.status == 429)
+            if resp.status_code == 429:
+                limited += 1
+            if limited:
+                _logger.warning(
+                    "feishu rate limited: %s got 429 %d times, final status %d",
+                    endpoint,
+                    limited,
+                    resp.status_code,
+                )
+            return resp
+        finally:
+            DeadlineRetry.local.deadline = None
+            feishu_request_histogram.observe(
+                time.perf_counter() - start, endpoint=endpoint, status=status
+            )
+
+    def post(
+        self, path: str, data: dict, endpoint: str = "other", deadline: Deadline = None
+    ) -> requests.Response:
+        return self.request("POST", path, endpoint, deadline, json=data)
+
+    def create_reaction(
+        self, msg_id: str, emoji_type: str, deadline: Deadline = None
+    ) -> requests.Response:
+        path = "/im/v1/messages/{}/reactions".format(msg_id)
+        data = {"reaction_type": {"emoji_type": emoji_type}}
+        return self.post(path, data, "create_reaction", deadline)
+
+    def reply_message(
+        self, msg_id: str, msg_type: str, content, deadline: Deadline = None
+    ) -> requests.Response:
+        path = "/im/v1/messages/{}/reply".format(msg_id)
+        return self.post(path, reply_data(msg_type, content), "reply_message", deadline)
+
+
+def max_wait(deadline: Deadline) -> float:
+    """限流排队最多等多久：等到事件时限之后再发已经没有意义，也不占用令牌"""
+    return deadline.remaining() if deadline is not None else None
+
+
+def reply_data(msg_type: str, content) -> dict:
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    return {
+        "content": content,
+        "msg_type": msg_type,
+        # 飞书按 uuid 对回复去重，重试不会产生重复消息
+        "uuid": str(uuid.uuid4()),
+    }
+
+
+class AsyncFeishuClient:
+    """
+    FeishuClient 的 asyncio 版本：一个事件循环共用一个 httpx 连接池，
+    等待飞书响应时不占线程。重试策略和同步版本一致，
+    传入 deadline 时剩余时间不够下一次重试就直接返回最后一次的结果。
+    token 通常已经由后台线程刷新好，只有需要现取时才放到线程池里等待。
+    """
+
+    base_url: str = ""
+    token_manager = None
+    timeout: httpx.Timeout = None
+    limits: httpx.Limits = None
+    retries: int = 0
+    backoff_factor: float = 0
+    client: httpx.AsyncClient = None
+    rate_limits: dict = None
+
+    def __init__(
+        self,
+        token_manager,
+        base_url: str = DEFAULT_BASE_URL,
+        max_connections: int = 100,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10,
+        retries: int = 3,
+        backoff_factor: float = 0.3,
+        rate_limits: dict = None,
+    ):
+        self.token_manager = token_manager
+        self.rate_limits = rate_limits or {}
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    def get_client(self) -> httpx.AsyncClient:
+        # 连接池绑定事件循环，在第一次请求时（循环内）创建
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get_header(self) -> dict:
+        if self.token_manager.has_token():
+            return self.token_manager.get_header()
+        return await asyncio.to_thread(self.token_manager.get_header)
+
+    def retry_delay(self, resp: httpx.Response, attempt: int) -> float:
+        retry_after = resp.headers.get("Retry-After", "") if resp else ""
+        if retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff_factor * (2**attempt)
+
+    def request_timeout(self, deadline: Deadline) -> httpx.Timeout:
+        if deadline is None:
+            return self.timeout
+        return httpx.Timeout(
+            deadline.timeout(self.timeout.read),
+            connect=deadline.timeout(self.timeout.connect),
+        )
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        endpoint: str = "other",
+        deadline: Deadline = None,
+        **kwargs
+    ) -> httpx.Response:
+        url = self.base_url + path
+        extra_headers = kwargs.pop("headers", {})
+        bucket = self.rate_limits.get(endpoint)
+        if bucket is not None:
+            waited = await bucket.acquire_async(max_wait(deadline))
+            if waited is None:
+                raise DeadlineExceeded("rate limit wait exceeds event deadline")
+            rate_limit_wait_histogram.observe(waited, endpoint=endpoint)
+        start, status = time.perf_counter(), "error"
+        try:
+            resp = await self._request(
+                method, url, endpoint, deadline, extra_headers, kwargs
+            )
+            status = str(resp.status_code)
+            return resp
+        finally:
+            feishu_request_histogram.observe(
+                time.perf_counter() - start, endpoint=endpoint, status=status
+            )
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        endpoint: str,
+        deadline: Deadline,
+        extra_headers: dict,
+        kwargs: dict,
+    ) -> httpx.Response:
+        attempt = 0
+        while True:
+            headers = dict(extra_headers)
+            headers.update(await self.get_header())
+            resp, error = None, None
+            try:
+                resp = await self.get_client().request(
+                    method,
+                    url,
+                    headers=headers,
+                    timeout=self.request_timeout(deadline),
+                    **kwargs
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # 只重试没连上的请求，和同步版本的 read=0 一致
+                if attempt >= self.retries:
+                    raise
+                error = e
+            if resp is not None:
+                if resp.status_code == 429:
+                    _logger.warning(
+                        "feishu rate limited: %s got 429, attempt %d", endpoint, attempt
+                    )
+                if resp.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return resp
+            delay = self.retry_delay(resp, attempt)
+            if deadline is not None and deadline.remaining() <= delay:
+                # 等不到下一次重试了
+                if error is not None:
+                    raise error
+                return resp
+            await asyncio.sleep(delay)
+            feishu_retry_counter.inc(endpoint=endpoint)
+            attempt += 1
+
+    async def post(
+        self, path: str, data: dict, endpoint: str = "other", deadline: Deadline = None
+    ) -> httpx.Response:
+        return await self.request("POST", path, endpoint, deadline, json=data)
+
+    async def create_reaction(
+        self, msg_id: str, emoji_type: str, deadline: Deadline = None
+    ) -> httpx.Response:
+        path = "/im/v1/messages/{}/reactions".format(msg_id)
+        data = {"reaction_type": {"emoji_type": emoji_type}}
+        return await self.post(path, data, "create_reaction", deadline)
+
+    async def reply_message(
+        self, msg_id: str, msg_type: str, content, deadline: Deadline = None
+    ) -> httpx.Response:
+        path = "/im/v1/messages/{}/reply".format(msg_id)
+        return await self.post(
+            path, reply_data(msg_type, content), "reply_message", deadline
+        )
@@ -0,0 +1,37 @@
+# gunicorn 会自动加载工作目录下的 gunicorn.conf.py
+import os
+
+# sync: Flask + 线程（默认）; async: ASGI + asyncio 出站请求
+SERVER_MODE = os.environ.get("SERVER_MODE", "sync")
+
+if SERVER_MODE == "async":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn_worker.UvicornWorker"
+else:
+    wsgi_app = "app:app"
+
+# 留出时间让事件队列处理完（需大于 EVENT_DRAIN_TIMEOUT）
+graceful_timeout = 30
+
+# master 里导入应用并完成迁移，worker fork 后直接可用；各 worker 的线程和连接
+# 在 post_worker_init 里创建
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def post_worker_init(worker):
+    import app
+
+    app.init_worker()
+
+
+def worker_exit(server, worker):
+    import app
+
+    app.drain_pipeline()
+
+
+def on_starting(server):
+    # 清掉上次运行留下的各 worker 指标文件，计数从 0 开始
+    import shutil
+
+    shutil.rmtree(os.environ.get("METRICS_DIR", "data/metrics"), ignore_errors=True)
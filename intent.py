@@ -0,0 +1,137 @@
+#!encoding:utf-8
+import json
+import re
+
+from translation import normalize_text
+
+# 集合名后面可以跟的修饰，如 "吃饭集合里面"
+_SET = r"(?P<set>[^\s、,，]+?)(?:集合)?"
+_IN = r"(?:里面|里头|当中|里|中)?"
+
+_HELP = re.compile(r"^(?:怎么使用|怎么用|如何使用|使用说明|帮助|help)$", re.I)
+_LS_ALL = re.compile(
+    r"^(?:查看|列出|看看)?(?:所有|全部)?(?:的)?集合(?:列表)?$|^查看$|^有哪些集合$"
+)
+_LS_SET = re.compile(
+    r"^(?:查看|列出|看看|看下|看一下)" + _SET + r"(?:里的|的)?(?:所有)?(?:成员)?$"
+)
+_ADD = re.compile(
+    r"^(?:向|往|给|在)"
+    + _SET
+    + _IN
+    + r"(?P<verb>添加|增加|加入|加上|加)(?:成员)?[:：]?\s*(?P<items>.+)$"
+)
+_DEL = re.compile(
+    r"^(?:从|在|把)" + _SET + _IN + r"(?:删掉|删除|去掉|移除)(?:成员)?\s*(?P<item>.+)$"
+)
+_ROLL = re.compile(
+    r"^(?:从|在)?"
+    + _SET
+    + _IN
+    + r"(?:随机)?抽(?:一张|一个|一下|一次|(?P<num>\d+)?张|(?P<num2>\d+)?个|卡)?(?:卡)?$"
+)
+_ROLL_ANY = re.compile(r"^(?:随机)?抽(?:一张|一个|一下|一次|张|个)?(?:卡)?$")
+_WEIGHT = re.compile(r"^(?:调整|修改|设置)(?P<rest>.+?)的?权重$")
+_WEIGHT_ITEM = re.compile(r"^(?:集合)?" + _IN + r"(?:的)?(?P<item>[^\s、,，]+)$")
+_ITEM_SEP = re.compile(r"[、,，\s]+")
+
+
+def _is_name(name: str) -> bool:
+    return bool(name) and not _ITEM_SEP.search(name)
+
+
+def parse_intent(text: str, set_names: list[str]) -> str:
+    """
+    把常见说法直接翻译成指令，拿不准时返回 None 交给大模型。
+    集合名必须是当前会话里已有的集合；/add 可以创建新集合，但要明确说了“集合”或“添加”，
+    否则“在家加班”“给我加个鸡腿”这类闲聊也会被当成添加。
+    """
+    text = normalize_text(text)
+    if not text or text.startswith("/"):
+        return None
+    names = set(set_names)
+
+    if _HELP.match(text):
+        return "/help"
+    if _LS_ALL.match(text):
+        return "/ls"
+    if _ROLL_ANY.match(text):
+        return "/roll"
+
+    m = _ADD.match(text)
+    if m:
+        items = [x for x in _ITEM_SEP.split(m.group("items")) if x]
+        explicit = (
+            m.group("set") in names
+            or m.group("verb") == "添加"
+            or text[m.end("set") :].startswith("集合")
+        )
+        if items and explicit and _is_name(m.group("set")):
+            return "/add {} {}".format(m.group("set"), " ".join(items))
+        return None
+
+    m = _DEL.match(text)
+    if m:
+        if m.group("set") in names and _is_name(m.group("item")):
+            return "/del {} {}".format(m.group("set"), m.group("item"))
+        return None
+
+    m = _WEIGHT.match(text)
+    if m:
+        # 集合名和成员名之间可能没有分隔，用已有集合名（长的优先）去切分
+        rest = m.group("rest")
+        for name in sorted(names, key=len, reverse=True):
+            if not rest.startswith(name):
+                continue
+            item = _WEIGHT_ITEM.match(rest[len(name) :])
+            if item:
+                return "/weight {} {}".format(name, item.group("item"))
+        return None
+
+    m = _ROLL.match(text)
+    if m and m.group("set") in names:
+        num = m.group("num") or m.group("num2")
+        if num:
+            return "/roll {} {}".format(m.group("set"), num)
+        return "/roll {}".format(m.group("set"))
+
+    m = _LS_SET.match(text)
+    if m and m.group("set") in names:
+        return "/ls {}".format(m.group("set"))
+    return None
+
+
+class CommandReader:
+    """
+    从回答里取出指令：只看第一行。流式回答逐行喂入 SSE 数据，
+    第一行已经完整，或者开头已经能看出不是指令（不以 / 开头）时 feed 返回 True，不用再读。
+    回答被 max_tokens 截断、第一行没有结束时不能当作指令执行，结果为空。
+    """
+
+    text: str = ""
+    truncated: bool = False
+
+    def add(self, content: str, finish_reason: str = None):
+        self.text += content or ""
+        if finish_reason == "length":
+            self.truncated = True
+
+    def feed(self, line: str) -> bool:
+        if not line.startswith("data:"):
+            return False
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return True
+        choice = (json.loads(data).get("choices") or [{}])[0]
+        delta = choice.get("delta") or {}
+        self.add(delta.get("content"), choice.get("finish_reason"))
+        head = self.text.lstrip()
+        return bool(head) and (not head.startswith("/") or "\n" in head)
+
+    def result(self) -> str:
+        head = self.text.lstrip()
+        if "\n" in head:
+            return head.split("\n", 1)[0].rstrip()
+        if self.truncated:
+            return ""
+        return head.rstrip()
@@ -0,0 +1,122 @@
+#!encoding:utf-8
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import Counter
+
+TEXT_FORMAT = (
+    "%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] "
+    "[%(req_id)s] %(message)s"
+)
+DATE_FORMAT = "%Y-%m-%d:%H:%M:%S"
+
+log_dropped_counter = Counter("log_dropped_total", "日志队列满时丢弃的日志条数")
+
+
+class LazyPayload:
+    """
+    日志里的大块数据（事件、回复内容、接口响应）。只有真正输出时才序列化，
+    超过 max_len 个字符截断；max_len 为 0 时不截断。
+    有 .text 属性的对象（requests/httpx 的响应）输出响应体。
+    """
+
+    __slots__ = ("value", "max_len")
+
+    def __init__(self, value, max_len: int = 0):
+        self.value = value
+        self.max_len = max_len
+
+    def __str__(self) -> str:
+        value = self.value
+        if not isinstance(value, (str, dict, list)) and hasattr(value, "text"):
+            value = value.text
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        if self.max_len and len(value) > self.max_len:
+            return "{}...({} chars)".format(value[: self.max_len], len(value))
+        return value
+
+
+class ReqIdFilter(logging.Filter):
+    """没有经过 CustomAdapter 的日志（第三方库等）补一个空的 req_id"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "req_id"):
+            record.req_id = "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON，req_id 是单独的字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, DATE_FORMAT)
+            + ",{:03d}".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": "{}:{}".format(record.filename, record.lineno),
+            "req_id": getattr(record, "req_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    把日志放进有界队列，由后台线程格式化并写出，请求线程不做 IO 也不做序列化。
+    标准库的 QueueHandler 会在调用线程里先格式化消息（为了能跨进程传递），
+    这里是线程间队列，直接把 record 交给后台线程。队列满时丢弃并计数，不阻塞请求。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped_counter.inc()
+
+
+class BackgroundListener(QueueListener):
+    """退出时即使队列是满的也要等到能放进结束标记，保证剩下的日志都写出去"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(
+    level: int = logging.INFO,
+    mode: str = "sync",
+    fmt: str = "text",
+    queue_size: int = 10000,
+) -> QueueListener:
+    """
+    配置根 logger。mode=queue 时返回后台写日志的 QueueListener，退出前需要 stop()
+    把队列里剩下的日志写完；mode=sync 时在调用线程里直接写，返回 None。
+    """
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    handler.addFilter(ReqIdFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    if mode != "queue":
+        root.addHandler(handler)
+        return None
+    listener = BackgroundListener(
+        queue.Queue(queue_size), handler, respect_handler_level=True
+    )
+    root.addHandler(BackgroundQueueHandler(listener.queue))
+    listener.start()
+    return listener
@@ -0,0 +1,296 @@
+#!encoding:utf-8
+import bisect
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+# 覆盖数据库查询（亚毫秒）到外部接口（秒级）的耗时
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Counter:
+    """按标签累加的计数器"""
+
+    type: str = "counter"
+    name: str = ""
+    doc: str = ""
+    labelnames: tuple = ()
+    values: dict = None
+    lock: threading.Lock = None
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, num: float = 1, **labels):
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + num
+
+    def get(self, **labels) -> float:
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        return self.values.get(key, 0)
+
+    def reset(self):
+        # fork 之后调用，锁也重新创建
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> list:
+        with self.lock:
+            return [[list(k), v] for k, v in self.values.items()]
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, key: tuple, value) -> list:
+        return [(self.name, key, value)]
+
+
+class Gauge(Counter):
+    """
+    当前值（如熔断器状态）。多进程汇总时只看还活着的进程，取最大值：
+    任何一个 worker 处于异常状态都会体现出来，已退出进程的旧值不会残留。
+    """
+
+    type: str = "gauge"
+    live_only: bool = True
+
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    @staticmethod
+    def merge(a, b):
+        return max(a, b)
+
+    def reset(self):
+        # 当前值不是累计值，fork 之后继续沿用
+        self.lock = threading.Lock()
+
+
+class Histogram:
+    """按标签统计的直方图，每个桶只存落在本桶的次数，输出时再累加"""
+
+    type: str = "histogram"
+    name: str = ""
+    doc: str = ""
+    labelnames: tuple = ()
+    buckets: tuple = ()
+    values: dict = None
+    lock: threading.Lock = None
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                # [各桶次数(最后一个是 +Inf), 总和, 次数]
+                item = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def get(self, **labels) -> tuple[int, float]:
+        """返回 (次数, 总和)"""
+        key = tuple(labels.get(x, "") for x in self.labelnames)
+        item = self.values.get(key)
+        return (item[2], item[1]) if item else (0, 0.0)
+
+    def reset(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> list:
+        with self.lock:
+            return [[list(k), [list(v[0]), v[1], v[2]]] for k, v in self.values.items()]
+
+    @staticmethod
+    def merge(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def samples(self, key: tuple, value) -> list:
+        res, total = [], 0
+        bounds = [_format_value(x) for x in self.buckets] + ["+Inf"]
+        for bound, num in zip(bounds, value[0]):
+            total += num
+            res.append((self.name + "_bucket", key + (("le", bound),), total))
+        res.append((self.name + "_sum", key, value[1]))
+        res.append((self.name + "_count", key, value[2]))
+        return res
+
+
+REGISTRY: list = []
+
+
+def reset_registry():
+    """
+    gunicorn --preload 时 worker 会继承 master 里记下的值（迁移、启动时的查询），
+    fork 之后清零，否则每个 worker 都会把这些值当成自己的再导出一次
+    """
+    for metric in REGISTRY:
+        metric.reset()
+
+
+class MultiProcessCollector:
+    """
+    gunicorn 多 worker 下的指标汇总。每个进程定期把自己的指标写到 directory 下
+    以 pid 命名的文件里，/metrics 读取所有文件相加。已退出的 worker 的文件保留，
+    计数器不会因为 worker 重启而回退；目录在 master 启动时清空（见 gunicorn.conf.py）。
+    directory 为空时只输出本进程的指标。
+    """
+
+    directory: str = ""
+    interval: float = 0
+    flusher_pid: int = 0
+
+    def __init__(self, directory: str, interval: float = 5):
+        self.directory = directory
+        self.interval = interval
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, "metrics_{}.json".format(os.getpid()))
+
+    def start(self):
+        """启动后台写文件的线程，fork 之后需要在子进程里重新调用"""
+        pid = os.getpid()
+        if not self.directory or self.flusher_pid == pid:
+            return
+        self.flusher_pid = pid
+        threading.Thread(
+            target=self._flush_loop, name="metrics-flusher", daemon=True
+        ).start()
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        data = {x.name: x.snapshot() for x in REGISTRY}
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _flush_loop(self):
+        while True:
+            # 加一点抖动，避免所有 worker 同时写
+            time.sleep(self.interval + random.random())
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self) -> dict:
+        """{指标名: {标签: 值}}，所有进程合并（计数器相加，Gauge 取存活进程的最大值）"""
+        if not self.directory:
+            snapshots = [(True, {x.name: x.snapshot() for x in REGISTRY})]
+        else:
+            self.flush()
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                try:
+                    with open(path) as f:
+                        snapshots.append((_is_alive(path), json.load(f)))
+                except (OSError, ValueError):
+                    continue
+        res = {x.name: {} for x in REGISTRY}
+        for metric in REGISTRY:
+            values = res[metric.name]
+            for alive, snapshot in snapshots:
+                if not alive and getattr(metric, "live_only", False):
+                    continue
+                for key, value in snapshot.get(metric.name, []):
+                    key = tuple(key)
+                    if key in values:
+                        values[key] = metric.merge(values[key], value)
+                    else:
+                        values[key] = value
+        return res
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        collected = self.collect()
+        for metric in REGISTRY:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for key, value in sorted(collected[metric.name].items()):
+                labels = tuple(zip(metric.labelnames, key))
+                for name, sample_labels, sample in metric.samples(labels, value):
+                    lines.append(
+                        "{}{} {}".format(
+                            name, _format_labels(sample_labels), _format_value(sample)
+                        )
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def _is_alive(path: str) -> bool:
+    """指标文件对应的进程是否还在"""
+    try:
+        pid = int(os.path.basename(path)[len("metrics_") : -len(".json")])
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    items = []
+    for name, value in labels:
+        value = (
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        items.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return repr(value) if abs(value) >= 1e15 else str(int(value))
+    return repr(value)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# 数据库迁移，可重复执行：python migrate.py [--vacuum] [数据库 URL]
+import argparse
+import json
+import logging
+import time
+
+from sqlalchemy import delete, func, inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+from repo import CardORM, CardSetORM, RollRecordORM, create_db_engine, insert_ignore
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate_card_items(engine: Engine) -> int:
+    """把 card_set.items 里的 JSON 成员搬到 card 表"""
+    with Session(engine) as session:
+        stmt = select(CardSetORM).where(CardSetORM.items != "[]")
+        rows = session.scalars(stmt).all()
+        for row in rows:
+            items = json.loads(row.items or "[]")
+            cards = [
+                {"card_set_id": row.id, "name": x["name"], "weight": x["weight"]}
+                for x in items
+            ]
+            insert_ignore(session, CardORM, cards)
+            row.items = "[]"
+        session.commit()
+        return len(rows)
+
+
+def dedupe_roll_records(engine: Engine) -> int:
+    """建唯一索引前删除 msg_id 重复的记录，保留最早的一条"""
+    with Session(engine) as session:
+        keep = (
+            select(func.min(RollRecordORM.id))
+            .group_by(RollRecordORM.msg_id)
+            .scalar_subquery()
+        )
+        res = session.execute(
+            delete(RollRecordORM).where(RollRecordORM.id.not_in(keep))
+        )
+        session.commit()
+        return res.rowcount
+
+
+def migrate_indexes(engine: Engine) -> list[str]:
+    """create_all 不会给已存在的表补索引，这里逐个检查创建"""
+    created = []
+    for table in CardSetORM.metadata.sorted_tables:
+        existing = {x["name"] for x in inspect(engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.name == "ux_roll_record_msg_id":
+                dedupe_roll_records(engine)
+            index.create(engine)
+            created.append(index.name)
+    return created
+
+
+def migrate_columns(engine: Engine) -> list[str]:
+    """create_all 不会给已存在的表加列，这里补上新增的可空列或带 server_default 的列"""
+    added = []
+    for table in CardSetORM.metadata.sorted_tables:
+        existing = {x["name"] for x in inspect(engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                continue
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(
+                    text("ALTER TABLE {} ADD COLUMN {}".format(table.name, ddl))
+                )
+            added.append("{}.{}".format(table.name, column.name))
+    if "card_set.deleted_at" in added:
+        # 旧库里已软删除的集合从现在开始计算保留期
+        with engine.begin() as conn:
+            conn.execute(
+                update(CardSetORM)
+                .where(CardSetORM.deleted == True)
+                .values(deleted_at=time.time())
+            )
+    return added
+
+
+def is_file_sqlite(engine: Engine) -> bool:
+    """内存库和其他数据库不需要回收空间"""
+    if engine.dialect.name != "sqlite":
+        return False
+    return engine.url.database not in (None, "", ":memory:")
+
+
+def incremental_vacuum_enabled(engine: Engine) -> bool:
+    """
+    连接时设置的 auto_vacuum=INCREMENTAL 对新库直接生效；已有表的旧库要整库 VACUUM
+    一次才会转换，启动时不做（会锁库很久），需要手动执行 python migrate.py --vacuum
+    """
+    if not is_file_sqlite(engine):
+        return True
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+
+
+def vacuum(engine: Engine):
+    """整库 VACUUM 一次，把旧库转换成 auto_vacuum=INCREMENTAL，期间其他进程无法写入"""
+    if not is_file_sqlite(engine):
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL"))
+        conn.execute(text("VACUUM"))
+
+
+def migrate(engine: Engine):
+    if not incremental_vacuum_enabled(engine):
+        _logger.warning(
+            "incremental vacuum is not enabled, run python migrate.py --vacuum "
+            "during a quiet period"
+        )
+    CardSetORM.metadata.create_all(engine)
+    for name in migrate_columns(engine):
+        _logger.info("added column %s", name)
+    for name in migrate_indexes(engine):
+        _logger.info("created index %s", name)
+    num = migrate_card_items(engine)
+    if num:
+        _logger.info("migrated %d card sets to card table", num)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="数据库迁移")
+    parser.add_argument("db_url", nargs="?", help="数据库 URL，默认读 DATABASE_URL")
+    parser.add_argument(
+        "--vacuum", action="store_true", help="整库 VACUUM，开启旧库的增量回收"
+    )
+    args = parser.parse_args()
+    db_engine = create_db_engine(args.db_url)
+    if args.vacuum:
+        vacuum(db_engine)
+        _logger.info("vacuumed database")
+    migrate(db_engine)
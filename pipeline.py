@@ -0,0 +1,187 @@
+#!encoding:utf-8
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from typing import Callable
+
+from metrics import Histogram
+
+_logger = logging.getLogger(__name__)
+_STOP = object()
+
+queue_wait_histogram = Histogram(
+    "event_queue_wait_seconds", "事件从入队（或等待同一会话的锁）到开始处理的时间"
+)
+
+
+class EventPipeline:
+    """
+    有界事件队列 + 工作线程池：webhook 校验后入队并立即返回，由后台线程处理。
+    队列满时先阻塞 put_timeout 秒（背压），仍然满则拒绝（由调用方返回 503 让飞书重推）。
+    给了 key_func 时，同一个 key（如 chat_id）的事件按入队顺序逐个处理，不同 key 并行：
+    每个 key 同一时刻只在 ready 里出现一次，处理完一个事件后如果还有排队的，重新排到 ready 末尾。
+    """
+
+    handle_func: Callable = None
+    key_func: Callable = None
+    ready: queue.Queue = None
+    pending: dict = None
+    size: int = 0
+    max_size: int = 0
+    workers: int = 0
+    put_timeout: float = 0
+    threads: list[threading.Thread] = None
+    accepting: bool = False
+    lock: threading.Lock = None
+    cond: threading.Condition = None
+
+    def __init__(
+        self,
+        handle_func: Callable,
+        workers: int = 4,
+        max_size: int = 256,
+        put_timeout: float = 0.0,
+        key_func: Callable = None,
+    ):
+        self.handle_func = handle_func
+        self.key_func = key_func
+        self.ready = queue.Queue()
+        self.pending = {}
+        self.max_size = max_size
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.threads = []
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+
+    def start(self):
+        with self.lock:
+            if self.accepting:
+                return
+            self.accepting = True
+            for i in range(self.workers):
+                t = threading.Thread(
+                    target=self._run, name="event-worker-{}".format(i), daemon=True
+                )
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, item) -> bool:
+        if not self.accepting:
+            return False
+        # 没有 key_func 时每个事件一个独立的 key，退化成普通的 FIFO 队列
+        key = self.key_func(item) if self.key_func else object()
+        deadline = time.monotonic() + self.put_timeout
+        with self.cond:
+            while self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    _logger.warning("event queue full (%d), shed event", self.max_size)
+                    return False
+                self.cond.wait(remaining)
+            if not self.accepting:
+                return False
+            self.size += 1
+            entry = (item, time.perf_counter())
+            if key in self.pending:
+                # 同一个 key 有事件正在处理或排队，排在它后面
+                self.pending[key].append(entry)
+                return True
+            self.pending[key] = deque([entry])
+        self.ready.put(key)
+        return True
+
+    def drain(self, timeout: float = 30.0) -> bool:
+        """停止接收新事件，等待队列内事件处理完；超时返回 False"""
+        with self.lock:
+            if not self.accepting:
+                return True
+            self.accepting = False
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.size > 0 and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            left = self.size
+        for _ in self.threads:
+            self.ready.put(_STOP)
+        for t in self.threads:
+            t.join(max(deadline - time.monotonic(), 0))
+        self.threads = []
+        if left:
+            _logger.warning("event pipeline drain timeout, %d events left", left)
+            return False
+        _logger.info("event pipeline drained")
+        return True
+
+    def _run(self):
+        while True:
+            key = self.ready.get()
+            if key is _STOP:
+                return
+            with self.cond:
+                item, enqueued_at = self.pending[key][0]
+            queue_wait_histogram.observe(time.perf_counter() - enqueued_at)
+            try:
+                self.handle_func(item)
+            except Exception as e:
+                _logger.exception(e)
+            finally:
+                with self.cond:
+                    events = self.pending[key]
+                    events.popleft()
+                    self.size -= 1
+                    self.cond.notify_all()
+                    more = bool(events)
+                    if not more:
+                        del self.pending[key]
+                if more:
+                    self.ready.put(key)
+
+
+class KeyedLock:
+    """按 key 加锁：同一个 key 互斥，不同 key 并行。没人持有的锁随即删除，不随 key 数量增长"""
+
+    lock: threading.Lock = None
+    locks: dict = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            item = self.locks.get(key)
+            if item is None:
+                # [锁, 持有或等待的线程数]
+                item = self.locks[key] = [threading.Lock(), 0]
+            item[1] += 1
+        start = time.perf_counter()
+        try:
+            with item[0]:
+                queue_wait_histogram.observe(time.perf_counter() - start)
+                yield
+        finally:
+            with self.lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self.locks[key]
+
+
+def fan_out(executor: Executor, calls) -> list[tuple[Callable, Exception]]:
+    """
+    在 executor 里并发执行互不依赖的调用（每项为 (func, *args)），等待全部完成。
+    一个调用失败不影响其他调用，返回失败的 (func, 异常)
+    """
+    futures = [(func, executor.submit(func, *args)) for func, *args in calls]
+    errors = []
+    for func, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            errors.append((func, e))
+    return errors
@@ -0,0 +1,54 @@
+#!encoding:utf-8
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限流：每秒补充 rate 个令牌，最多攒 burst 个。
+    令牌不够时不失败，而是预约未来的令牌并返回需要等待的时间，调用方按预约顺序排队。
+    线程和 asyncio 协程可以共用同一个桶。
+    """
+
+    rate: float = 0
+    burst: float = 0
+    tokens: float = 0
+    updated_at: float = 0
+    lock: threading.Lock = None
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait: float = None) -> float:
+        """
+        取一个令牌，返回需要等待的秒数（0 表示立即可用）。
+        需要等待的时间超过 max_wait 时不取令牌，返回 None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, max_wait: float = None) -> float:
+        wait = self.reserve(max_wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, max_wait: float = None) -> float:
+        wait = self.reserve(max_wait)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
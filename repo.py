@@ -1,11 +1,129 @@
 #!encoding:utf-8
-import json
+import functools
+import logging
+import os
+import re
 import time
-from sqlalchemy import String, select
+from typing import Iterator, Optional
+from sqlalchemy import (
+    ForeignKey,
+    Index,
+    String,
+    UniqueConstraint,
+    case,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
 from sqlalchemy.engine import Engine
 
-from domain import CardSet, RollRecord
+from cache import TTLCache
+from metrics import Counter, Histogram
+from domain import DEFAULT_CARD_WIGHT, Card, CardSet, RollRecord
+
+DEFAULT_DB_URL = "sqlite:///data/sqlite3.db"
+# 旧版 SQLite（< 3.32，如 buster 镜像里的 3.27）一条语句最多 999 个参数，IN 列表分批查询
+MAX_IN_PARAMS = 900
+
+db_query_histogram = Histogram(
+    "db_query_seconds", "数据库语句耗时", ("operation", "table")
+)
+db_error_counter = Counter(
+    "db_query_errors_total", "数据库语句出错次数", ("operation", "table")
+)
+_STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+\"?(\w+)", re.I)
+
+
+def create_db_engine(url: str = None, echo: bool = None) -> Engine:
+    """
+    根据 DATABASE_URL 创建引擎（默认本地 SQLite，也可以是 postgresql://...）。
+    SQLite 使用 WAL 模式和 busy_timeout，多个 gunicorn worker 并发读写时不再报 database is locked。
+    """
+    url = url or os.environ.get("DATABASE_URL", DEFAULT_DB_URL)
+    if echo is None:
+        echo = os.environ.get("SQL_ECHO", "") in ("1", "true")
+    if echo:
+        # 不用 create_engine(echo=True)：它会给 sqlalchemy 单独挂一个同步写 stdout 的 handler，
+        # 这里只打开日志级别，交给根 logger 的 handler（可能是后台队列）输出
+        logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+    kwargs = {"future": True}
+    memory = url in ("sqlite://", "sqlite:///:memory:")
+    if not url.startswith("sqlite"):
+        kwargs["pool_size"] = int(os.environ.get("DB_POOL_SIZE", "5"))
+        kwargs["max_overflow"] = int(os.environ.get("DB_MAX_OVERFLOW", "5"))
+        kwargs["pool_pre_ping"] = True
+        kwargs["pool_recycle"] = 1800
+    elif not memory:
+        kwargs["pool_size"] = int(os.environ.get("DB_POOL_SIZE", "8"))
+        kwargs["max_overflow"] = int(os.environ.get("DB_MAX_OVERFLOW", "8"))
+        kwargs["connect_args"] = {"timeout": 10, "check_same_thread": False}
+    engine = create_engine(url, **kwargs)
+    if url.startswith("sqlite") and not memory:
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    return engine
+
+
+def ping_db(engine: Engine) -> bool:
+    """数据库是否可用，给 /healthz 用"""
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        return True
+    except SQLAlchemyError:
+        return False
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_labels(statement: str) -> tuple[str, str]:
+    """语句的操作和（第一个）表名，作为指标标签"""
+    words = statement.split(None, 1)
+    operation = words[0].lower() if words else ""
+    m = _STATEMENT_TABLE.search(statement)
+    return operation, m.group(1) if m else ""
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "metrics_start", None)
+    if start is None:
+        return
+    operation, table = statement_labels(statement)
+    db_query_histogram.observe(
+        time.perf_counter() - start, operation=operation, table=table
+    )
+
+
+def _handle_error(exception_context):
+    operation, table = statement_labels(exception_context.statement or "")
+    db_error_counter.inc(operation=operation, table=table)
+
+
+def _set_sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    # 要在切换 WAL（会写入文件头）之前设置，新库才能直接生效；旧库见 migrate.py --vacuum
+    cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA busy_timeout=10000")
+    # WAL 下 NORMAL 只在断电时可能丢最后几个事务，不会损坏数据库
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
 
 
 class __ORMBase(DeclarativeBase):
@@ -14,98 +132,394 @@ class __ORMBase(DeclarativeBase):
 
 class CardSetORM(__ORMBase):
     __tablename__ = "card_set"
+    __table_args__ = (Index("ix_card_set_lookup", "chat_id", "name", "deleted"),)
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(255))
     chat_id: Mapped[str] = mapped_column(String(255))
-    items: Mapped[str] = mapped_column(String(2048))
+    # 成员已迁移到 card 表，该字段只保留给旧库迁移使用
+    items: Mapped[str] = mapped_column(String(2048), default="[]")
     created_at: Mapped[int] = mapped_column()
     created_by: Mapped[str] = mapped_column(String(255))
     deleted: Mapped[bool] = mapped_column(default=False)
+    deleted_at: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+
+class CardORM(__ORMBase):
+    __tablename__ = "card"
+    __table_args__ = (UniqueConstraint("card_set_id", "name"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    card_set_id: Mapped[int] = mapped_column(ForeignKey("card_set.id"))
+    name: Mapped[str] = mapped_column(String(255))
+    weight: Mapped[int] = mapped_column()
+
+
+def insert_ignore(session: Session, table, rows: list[dict]):
+    """批量插入，忽略唯一键冲突的行"""
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        stmt = sqlite_insert(table).on_conflict_do_nothing()
+    elif dialect == "postgresql":
+        stmt = postgresql_insert(table).on_conflict_do_nothing()
+    else:
+        stmt = insert(table).prefix_with("IGNORE")
+    session.execute(stmt, rows)
+
+
+class ChatVersionORM(__ORMBase):
+    __tablename__ = "chat_version"
+    chat_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    version: Mapped[int] = mapped_column(default=0)
 
 
 class CardSetRepo:
+    """
+    cache_size > 0 时开启进程内读缓存。每次写操作在同一事务里把 chat_version 加一，
+    读取时先查版本号（主键查询），版本一致才用缓存，因此其他 worker 的写入能立即生效。
+    """
+
     engine: Engine = None
+    cache: TTLCache = None
 
-    def __init__(self, engine):
+    def __init__(self, engine, cache_size: int = 0, cache_ttl: float = 3600):
         self.engine = engine
+        if cache_size > 0:
+            self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
 
-    def __row_to_card_set(self, row: CardSetORM) -> CardSet:
-        card_set = CardSet(row.chat_id, row.name, create_by=row.created_by)
-        items = json.loads(row.items)
-        for item in items:
-            card_set.add_card(item["name"], item["weight"])
-        return card_set
+    def __get_version(self, session: Session, chat_id: str) -> int:
+        stmt = select(ChatVersionORM.version).where(ChatVersionORM.chat_id == chat_id)
+        return session.scalars(stmt).first() or 0
 
-    def get_card_set_list(self, chat_id: str) -> list[CardSet]:
-        session = Session(self.engine)
+    def __bump_version(self, session: Session, chat_id: str):
+        dialect = session.get_bind().dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            dialect_insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+            stmt = (
+                dialect_insert(ChatVersionORM)
+                .values(chat_id=chat_id, version=1)
+                .on_conflict_do_update(
+                    index_elements=["chat_id"],
+                    set_={"version": ChatVersionORM.version + 1},
+                )
+            )
+            session.execute(stmt)
+            return
         stmt = (
-            select(CardSetORM)
-            .where(CardSetORM.chat_id == chat_id)
-            .where(CardSetORM.deleted == False)
+            update(ChatVersionORM)
+            .where(ChatVersionORM.chat_id == chat_id)
+            .values(version=ChatVersionORM.version + 1)
         )
-        ans = []
-        for row in session.scalars(stmt):
-            ans.append(self.__row_to_card_set(row))
-        return ans
+        if session.execute(stmt).rowcount == 0:
+            session.add(ChatVersionORM(chat_id=chat_id, version=1))
 
-    def get_card_set(self, chat_id: str, name: str) -> CardSet:
-        session = Session(self.engine)
-        stmt = (
+    def __cached(self, session: Session, key: tuple, chat_id: str, load):
+        """读穿缓存：先读版本号再读数据，数据只可能比版本新，不会缓存到旧数据"""
+        if self.cache is None:
+            return load()
+        version = self.__get_version(session, chat_id)
+        item = self.cache.get(key)
+        if item is not None and item[0] == version:
+            return item[1]
+        value = load()
+        self.cache.set(key, (version, value))
+        return value
+
+    def __select_card_set(self, chat_id: str, name: str):
+        return (
             select(CardSetORM)
             .where(CardSetORM.chat_id == chat_id)
             .where(CardSetORM.name == name)
             .where(CardSetORM.deleted == False)
         )
-        for row in session.scalars(stmt):
-            return self.__row_to_card_set(row)
-        return None
 
-    def create_or_update_card_set(self, card_set: CardSet):
+    def __load_card_sets(self, session: Session, rows: list[CardSetORM]):
+        ans = {}
+        for row in rows:
+            ans[row.id] = CardSet(row.chat_id, row.name, create_by=row.created_by)
+        if not ans:
+            return []
+        ids = list(ans.keys())
+        for i in range(0, len(ids), MAX_IN_PARAMS):
+            stmt = (
+                select(CardORM.card_set_id, CardORM.name, CardORM.weight)
+                .where(CardORM.card_set_id.in_(ids[i : i + MAX_IN_PARAMS]))
+                .order_by(CardORM.id)
+            )
+            for card_set_id, name, weight in session.execute(stmt):
+                ans[card_set_id].add_card(name, weight)
+        return list(ans.values())
+
+    def __get_card_set_id(self, session: Session, chat_id: str, name: str) -> int:
+        stmt = self.__select_card_set(chat_id, name).with_only_columns(CardSetORM.id)
+        return session.scalars(stmt).first()
+
+    def __get_or_create_card_set_id(
+        self, session: Session, chat_id: str, name: str, create_by: str
+    ) -> int:
+        card_set_id = self.__get_card_set_id(session, chat_id, name)
+        if card_set_id is not None:
+            return card_set_id
+        row = CardSetORM()
+        row.chat_id = chat_id
+        row.name = name
+        row.created_at = time.time()
+        row.created_by = create_by
+        session.add(row)
+        session.flush()
+        return row.id
+
+    def get_card_set_list(self, chat_id: str) -> list[CardSet]:
         with Session(self.engine) as session:
             stmt = (
                 select(CardSetORM)
-                .where(CardSetORM.chat_id == card_set.chat_id)
-                .where(CardSetORM.name == card_set.name)
+                .where(CardSetORM.chat_id == chat_id)
                 .where(CardSetORM.deleted == False)
+                .order_by(CardSetORM.id)
             )
-            for row in session.scalars(stmt):
-                row.items = json.dumps(
-                    card_set.get_cards(),
-                    default=lambda o: o.__dict__,
-                    ensure_ascii=False,
-                )
-                assert len(row.items) < 2048
-                session.commit()
+            ans = self.__cached(
+                session,
+                ("list", chat_id),
+                chat_id,
+                lambda: self.__load_card_sets(session, session.scalars(stmt).all()),
+            )
+            return [x.copy() for x in ans]
+
+    def get_card_set_names(self, chat_id: str) -> list[str]:
+        """只查集合名，不加载成员"""
+        with Session(self.engine) as session:
+            stmt = (
+                select(CardSetORM.name)
+                .where(CardSetORM.chat_id == chat_id)
+                .where(CardSetORM.deleted == False)
+                .order_by(CardSetORM.id)
+            )
+            return list(session.scalars(stmt))
+
+    def get_card_set(self, chat_id: str, name: str) -> CardSet:
+        with Session(self.engine) as session:
+
+            def load():
+                rows = session.scalars(self.__select_card_set(chat_id, name)).all()
+                for card_set in self.__load_card_sets(session, rows[:1]):
+                    return card_set
+                return None
+
+            card_set = self.__cached(session, ("set", chat_id, name), chat_id, load)
+            return card_set.copy() if card_set else None
+
+    def has_card_set(self, chat_id: str, name: str) -> bool:
+        with Session(self.engine) as session:
+            return self.__get_card_set_id(session, chat_id, name) is not None
+
+    def card_set_stats(self, chat_id: str, name: str) -> tuple[int, int]:
+        """(成员数, 总权重)，集合不存在时返回 None"""
+        with Session(self.engine) as session:
+            card_set_id = self.__get_card_set_id(session, chat_id, name)
+            if card_set_id is None:
+                return None
+            stmt = select(func.count(CardORM.id), func.sum(CardORM.weight)).where(
+                CardORM.card_set_id == card_set_id
+            )
+            count, total = session.execute(stmt).one()
+            return count, total or 0
+
+    def iter_cards(
+        self, chat_id: str, name: str, batch_size: int = 500
+    ) -> Iterator[Card]:
+        """按添加顺序逐批读取成员，不把整个集合加载到内存；不经过缓存"""
+        with Session(self.engine) as session:
+            card_set_id = self.__get_card_set_id(session, chat_id, name)
+            if card_set_id is None:
                 return
-            else:
-                row = CardSetORM()
-                row.chat_id = card_set.chat_id
-                row.name = card_set.name
-                row.items = json.dumps(
-                    card_set.get_cards(), default=lambda o: o.__dict__
-                )
-                row.created_at = time.time()
-                row.created_by = card_set.create_by
-                session.add(row)
-                session.commit()
+            stmt = (
+                select(CardORM.name, CardORM.weight)
+                .where(CardORM.card_set_id == card_set_id)
+                .order_by(CardORM.id)
+                .execution_options(yield_per=batch_size)
+            )
+            for card_name, weight in session.execute(stmt):
+                yield Card(card_name, weight)
 
-    def remove_card_set(self, chat_id: str, name: str):
+    def top_cards(self, chat_id: str, name: str, limit: int) -> list[Card]:
+        """权重最高的 limit 个成员"""
         with Session(self.engine) as session:
+            card_set_id = self.__get_card_set_id(session, chat_id, name)
+            if card_set_id is None:
+                return []
             stmt = (
-                select(CardSetORM)
+                select(CardORM.name, CardORM.weight)
+                .where(CardORM.card_set_id == card_set_id)
+                .order_by(CardORM.weight.desc(), CardORM.id)
+                .limit(limit)
+            )
+            return [Card(x, y) for x, y in session.execute(stmt)]
+
+    def count_card_sets(self, chat_id: str) -> int:
+        with Session(self.engine) as session:
+            stmt = (
+                select(func.count(CardSetORM.id))
                 .where(CardSetORM.chat_id == chat_id)
-                .where(CardSetORM.name == name)
                 .where(CardSetORM.deleted == False)
             )
-            for row in session.scalars(stmt):
+            return session.scalar(stmt)
+
+    def iter_card_set_summaries(
+        self, chat_id: str, batch_size: int = 500
+    ) -> Iterator[tuple[str, int]]:
+        """逐批读取 (集合名, 成员数)，成员只在数据库里计数"""
+        with Session(self.engine) as session:
+            stmt = (
+                select(CardSetORM.name, func.count(CardORM.id))
+                .outerjoin(CardORM, CardORM.card_set_id == CardSetORM.id)
+                .where(CardSetORM.chat_id == chat_id)
+                .where(CardSetORM.deleted == False)
+                .group_by(CardSetORM.id)
+                .order_by(CardSetORM.id)
+                .execution_options(yield_per=batch_size)
+            )
+            for name, count in session.execute(stmt):
+                yield name, count
+
+    def create_or_update_card_set(self, card_set: CardSet):
+        """按成员逐行同步：新增、修改权重、删除不在 card_set 里的成员"""
+        with Session(self.engine) as session:
+            card_set_id = self.__get_or_create_card_set_id(
+                session, card_set.chat_id, card_set.name, card_set.create_by
+            )
+            stmt = select(CardORM).where(CardORM.card_set_id == card_set_id)
+            rows = {row.name: row for row in session.scalars(stmt)}
+            new_rows = []
+            for card in card_set.get_cards():
+                row = rows.pop(card.name, None)
+                if row is None:
+                    new_rows.append(
+                        {
+                            "card_set_id": card_set_id,
+                            "name": card.name,
+                            "weight": card.weight,
+                        }
+                    )
+                elif row.weight != card.weight:
+                    row.weight = card.weight
+            for row in rows.values():
+                session.delete(row)
+            session.flush()
+            insert_ignore(session, CardORM, new_rows)
+            self.__bump_version(session, card_set.chat_id)
+            session.commit()
+
+    def add_cards(
+        self,
+        chat_id: str,
+        name: str,
+        card_names: list[str],
+        create_by: str,
+        weight: int = DEFAULT_CARD_WIGHT,
+    ):
+        """向集合添加成员（集合不存在时创建），已存在的成员保持不变"""
+        with Session(self.engine) as session:
+            card_set_id = self.__get_or_create_card_set_id(
+                session, chat_id, name, create_by
+            )
+            rows = [
+                {"card_set_id": card_set_id, "name": x, "weight": weight}
+                for x in dict.fromkeys(card_names)
+            ]
+            insert_ignore(session, CardORM, rows)
+            self.__bump_version(session, chat_id)
+            session.commit()
+
+    def remove_card(self, chat_id: str, name: str, card_name: str) -> Card:
+        with Session(self.engine) as session:
+            card_set_id = self.__get_card_set_id(session, chat_id, name)
+            if card_set_id is None:
+                return None
+            stmt = (
+                select(CardORM)
+                .where(CardORM.card_set_id == card_set_id)
+                .where(CardORM.name == card_name)
+            )
+            row = session.scalars(stmt).first()
+            if row is None:
+                return None
+            card = Card(row.name, row.weight)
+            session.delete(row)
+            self.__bump_version(session, chat_id)
+            session.commit()
+            return card
+
+    def change_card_weight(
+        self, chat_id: str, name: str, card_name: str, delta: int
+    ) -> tuple[int, int]:
+        """
+        在数据库内原子地增减成员权重（最低为 0），不读取整个集合。
+        返回 (修改前的权重, 修改后的权重)，集合或成员不存在时返回 None。
+        """
+        card_set_id = (
+            self.__select_card_set(chat_id, name)
+            .with_only_columns(CardSetORM.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        new_weight = CardORM.weight + delta
+        stmt = (
+            update(CardORM)
+            .where(CardORM.card_set_id == card_set_id)
+            .where(CardORM.name == card_name)
+            .values(weight=case((new_weight < 0, 0), else_=new_weight))
+        )
+        select_weight = (
+            select(CardORM.weight)
+            .where(CardORM.card_set_id == card_set_id)
+            .where(CardORM.name == card_name)
+        )
+        with Session(self.engine) as session:
+            # 先改版本号拿到写锁（同一会话的写操作都会改这一行），更新前后读到的权重
+            # 不会被并发的修改穿插
+            self.__bump_version(session, chat_id)
+            old_weight = session.scalars(select_weight).first()
+            if old_weight is None or session.execute(stmt).rowcount == 0:
+                session.rollback()
+                return None
+            weight = session.scalars(select_weight).first()
+            session.commit()
+            return old_weight, weight
+
+    def remove_card_set(self, chat_id: str, name: str):
+        with Session(self.engine) as session:
+            for row in session.scalars(self.__select_card_set(chat_id, name)):
                 row.deleted = True
+                row.deleted_at = time.time()
+                self.__bump_version(session, chat_id)
                 session.commit()
                 return True
             return False
 
+    def purge_deleted_card_sets(self, before: float, limit: int) -> tuple[int, int]:
+        """硬删除 before 之前软删除的集合及其成员，每次最多 limit 个集合，返回 (集合数, 成员数)"""
+        with Session(self.engine) as session:
+            ids = session.scalars(
+                select(CardSetORM.id)
+                .where(CardSetORM.deleted == True)
+                .where(CardSetORM.deleted_at < before)
+                .limit(limit)
+            ).all()
+            if not ids:
+                return 0, 0
+            cards = session.execute(
+                delete(CardORM).where(CardORM.card_set_id.in_(ids))
+            ).rowcount
+            sets = session.execute(
+                delete(CardSetORM).where(CardSetORM.id.in_(ids))
+            ).rowcount
+            session.commit()
+            return sets, cards
+
 
 class RollRecordORM(__ORMBase):
     __tablename__ = "roll_record"
+    __table_args__ = (Index("ux_roll_record_msg_id", "msg_id", unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True)
     chat_id: Mapped[str] = mapped_column(String(255))
     card_set_name: Mapped[str] = mapped_column(String(255))
@@ -115,6 +529,48 @@ class RollRecordORM(__ORMBase):
     created_at: Mapped[int] = mapped_column()
 
 
+class RollStatORM(__ORMBase):
+    """按天汇总的抽卡次数和赞/踩次数，/stats 只查这张表，和抽卡记录的多少无关"""
+
+    __tablename__ = "roll_stat"
+    chat_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    card_set_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    day: Mapped[int] = mapped_column(primary_key=True)  # 本地日期，如 20240131
+    card_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    draws: Mapped[int] = mapped_column(default=0)
+    up: Mapped[int] = mapped_column(default=0)
+    down: Mapped[int] = mapped_column(default=0)
+    # 回应实际带来的权重变化（权重最低为 0，不一定等于赞踩之差）
+    weight_delta: Mapped[int] = mapped_column(default=0, server_default="0")
+
+
+def stat_day(ts: float) -> int:
+    return int(time.strftime("%Y%m%d", time.localtime(ts)))
+
+
+def upsert_roll_stat(session: Session, key: dict, values: dict, add: bool = True):
+    """add=True 时在原值上累加，否则覆盖"""
+    if add:
+        set_ = {k: getattr(RollStatORM, k) + v for k, v in values.items()}
+    else:
+        set_ = dict(values)
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        dialect_insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+        stmt = (
+            dialect_insert(RollStatORM)
+            .values(**key, **values)
+            .on_conflict_do_update(index_elements=list(key), set_=set_)
+        )
+        session.execute(stmt)
+        return
+    stmt = update(RollStatORM).values(**set_)
+    for k, v in key.items():
+        stmt = stmt.where(getattr(RollStatORM, k) == v)
+    if session.execute(stmt).rowcount == 0:
+        session.add(RollStatORM(**key, **values))
+
+
 class RollRecordRepo:
     engine: Engine = None
 
@@ -122,14 +578,92 @@ class RollRecordRepo:
         self.engine = engine
 
     def create_roll_record(self, record: RollRecord):
+        """写抽卡记录，同一事务里给当天的抽卡次数加一（msg_id 重复时一起回滚）"""
         with Session(self.engine) as session:
             row = RollRecordORM()
             for key in record.__dict__:
                 setattr(row, key, record.__dict__[key])
             row.created_at = time.time()
             session.add(row)
+            session.flush()
+            upsert_roll_stat(
+                session, self.__stat_key(record, row.created_at), {"draws": 1}
+            )
+            session.commit()
+
+    def record_reaction(
+        self, record: RollRecord, weight_delta: int, column: str = None
+    ):
+        """
+        记录一次回应实际带来的权重变化。新增的赞/踩同时计数（column 为 up 或 down），
+        取消回应只记权重变化，计数不会减成负数
+        """
+        values = {"weight_delta": weight_delta}
+        if column:
+            values[column] = 1
+        with Session(self.engine) as session:
+            upsert_roll_stat(session, self.__stat_key(record, time.time()), values)
+            session.commit()
+
+    def roll_stats(
+        self, chat_id: str, card_set_name: str, since_day: int = 0
+    ) -> list[tuple[str, int, int, int, int]]:
+        """
+        since_day（含）以来每个成员的 (成员名, 抽中次数, 赞, 踩, 权重变化)，
+        按抽中次数从多到少
+        """
+        draws = func.sum(RollStatORM.draws)
+        stmt = (
+            select(
+                RollStatORM.card_name,
+                draws,
+                func.sum(RollStatORM.up),
+                func.sum(RollStatORM.down),
+                func.sum(RollStatORM.weight_delta),
+            )
+            .where(RollStatORM.chat_id == chat_id)
+            .where(RollStatORM.card_set_name == card_set_name)
+            .where(RollStatORM.day >= since_day)
+            .group_by(RollStatORM.card_name)
+            .order_by(draws.desc(), RollStatORM.card_name)
+        )
+        with Session(self.engine) as session:
+            return [tuple(x) for x in session.execute(stmt)]
+
+    def iter_roll_records(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """按主键顺序逐批读出 (chat_id, 集合名, 成员名, created_at)，给回填统计用"""
+        stmt = select(
+            RollRecordORM.chat_id,
+            RollRecordORM.card_set_name,
+            RollRecordORM.card_name,
+            RollRecordORM.created_at,
+        ).order_by(RollRecordORM.id)
+        with Session(self.engine) as session:
+            for row in session.execute(stmt.execution_options(yield_per=batch_size)):
+                yield tuple(row)
+
+    def set_draws(self, counts: dict[tuple, int]):
+        """counts 为 {(chat_id, 集合名, 日期, 成员名): 抽卡次数}，覆盖已有的抽卡次数"""
+        with Session(self.engine) as session:
+            for (chat_id, card_set_name, day, card_name), num in counts.items():
+                key = {
+                    "chat_id": chat_id,
+                    "card_set_name": card_set_name,
+                    "day": day,
+                    "card_name": card_name,
+                }
+                upsert_roll_stat(session, key, {"draws": num}, add=False)
             session.commit()
 
+    @staticmethod
+    def __stat_key(record: RollRecord, ts: float) -> dict:
+        return {
+            "chat_id": record.chat_id,
+            "card_set_name": record.card_set_name,
+            "day": stat_day(ts),
+            "card_name": record.card_name,
+        }
+
     def get_roll_record(self, msg_id: str) -> RollRecord:
         with Session(self.engine) as session:
             stmt = select(RollRecordORM).where(RollRecordORM.msg_id == msg_id)
@@ -143,3 +677,119 @@ class RollRecordRepo:
                 )
                 return record
             return None
+
+    def purge_roll_records(self, before: float, limit: int) -> int:
+        """
+        删除 before 之前的抽卡记录，每次最多 limit 行。记录按主键顺序写入，从最旧的开始
+        按主键读 limit 行，遇到 before 之后的记录即停，不需要 created_at 上的索引。
+        """
+        with Session(self.engine) as session:
+            stmt = (
+                select(RollRecordORM.id, RollRecordORM.created_at)
+                .order_by(RollRecordORM.id)
+                .limit(limit)
+            )
+            last_id = None
+            for row_id, created_at in session.execute(stmt):
+                if created_at >= before:
+                    break
+                last_id = row_id
+            if last_id is None:
+                return 0
+            res = session.execute(
+                delete(RollRecordORM).where(RollRecordORM.id <= last_id)
+            )
+            session.commit()
+            return res.rowcount
+
+
+class EventDedupORM(__ORMBase):
+    __tablename__ = "event_dedup"
+    event_id: Mapped[str] = mapped_column(String(255), primary_key=True)
+    created_at: Mapped[int] = mapped_column(index=True)
+
+
+class EventDedupRepo:
+    engine: Engine = None
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def mark_event(self, event_id: str) -> bool:
+        """记录事件，首次出现返回 True，已存在返回 False"""
+        with Session(self.engine) as session:
+            session.add(EventDedupORM(event_id=event_id, created_at=time.time()))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return False
+            return True
+
+    def remove_event(self, event_id: str):
+        with Session(self.engine) as session:
+            session.execute(
+                delete(EventDedupORM).where(EventDedupORM.event_id == event_id)
+            )
+            session.commit()
+
+    def purge_events(self, before: float) -> int:
+        with Session(self.engine) as session:
+            res = session.execute(
+                delete(EventDedupORM).where(EventDedupORM.created_at < before)
+            )
+            session.commit()
+            return res.rowcount
+
+
+class TranslationCacheORM(__ORMBase):
+    __tablename__ = "translation_cache"
+    text: Mapped[str] = mapped_column(String(512), primary_key=True)
+    command: Mapped[str] = mapped_column(String(512))
+    created_at: Mapped[int] = mapped_column(index=True)
+
+
+class TranslationCacheRepo:
+    engine: Engine = None
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def get(self, text: str, min_created_at: float) -> str:
+        with Session(self.engine) as session:
+            stmt = (
+                select(TranslationCacheORM.command)
+                .where(TranslationCacheORM.text == text)
+                .where(TranslationCacheORM.created_at >= min_created_at)
+            )
+            return session.scalars(stmt).first()
+
+    def put(self, text: str, command: str):
+        with Session(self.engine) as session:
+            session.merge(
+                TranslationCacheORM(text=text, command=command, created_at=time.time())
+            )
+            session.commit()
+
+    def evict(self, max_rows: int, min_created_at: float) -> int:
+        """删除过期条目，并只保留最新的 max_rows 条"""
+        with Session(self.engine) as session:
+            removed = session.execute(
+                delete(TranslationCacheORM).where(
+                    TranslationCacheORM.created_at < min_created_at
+                )
+            ).rowcount
+            boundary = session.scalars(
+                select(TranslationCacheORM.created_at)
+                .order_by(TranslationCacheORM.created_at.desc())
+                .offset(max_rows)
+                .limit(1)
+            ).first()
+            if boundary is not None:
+                removed += session.execute(
+                    delete(TranslationCacheORM).where(
+                        TranslationCacheORM.created_at <= boundary
+                    )
+                ).rowcount
+            session.commit()
+            return removed
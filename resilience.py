@@ -0,0 +1,138 @@
+#!encoding:utf-8
+import logging
+import threading
+import time
+
+from metrics import Counter, Gauge
+
+_logger = logging.getLogger(__name__)
+
+breaker_state_gauge = Gauge(
+    "circuit_breaker_state", "熔断器状态，0: 关闭, 1: 半开, 2: 打开", ("name",)
+)
+breaker_transition_counter = Counter(
+    "circuit_breaker_transitions_total", "熔断器状态切换次数", ("name", "state")
+)
+breaker_rejected_counter = Counter(
+    "circuit_breaker_rejected_total", "熔断器打开期间被直接拒绝的调用次数", ("name",)
+)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Deadline:
+    """
+    单个事件的处理时限。事件收到时创建，之后每个出站调用的超时都不超过剩余时间，
+    时间用完后不再发起新的调用。
+    """
+
+    expires_at: float = 0
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded("event deadline exceeded")
+
+    def timeout(self, cap: float) -> float:
+        """本次调用可用的超时：cap 和剩余时间取小，时间已用完时抛出 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("event deadline exceeded")
+        return min(cap, remaining)
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续 failure_threshold 次调用失败（超过 slow_call_duration 秒的也算失败）后打开，
+    打开期间 allow() 直接返回 False，调用方走降级逻辑；cooldown 秒后进入半开状态，
+    放行一个试探调用，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    name: str = ""
+    failure_threshold: int = 0
+    slow_call_duration: float = 0
+    cooldown: float = 0
+    state: str = CLOSED
+    failures: int = 0
+    opened_at: float = 0
+    trial_started_at: float = 0
+    lock: threading.Lock = None
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        slow_call_duration: float = 10,
+        cooldown: float = 30,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_duration = slow_call_duration
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        breaker_state_gauge.set(0, name=name)
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.cooldown:
+                    breaker_rejected_counter.inc(name=self.name)
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                # 半开时只放行一个试探调用；试探调用没有回报结果（如被提前取消）时，
+                # 超过 cooldown 再放行下一个
+                if (
+                    self.trial_started_at
+                    and now - self.trial_started_at < self.cooldown
+                ):
+                    breaker_rejected_counter.inc(name=self.name)
+                    return False
+                self.trial_started_at = now
+            return True
+
+    def record(self, ok: bool, duration: float = 0):
+        """回报一次调用的结果，ok=False 表示失败"""
+        failed = not ok or duration >= self.slow_call_duration
+        with self.lock:
+            self.trial_started_at = 0
+            if not failed:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self._set_state(self.CLOSED)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        _logger.warning(
+            "circuit breaker %s: %s -> %s (failures: %d)",
+            self.name,
+            self.state,
+            state,
+            self.failures,
+        )
+        self.state = state
+        breaker_state_gauge.set(self.STATE_VALUES[state], name=self.name)
+        breaker_transition_counter.inc(name=self.name, state=state)
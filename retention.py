@@ -0,0 +1,123 @@
+#!encoding:utf-8
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from repo import CardSetRepo, RollRecordRepo
+
+_logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """
+    后台清理任务：删除超过回应窗口的抽卡记录、硬删除软删除已久的集合，最后增量回收空间。
+    每批只删 batch_size 行、批间让出 pause 秒，不长时间占用写锁；
+    多个 worker 通过文件锁保证同一时间只有一个在执行。
+    """
+
+    engine: Engine = None
+    card_set_repo: CardSetRepo = None
+    roll_record_repo: RollRecordRepo = None
+    roll_record_ttl: float = 0
+    deleted_set_ttl: float = 0
+    batch_size: int = 0
+    pause: float = 0
+    interval: float = 0
+    lock_path: str = ""
+    started_pid: int = 0
+
+    def __init__(
+        self,
+        engine: Engine,
+        roll_record_ttl: float = 30 * 86400,
+        deleted_set_ttl: float = 30 * 86400,
+        batch_size: int = 500,
+        pause: float = 0.05,
+        interval: float = 3600,
+        lock_path: str = "data/retention.lock",
+    ):
+        self.engine = engine
+        self.card_set_repo = CardSetRepo(engine)
+        self.roll_record_repo = RollRecordRepo(engine)
+        self.roll_record_ttl = roll_record_ttl
+        self.deleted_set_ttl = deleted_set_ttl
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.lock_path = lock_path
+
+    def start(self):
+        pid = os.getpid()
+        if self.started_pid == pid:
+            return
+        self.started_pid = pid
+        threading.Thread(target=self._loop, name="retention", daemon=True).start()
+
+    def run_once(self) -> dict:
+        now = time.time()
+        size_before = self._db_size()
+        report = {"roll_record": 0, "card_set": 0, "card": 0}
+        while True:
+            num = self.roll_record_repo.purge_roll_records(
+                now - self.roll_record_ttl, self.batch_size
+            )
+            report["roll_record"] += num
+            if num < self.batch_size:
+                break
+            time.sleep(self.pause)
+        while True:
+            sets, cards = self.card_set_repo.purge_deleted_card_sets(
+                now - self.deleted_set_ttl, self.batch_size
+            )
+            report["card_set"] += sets
+            report["card"] += cards
+            if sets < self.batch_size:
+                break
+            time.sleep(self.pause)
+        self._incremental_vacuum()
+        report["bytes_reclaimed"] = max(size_before - self._db_size(), 0)
+        report["seconds"] = round(time.time() - now, 3)
+        _logger.info("retention done: %s", report)
+        return report
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with open(self.lock_path, "a") as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # 其他 worker 正在执行
+                    self.run_once()
+            except Exception as e:
+                _logger.exception(e)
+
+    def _is_sqlite(self) -> bool:
+        return self.engine.dialect.name == "sqlite"
+
+    def _db_size(self) -> int:
+        if not self._is_sqlite():
+            return 0
+        with self.engine.connect() as conn:
+            page_count = conn.execute(text("PRAGMA page_count")).scalar()
+            page_size = conn.execute(text("PRAGMA page_size")).scalar()
+            return page_count * page_size
+
+    def _incremental_vacuum(self):
+        if not self._is_sqlite():
+            return
+        raw = self.engine.raw_connection()
+        try:
+            # sqlite3 每 fetch 一步回收一页，需要把结果取完；每次最多 1000 页，剩下的留给下一轮
+            cur = raw.cursor()
+            cur.execute("PRAGMA incremental_vacuum(1000)")
+            cur.fetchall()
+            raw.commit()
+        finally:
+            raw.close()
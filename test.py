@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import os
+import time
 
 from sqlalchemy import create_engine
 from repo import CardSetRepo, CardSetORM
@@ -28,3 +30,724 @@ card_set_list = card_set_repo.get_card_set_list("test_123456")
 assert len(card_set_list) == 1
 assert len(card_set_list[0].get_cards()) == 3
 assert card_set_list[0].get_card("必胜客").weight == 10
+
+# 事件去重
+from dedup import EventDeduper, dedup_counter
+from repo import EventDedupRepo
+
+dedup_engine = create_engine("sqlite://", future=True)
+CardSetORM.metadata.create_all(dedup_engine)
+deduper_a = EventDeduper(EventDedupRepo(dedup_engine))
+deduper_b = EventDeduper(EventDedupRepo(dedup_engine))
+assert not deduper_a.is_duplicate("event_1")
+assert deduper_a.is_duplicate("event_1")
+assert deduper_b.is_duplicate("event_1")  # 另一个 worker 通过数据库识别重复
+deduper_b.forget("event_1")
+assert not deduper_b.is_duplicate("event_1")
+assert not deduper_a.is_duplicate("")
+
+# 多进程共享 token 缓存
+import tempfile
+from feishu import TokenManager
+from token_store import FileTokenStore
+
+token_path = os.path.join(tempfile.mkdtemp(), "token.json")
+fetch_count = []
+
+
+def fake_fetch(self):
+    fetch_count.append(1)
+    self.token = "token_{}".format(len(fetch_count))
+    self.expire_time = time.time() + 7200
+
+
+TokenManager._fetch = fake_fetch
+manager_a = TokenManager("app_id", "app_secret", store=FileTokenStore(token_path))
+manager_b = TokenManager("app_id", "app_secret", store=FileTokenStore(token_path))
+assert manager_a.get_token() == "token_1"
+assert manager_b.get_token() == "token_1"  # 复用其他进程的 token
+assert len(fetch_count) == 1
+assert os.stat(token_path).st_mode & 0o777 == 0o600  # token 文件只有本用户可读
+
+# 自然语言翻译缓存
+from translation import TranslationCache
+from repo import TranslationCacheRepo
+
+translation_repo = TranslationCacheRepo(dedup_engine)
+translation_cache = TranslationCache(translation_repo, max_rows=2, evict_every=1)
+translation_cache.put("从吃饭里抽一张", "/roll 吃饭")
+translation_cache.put("随便说点什么", "无法理解")
+assert translation_cache.get("从吃饭里抽一张。") == "/roll 吃饭"
+assert translation_cache.get("随便说点什么") is None
+# 持久层在另一个进程里也能命中
+assert TranslationCache(translation_repo).get("从吃饭里抽一张") == "/roll 吃饭"
+translation_cache.put("查看", "/ls")
+translation_cache.put("怎么使用", "/help")
+assert TranslationCache(translation_repo).get("从吃饭里抽一张") is None
+
+# 本地意图识别，统计准确率和绕过大模型的比例
+from intent import parse_intent
+
+INTENT_CORPUS = [
+    # (会话内已有集合, 输入, 期望指令；None 表示应交给大模型)
+    (["吃饭"], "怎么使用", "/help"),
+    (["吃饭"], "怎么用？", "/help"),
+    (["吃饭"], "查看", "/ls"),
+    (["吃饭"], "查看所有集合", "/ls"),
+    (["吃饭"], "有哪些集合", "/ls"),
+    (["吃饭"], "查看吃饭集合", "/ls 吃饭"),
+    (["吃饭"], "查看吃饭", "/ls 吃饭"),
+    (["吃饭"], "看看吃饭集合的成员", "/ls 吃饭"),
+    (["吃饭"], "查看喝水集合", None),
+    ([], "向吃饭集合里添加老乡鸡、和府捞面", "/add 吃饭 老乡鸡 和府捞面"),
+    ([], "向吃饭里添加老乡鸡", "/add 吃饭 老乡鸡"),
+    (["吃饭"], "往吃饭里加麦当劳，肯德基", "/add 吃饭 麦当劳 肯德基"),
+    (["吃饭"], "给吃饭集合添加成员：必胜客 汉堡王", "/add 吃饭 必胜客 汉堡王"),
+    (["吃饭"], "在吃饭里加老乡鸡", "/add 吃饭 老乡鸡"),
+    ([], "往喝水集合里加可乐", "/add 喝水 可乐"),
+    (["吃饭"], "在家加班", None),
+    (["吃饭"], "给我加个鸡腿", None),
+    (["吃饭"], "给老板加点钱", None),
+    (["吃饭"], "往前加油", None),
+    (["吃饭"], "从吃饭集合里删掉老乡鸡", "/del 吃饭 老乡鸡"),
+    (["吃饭"], "从吃饭里删除和府捞面", "/del 吃饭 和府捞面"),
+    (["吃饭"], "从吃饭里删掉老乡鸡、和府捞面", None),
+    (["吃饭"], "从喝水里删掉可乐", None),
+    (["吃饭"], "从吃饭里抽一张", "/roll 吃饭"),
+    (["吃饭"], "从吃饭集合里抽一张。", "/roll 吃饭"),
+    (["吃饭"], "从吃饭里面随机抽一个", "/roll 吃饭"),
+    (["吃饭"], "从吃饭里抽3张", "/roll 吃饭 3"),
+    (["吃饭"], "吃饭抽卡", "/roll 吃饭"),
+    (["吃饭"], "抽一张", "/roll"),
+    (["吃饭"], "从喝水里抽一张", None),
+    (["吃饭"], "调整吃饭里老乡鸡的权重", "/weight 吃饭 老乡鸡"),
+    (["吃饭"], "调整吃饭集合里的老乡鸡的权重", "/weight 吃饭 老乡鸡"),
+    (["吃饭"], "吃饭可以去老乡鸡、和府捞面", None),
+    (["吃饭"], "今天中午吃什么好呢", None),
+    (["吃饭"], "帮我把老乡鸡的权重调高一点", None),
+]
+
+intent_correct = intent_local = 0
+for set_names, text, expected in INTENT_CORPUS:
+    command = parse_intent(text, set_names)
+    if command == expected:
+        intent_correct += 1
+    else:
+        print("intent mismatch: {} -> {}, expected {}".format(text, command, expected))
+    if command is not None:
+        intent_local += 1
+print(
+    "intent accuracy: {:.1%}, local fraction: {:.1%}".format(
+        intent_correct / len(INTENT_CORPUS), intent_local / len(INTENT_CORPUS)
+    )
+)
+assert intent_correct == len(INTENT_CORPUS)
+
+# card 表：逐行增删改，没有大小上限；旧库 items 迁移
+import json
+from migrate import migrate
+from repo import CardSetORM
+from sqlalchemy.orm import Session
+
+card_engine = create_engine("sqlite://", future=True)
+migrate(card_engine)
+card_repo = CardSetRepo(card_engine)
+card_repo.add_cards("chat_1", "大集合", ["成员{}".format(i) for i in range(3000)], "u")
+card_repo.add_cards("chat_1", "大集合", ["成员0", "新成员"], "u")
+big_set = card_repo.get_card_set("chat_1", "大集合")
+assert len(big_set.get_cards()) == 3001
+assert big_set.get_cards()[0].name == "成员0"
+assert big_set.get_cards()[-1].name == "新成员"
+assert card_repo.remove_card("chat_1", "大集合", "成员1").name == "成员1"
+assert card_repo.remove_card("chat_1", "大集合", "成员1") is None
+assert card_repo.change_card_weight("chat_1", "大集合", "成员2", -15) == (10, 0)
+assert card_repo.get_card_set("chat_1", "大集合").get_card("成员2").weight == 0
+
+with Session(card_engine) as session:
+    legacy = CardSetORM(chat_id="chat_1", name="旧集合", created_at=0, created_by="u")
+    legacy.items = json.dumps([{"name": "A", "weight": 3}, {"name": "B", "weight": 10}])
+    session.add(legacy)
+    session.commit()
+migrate(card_engine)
+migrate(card_engine)
+legacy_set = card_repo.get_card_set("chat_1", "旧集合")
+assert [(x.name, x.weight) for x in legacy_set.get_cards()] == [("A", 3), ("B", 10)]
+
+# 并发回应：数百个同时到达的赞/踩事件，最终权重必须精确
+import random
+import threading
+from repo import RollRecordRepo, create_db_engine
+from domain import RollRecord
+
+stress_path = os.path.join(tempfile.mkdtemp(), "stress.db")
+stress_engine = create_db_engine("sqlite:///" + stress_path)
+migrate(stress_engine)
+stress_repo = CardSetRepo(stress_engine)
+stress_roll_repo = RollRecordRepo(stress_engine)
+stress_repo.add_cards("chat_1", "吃饭", ["麦当劳"], "u", weight=200)
+stress_roll_repo.create_roll_record(RollRecord("chat_1", "吃饭", "麦当劳", "om_1", "u"))
+reactions = [1] * 300 + [-1] * 150
+random.shuffle(reactions)
+start_event = threading.Event()
+
+
+def react(num):
+    start_event.wait()
+    record = stress_roll_repo.get_roll_record("om_1")
+    stress_repo.change_card_weight(
+        record.chat_id, record.card_set_name, record.card_name, num
+    )
+
+
+threads = [threading.Thread(target=react, args=(x,)) for x in reactions]
+for t in threads:
+    t.start()
+start_event.set()
+for t in threads:
+    t.join()
+assert stress_repo.get_card_set("chat_1", "吃饭").get_card("麦当劳").weight == 350
+for _ in range(400):
+    stress_repo.change_card_weight("chat_1", "吃饭", "麦当劳", -1)
+assert stress_repo.get_card_set("chat_1", "吃饭").get_card("麦当劳").weight == 0
+assert stress_repo.change_card_weight("chat_1", "吃饭", "麦当劳", -1) == (0, 0)
+assert stress_repo.change_card_weight("chat_1", "吃饭", "麦当劳", 2) == (0, 2)
+stress_repo.change_card_weight("chat_1", "吃饭", "麦当劳", -2)
+assert stress_repo.change_card_weight("chat_1", "吃饭", "不存在", 1) is None
+
+# 读缓存：其他 worker 的写入通过 chat_version 立即可见
+cached_repo_a = CardSetRepo(card_engine, cache_size=16)
+cached_repo_b = CardSetRepo(card_engine, cache_size=16)
+assert len(cached_repo_a.get_card_set("chat_1", "旧集合").get_cards()) == 2
+assert cached_repo_a.get_card_set("chat_2", "不存在") is None
+cached_repo_b.add_cards("chat_1", "旧集合", ["C"], "u")
+assert len(cached_repo_a.get_card_set("chat_1", "旧集合").get_cards()) == 3
+cached_repo_b.change_card_weight("chat_1", "旧集合", "C", 5)
+assert cached_repo_a.get_card_set("chat_1", "旧集合").get_card("C").weight == 15
+assert len(cached_repo_a.get_card_set_list("chat_1")) == 2
+assert len(cached_repo_a.get_card_set_names("chat_1")) == 2
+cached_repo_b.remove_card_set("chat_1", "旧集合")
+assert len(cached_repo_a.get_card_set_list("chat_1")) == 1
+assert cached_repo_a.get_card_set("chat_1", "旧集合") is None
+# 调用方修改返回值不会污染缓存
+cached_repo_a.get_card_set("chat_1", "大集合").flush_cards()
+assert len(cached_repo_a.get_card_set("chat_1", "大集合").get_cards()) > 0
+
+# CardSet 按名字索引，保持插入顺序
+indexed_set = CardSet("chat_1", "排序", create_by="u")
+for name in ["C", "A", "B"]:
+    indexed_set.add_card(name)
+indexed_set.add_card("A", 99)
+assert [x.name for x in indexed_set.get_cards()] == ["C", "A", "B"]
+assert indexed_set.get_card("A").weight == 10
+assert indexed_set.remove_card("C").name == "C"
+assert indexed_set.remove_card("C") is None
+assert indexed_set.change_wight("B", 5) and indexed_set.get_card("B").weight == 15
+assert [x.name for x in indexed_set.get_cards()] == ["A", "B"]
+
+# 抽卡：空集合、权重全为 0、不放回多抽
+roll_set = CardSet("chat_1", "抽卡", create_by="u")
+assert roll_set.roll() is None
+roll_set.add_card("零", 0)
+assert roll_set.roll() is None and roll_set.roll_many(3) == []
+roll_set.add_card("甲", 1)
+roll_set.add_card("乙", 1000)
+assert roll_set.roll().name in ("甲", "乙")
+roll_set.set_wight("乙", 0)
+assert all(roll_set.roll().name == "甲" for _ in range(100))
+assert [x.name for x in roll_set.roll_many(5)] == ["甲"]
+roll_set.set_wight("乙", 1000)
+drawn = roll_set.roll_many(2)
+assert sorted(x.name for x in drawn) == ["乙", "甲"]
+first_counts = {"甲": 0, "乙": 0}
+for _ in range(2000):
+    first_counts[roll_set.roll_many(1)[0].name] += 1
+assert first_counts["乙"] > first_counts["甲"] * 50
+assert roll_set.copy().roll().name in ("甲", "乙")
+# 副本只共享已经建好且没过期的权重表，否则等抽卡时再建
+assert roll_set.copy().sampler is None  # 调整权重后还没抽过
+roll_set.roll()
+assert roll_set.copy().sampler[1] is roll_set.sampler[1]
+roll_set.set_wight("甲", 5)
+assert roll_set.copy().sampler is None
+
+# 清理任务：过期抽卡记录、软删除的集合，增量回收空间
+from retention import RetentionJob
+
+retention_path = os.path.join(tempfile.mkdtemp(), "retention.db")
+retention_engine = create_db_engine("sqlite:///" + retention_path)
+migrate(retention_engine)
+retention_repo = CardSetRepo(retention_engine)
+retention_roll_repo = RollRecordRepo(retention_engine)
+for i in range(5):
+    retention_roll_repo.create_roll_record(
+        RollRecord("chat_1", "吃饭", "麦当劳" * 50, "om_{}".format(i), "u")
+    )
+retention_repo.add_cards("chat_1", "吃饭", ["成员{}".format(i) for i in range(500)], "u")
+retention_repo.add_cards("chat_1", "喝水", ["可乐"], "u")
+retention_repo.remove_card_set("chat_1", "吃饭")
+time.sleep(0.01)
+report = RetentionJob(
+    retention_engine, roll_record_ttl=0, deleted_set_ttl=0, batch_size=2, pause=0
+).run_once()
+assert report["roll_record"] == 5 and report["card_set"] == 1 and report["card"] == 500
+assert retention_roll_repo.get_roll_record("om_1") is None
+assert len(retention_repo.get_card_set_list("chat_1")) == 1
+assert report["bytes_reclaimed"] > 0
+
+# 旧库启动时只设置 auto_vacuum，不整库 VACUUM；手动执行 migrate.py --vacuum 后转换
+from migrate import vacuum
+from sqlalchemy import text
+
+legacy_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "legacy.db")
+CardSetORM.metadata.create_all(create_engine(legacy_url))  # 没有设置 auto_vacuum 的旧库
+legacy_engine = create_db_engine(legacy_url)
+migrate(legacy_engine)
+with legacy_engine.connect() as conn:
+    assert conn.execute(text("PRAGMA auto_vacuum")).scalar() == 0
+vacuum(legacy_engine)
+with legacy_engine.connect() as conn:
+    assert conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+# 按主键从旧到新删除，遇到截止时间之后的记录就停
+from repo import RollRecordORM
+
+for i in range(5, 8):
+    retention_roll_repo.create_roll_record(RollRecord("chat_1", "吃饭", "a", "om_{}".format(i), "u"))
+with retention_engine.begin() as conn:
+    conn.execute(
+        RollRecordORM.__table__.update()
+        .where(RollRecordORM.msg_id == "om_7")
+        .values(created_at=time.time() + 3600)
+    )
+purge_before = time.time() + 60
+assert retention_roll_repo.purge_roll_records(purge_before, 10) == 2
+assert retention_roll_repo.purge_roll_records(purge_before, 10) == 0
+assert retention_roll_repo.get_roll_record("om_7") is not None
+
+# 异步飞书客户端：429/5xx 退避重试，回复带 uuid
+import asyncio
+import httpx
+from feishu import AsyncFeishuClient
+
+feishu_calls = []
+
+
+def feishu_stub(request: httpx.Request) -> httpx.Response:
+    feishu_calls.append(json.loads(request.content))
+    assert request.headers["Authorization"] == "Bearer token_1"
+    if len(feishu_calls) < 3:
+        return httpx.Response(429 if len(feishu_calls) == 1 else 502)
+    return httpx.Response(200, json={"data": {"message_id": "om_reply"}})
+
+
+async def reply_async():
+    client = AsyncFeishuClient(manager_a, base_url="http://feishu", backoff_factor=0)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(feishu_stub))
+    resp = await client.reply_message("om_1", "text", {"text": "hi"})
+    await client.aclose()
+    return resp
+
+
+assert asyncio.run(reply_async()).json()["data"]["message_id"] == "om_reply"
+assert len(feishu_calls) == 3
+assert len({x["uuid"] for x in feishu_calls}) == 1  # 重试沿用同一个 uuid
+
+
+def feishu_read_error(request: httpx.Request) -> httpx.Response:
+    feishu_calls.append(json.loads(request.content))
+    raise httpx.ReadTimeout("timeout", request=request)
+
+
+async def reply_read_error():
+    client = AsyncFeishuClient(manager_a, base_url="http://feishu", backoff_factor=0)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(feishu_read_error))
+    try:
+        await client.reply_message("om_1", "text", {"text": "hi"})
+    finally:
+        await client.aclose()
+
+
+feishu_calls.clear()
+try:
+    asyncio.run(reply_read_error())
+    assert False
+except httpx.ReadTimeout:
+    pass
+assert len(feishu_calls) == 1  # 请求已经发出，不重试
+
+# 同步飞书客户端：5xx 重试到上限；请求发出后连接断开或读超时不重试，读超时按配置生效
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from feishu import FeishuClient
+
+stub_hits = []
+
+
+class FeishuStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        stub_hits.append(self.path)
+        if self.path == "/drop":
+            self.close_connection = True
+            return
+        if self.path == "/slow":
+            time.sleep(1)
+        self.send_response(500)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+stub_server = ThreadingHTTPServer(("127.0.0.1", 0), FeishuStubHandler)
+stub_server.daemon_threads = True
+threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+stub_client = FeishuClient(
+    manager_a,
+    base_url="http://127.0.0.1:{}".format(stub_server.server_port),
+    read_timeout=0.2,
+    retries=2,
+    backoff_factor=0,
+)
+assert stub_client.post("/error", {}).status_code == 500
+assert stub_hits == ["/error"] * 3
+for path in ("/drop", "/slow"):
+    stub_hits.clear()
+    start = time.perf_counter()
+    try:
+        stub_client.post(path, {})
+        assert False
+    except requests.RequestException:
+        pass
+    assert stub_hits == [path]
+    assert time.perf_counter() - start < 0.6
+stub_server.shutdown()
+
+# 指标：多个 worker 的文件相加，输出 Prometheus 文本格式
+from metrics import Histogram, MultiProcessCollector
+
+metrics_dir = tempfile.mkdtemp()
+test_histogram = Histogram("test_seconds", "测试", ("command",), buckets=(0.1, 1))
+test_histogram.observe(0.05, command="/roll")
+test_histogram.observe(5, command="/roll")
+collector = MultiProcessCollector(metrics_dir)
+collector.flush()
+os.rename(collector.path, os.path.join(metrics_dir, "metrics_1.json"))  # 另一个 worker
+metrics_text = collector.render()
+assert 'test_seconds_bucket{command="/roll",le="0.1"} 2' in metrics_text
+assert 'test_seconds_bucket{command="/roll",le="+Inf"} 4' in metrics_text
+assert 'test_seconds_count{command="/roll"} 4' in metrics_text
+dedup_hits = int(dedup_counter.get(result="hit") * 2)
+assert 'event_dedup_total{result="hit"} ' + str(dedup_hits) in metrics_text
+
+# 日志：大块数据只在输出时序列化并截断，req_id 是结构化字段
+import io
+import logging
+from logs import JsonFormatter, LazyPayload
+
+assert str(LazyPayload({"text": "x" * 100}, 20)).endswith("...(112 chars)")
+assert str(LazyPayload("abc", 20)) == "abc"
+
+
+class Unserializable:
+    def __str__(self):
+        raise AssertionError("should not be serialized")
+
+
+log_stream = io.StringIO()
+log_handler = logging.StreamHandler(log_stream)
+log_handler.setFormatter(JsonFormatter())
+test_logger = logging.getLogger("test_logs")
+test_logger.propagate = False
+test_logger.addHandler(log_handler)
+test_logger.setLevel(logging.WARNING)
+test_logger.info("skipped: %s", Unserializable())
+test_logger.warning("kept: %s", LazyPayload({"a": 1}), extra={"req_id": "r1"})
+log_record = json.loads(log_stream.getvalue())
+assert log_record["req_id"] == "r1" and log_record["msg"] == 'kept: {"a": 1}'
+
+# 调度：同一个会话的事件按顺序逐个处理，不同会话并行
+from pipeline import EventPipeline
+from ratelimit import TokenBucket
+
+handled, running, overlap = [], {}, []
+handled_lock = threading.Lock()
+
+
+def handle_event(item):
+    chat, num = item
+    with handled_lock:
+        if running.get(chat):
+            overlap.append(item)
+        running[chat] = True
+    time.sleep(0.002)
+    with handled_lock:
+        running[chat] = False
+        handled.append(item)
+
+
+event_pipeline = EventPipeline(
+    handle_event, workers=8, max_size=1000, key_func=lambda item: item[0]
+)
+event_pipeline.start()
+for num in range(50):
+    for chat in ("chat_a", "chat_b", "chat_c"):
+        assert event_pipeline.submit((chat, num))
+assert event_pipeline.drain(10)
+assert not overlap and len(handled) == 150
+for chat in ("chat_a", "chat_b", "chat_c"):
+    assert [x[1] for x in handled if x[0] == chat] == list(range(50))
+
+# 队列满：等待 put_timeout 后拒绝（路由据此返回 503），有空位后可以继续入队
+release = threading.Event()
+full_pipeline = EventPipeline(lambda item: release.wait(), workers=1, max_size=2)
+full_pipeline.start()
+assert full_pipeline.submit(1) and full_pipeline.submit(2)
+full_pipeline.put_timeout = 0.05
+start = time.perf_counter()
+assert not full_pipeline.submit(3)
+assert 0.05 <= time.perf_counter() - start < 0.5
+full_pipeline.put_timeout = 2
+threading.Timer(0.05, release.set).start()
+assert full_pipeline.submit(4)
+assert full_pipeline.drain(2)
+
+# 停止：等待进行中和排队的事件处理完；超时返回 False，之后不再接收新事件
+drained = []
+drain_pipeline = EventPipeline(
+    lambda item: (time.sleep(0.05), drained.append(item)), workers=1
+)
+drain_pipeline.start()
+for num in range(3):
+    assert drain_pipeline.submit(num)
+assert drain_pipeline.drain(2) and drained == [0, 1, 2]
+assert not drain_pipeline.submit(3)
+release = threading.Event()
+stuck_pipeline = EventPipeline(lambda item: release.wait(), workers=1)
+stuck_pipeline.start()
+assert stuck_pipeline.submit(1)
+start = time.perf_counter()
+assert not stuck_pipeline.drain(0.1)
+assert time.perf_counter() - start < 0.5
+assert not stuck_pipeline.submit(2)
+release.set()
+
+# 后续操作并发执行：总耗时取最慢的一个，失败的调用不影响其他调用
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import fan_out
+
+fan_out_results = []
+
+
+def slow_side_effect(value):
+    time.sleep(0.2)
+    fan_out_results.append(value)
+
+
+def failing_side_effect():
+    time.sleep(0.1)
+    raise ValueError("reaction failed")
+
+
+start = time.perf_counter()
+with ThreadPoolExecutor(4) as side_effect_pool:
+    fan_out_errors = fan_out(
+        side_effect_pool, [(slow_side_effect, "record"), (failing_side_effect,)]
+    )
+    assert 0.2 <= time.perf_counter() - start < 0.3  # 串行执行要 0.3 秒
+assert fan_out_results == ["record"]
+assert [(func, type(e)) for func, e in fan_out_errors] == [
+    (failing_side_effect, ValueError)
+]
+
+# 限流：令牌用完后排队等待而不是失败
+bucket = TokenBucket(rate=100, burst=2)
+assert bucket.reserve() == 0 and bucket.reserve() == 0
+assert 0.005 < bucket.reserve() <= 0.01
+assert 0.015 < bucket.reserve() <= 0.02
+
+# 熔断：连续失败或慢调用后打开，冷却后放行一个试探调用
+from resilience import CircuitBreaker, Deadline, DeadlineExceeded
+
+breaker = CircuitBreaker("test", failure_threshold=3, slow_call_duration=1, cooldown=0.05)
+breaker.record(False)
+breaker.record(True, 0.1)  # 成功后重新计数
+breaker.record(False)
+breaker.record(True, 2)  # 慢调用算失败
+assert breaker.allow() and breaker.state == "closed"
+breaker.record(False)
+assert breaker.state == "open" and not breaker.allow()
+time.sleep(0.06)
+assert breaker.allow() and breaker.state == "half_open"
+assert not breaker.allow()  # 同一时刻只放行一个试探调用
+breaker.record(False)
+assert breaker.state == "open"
+time.sleep(0.06)
+assert breaker.allow()
+breaker.record(True, 0.1)
+assert breaker.state == "closed" and breaker.allow()
+assert 'circuit_breaker_state{name="test"} 0' in collector.render()
+
+deadline = Deadline(0.05)
+assert deadline.timeout(10) <= 0.05 and deadline.timeout(0.01) == 0.01
+time.sleep(0.06)
+try:
+    deadline.timeout(10)
+    assert False
+except DeadlineExceeded:
+    pass
+
+# 限流排队会超过事件时限时立即放弃，不占用令牌
+from feishu import FeishuClient
+
+limited_bucket = TokenBucket(rate=1, burst=1)
+limited_bucket.reserve()
+limited_tokens = limited_bucket.tokens
+sync_client = FeishuClient(
+    manager_a, base_url="http://feishu", rate_limits={"reply_message": limited_bucket}
+)
+async_client = AsyncFeishuClient(
+    manager_a, base_url="http://feishu", rate_limits={"reply_message": limited_bucket}
+)
+for send in (
+    lambda: sync_client.reply_message("om_1", "text", {"text": "hi"}, Deadline(0.2)),
+    lambda: asyncio.run(
+        async_client.reply_message("om_1", "text", {"text": "hi"}, Deadline(0.2))
+    ),
+):
+    start = time.perf_counter()
+    try:
+        send()
+        assert False
+    except DeadlineExceeded:
+        pass
+    assert time.perf_counter() - start < 0.1
+    assert limited_bucket.tokens <= limited_tokens + 0.2  # 只有随时间补充的部分
+assert limited_bucket.reserve(max_wait=0.1) is None
+
+# 大模型回答：只取第一行指令，流式读取时第一行读完或能看出不是指令就停止
+from intent import CommandReader
+
+
+def sse(content: str, finish_reason: str = None) -> str:
+    choice = {"delta": {"content": content}, "finish_reason": finish_reason}
+    return "data: " + json.dumps({"choices": [choice]}, ensure_ascii=False)
+
+
+reader = CommandReader()
+assert not reader.feed(sse(" /roll 吃饭"))
+assert not reader.feed("")
+assert reader.feed(sse(" 3\n\n这条指令会"))
+assert reader.result() == "/roll 吃饭 3"
+reader = CommandReader()
+assert reader.feed(sse("无法")) and reader.result() == "无法"
+reader = CommandReader()
+assert not reader.feed(sse("/add 吃饭 老乡鸡 和府", "length"))
+assert reader.feed("data: [DONE]")
+assert reader.result() == ""  # 被 max_tokens 截断的指令不能执行
+
+# /ls 大集合：逐批读取成员，成员数、总权重和权重最高的成员由数据库计算
+stress_repo.add_cards("chat_1", "大集合", ["m{}".format(i) for i in range(1200)], "u")
+stress_repo.change_card_weight("chat_1", "大集合", "m7", 40)
+cards_iter = stress_repo.iter_cards("chat_1", "大集合", batch_size=100)
+assert [next(cards_iter).name for _ in range(3)] == ["m0", "m1", "m2"]
+cards_iter.close()
+assert sum(1 for _ in stress_repo.iter_cards("chat_1", "大集合")) == 1200
+assert list(stress_repo.iter_cards("chat_1", "不存在")) == []
+assert stress_repo.card_set_stats("chat_1", "大集合") == (1200, 1200 * 10 + 40)
+assert stress_repo.card_set_stats("chat_1", "不存在") is None
+top = stress_repo.top_cards("chat_1", "大集合", 3)
+assert [(x.name, x.weight) for x in top] == [("m7", 50), ("m0", 10), ("m1", 10)]
+assert stress_repo.count_card_sets("chat_1") == 2
+assert list(stress_repo.iter_card_set_summaries("chat_1")) == [("吃饭", 1), ("大集合", 1200)]
+
+# /healthz 的数据库检查
+from repo import ping_db
+
+assert ping_db(stress_engine)
+assert not ping_db(create_db_engine("sqlite:////nonexistent/dir/x.db"))
+# 每次都真正查询数据库，不能缓存结果
+ping_dir = tempfile.mkdtemp()
+ping_engine = create_db_engine("sqlite:///" + os.path.join(ping_dir, "sub", "x.db"))
+assert not ping_db(ping_engine)
+os.makedirs(os.path.join(ping_dir, "sub"))
+assert ping_db(ping_engine)
+
+# /stats：抽卡和赞/踩增量写入按天汇总的统计表，回填可以重复执行
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from backfill import backfill_roll_stats
+from repo import RollStatORM, stat_day
+
+stats_engine = create_db_engine(
+    "sqlite:///" + os.path.join(tempfile.mkdtemp(), "stats.db")
+)
+migrate(stats_engine)
+stats_repo = RollRecordRepo(stats_engine)
+for i, name in enumerate(["a", "b", "a", "a"]):
+    stats_repo.create_roll_record(RollRecord("chat_1", "吃饭", name, "om_{}".format(i), "u"))
+try:
+    stats_repo.create_roll_record(RollRecord("chat_1", "吃饭", "a", "om_0", "u"))
+except IntegrityError:
+    pass  # msg_id 重复，统计一起回滚
+stats_repo.record_reaction(RollRecord("chat_1", "吃饭", "a", "om_0", "u"), 1, "up")
+stats_repo.record_reaction(RollRecord("chat_1", "吃饭", "a", "om_2", "u"), 1, "up")
+stats_repo.record_reaction(RollRecord("chat_1", "吃饭", "a", "om_2", "u"), -1)  # 取消赞
+# 权重已经是 0 时踩一下，权重没有变化
+stats_repo.record_reaction(RollRecord("chat_1", "吃饭", "b", "om_1", "u"), 0, "down")
+today = stat_day(time.time())
+expected = [("a", 3, 2, 0, 1), ("b", 1, 0, 1, 0)]
+assert stats_repo.roll_stats("chat_1", "吃饭", today) == expected
+assert stats_repo.roll_stats("chat_1", "吃饭", today + 1) == []
+assert stats_repo.roll_stats("chat_2", "吃饭") == []
+# 清空抽卡次数后回填，两次结果一样，赞/踩不受影响
+with stats_engine.begin() as conn:
+    conn.execute(RollStatORM.__table__.update().values(draws=0))
+assert backfill_roll_stats(stats_engine) == 2
+assert backfill_roll_stats(stats_engine, batch_size=1) == 2
+assert stats_repo.roll_stats("chat_1", "吃饭", today) == expected
+with stats_engine.begin() as conn:
+    conn.execute(delete(RollStatORM))
+backfill_roll_stats(stats_engine)
+assert stats_repo.roll_stats("chat_1", "吃饭") == [("a", 3, 0, 0, 0), ("b", 1, 0, 0, 0)]
+# 旧库的 roll_stat 没有 weight_delta 列，迁移时补上 NOT NULL DEFAULT 0
+with stats_engine.begin() as conn:
+    conn.execute(text("ALTER TABLE roll_stat DROP COLUMN weight_delta"))
+migrate(stats_engine)
+assert stats_repo.roll_stats("chat_1", "吃饭") == [("a", 3, 0, 0, 0), ("b", 1, 0, 0, 0)]
+stats_repo.record_reaction(RollRecord("chat_1", "吃饭", "b", "om_1", "u"), -1, "down")
+assert stats_repo.roll_stats("chat_1", "吃饭")[1] == ("b", 1, 0, 1, -1)
+
+# preload：fork 之后清掉从 master 继承的累计值，Gauge 保留当前值
+from metrics import Counter, Gauge, reset_registry
+
+fork_counter = Counter("fork_test_total", "测试")
+fork_gauge = Gauge("fork_test_state", "测试")
+fork_counter.inc(3)
+fork_gauge.set(2)
+test_histogram.observe(0.05, command="/roll")
+reset_registry()
+assert fork_counter.get() == 0 and fork_gauge.get() == 2
+assert test_histogram.get(command="/roll") == (0, 0.0)
+
+# 集合数超过旧版 SQLite 的参数上限（999）时也能加载
+import sqlite3
+from sqlalchemy import event
+
+many_engine = create_db_engine(
+    "sqlite:///" + os.path.join(tempfile.mkdtemp(), "many.db")
+)
+event.listen(
+    many_engine,
+    "connect",
+    lambda conn, _: conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999),
+)
+migrate(many_engine)
+many_repo = CardSetRepo(many_engine)
+for i in range(1001):
+    many_repo.add_cards("chat_1", "集合{}".format(i), ["a", "b"], "u")
+many_sets = many_repo.get_card_set_list("chat_1")
+assert len(many_sets) == 1001 and all(len(x.get_cards()) == 2 for x in many_sets)
@@ -0,0 +1,46 @@
+#!encoding:utf-8
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+
+class FileTokenStore:
+    """
+    多进程共享的 token 缓存文件。写入用临时文件 + rename 保证原子性，
+    刷新时持有 .lock 文件的排他锁，保证同一时刻只有一个进程去请求飞书。
+    """
+
+    path: str = ""
+    lock_path: str = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self) -> tuple[str, float]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data["token"], float(data["expire_time"])
+        except (OSError, ValueError, KeyError):
+            return "", 0
+
+    def save(self, token: str, expire_time: float):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        # token 只给本用户读写，不受 umask 影响；残留的临时文件也重新设置权限
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": token, "expire_time": expire_time}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,98 @@
+#!encoding:utf-8
+import logging
+import re
+import time
+import unicodedata
+
+from cache import TTLCache
+from metrics import Counter
+from repo import TranslationCacheRepo
+
+_logger = logging.getLogger(__name__)
+
+translation_cache_counter = Counter(
+    "translation_cache_total", "自然语言翻译缓存查询次数", ("result",)
+)
+
+MAX_KEY_LENGTH = 256
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "。.！!？?~～ "
+
+
+def normalize_text(text: str) -> str:
+    """全角转半角、合并空白、去掉句末标点，作为缓存键"""
+    text = unicodedata.normalize("NFKC", text)
+    text = _SPACES.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+def is_command(answer: str) -> bool:
+    """只有单行、以 / 开头的回答才是有效指令"""
+    answer = answer.strip()
+    return answer.startswith("/") and "\n" not in answer
+
+
+class TranslationCache:
+    """
+    自然语言 -> 指令的两级缓存：进程内 LRU（带 TTL）+ SQLite 持久层（多 worker 共享、重启不丢）。
+    持久层超过 max_rows 时按写入时间淘汰。
+    """
+
+    repo: TranslationCacheRepo = None
+    memory: TTLCache = None
+    ttl: float = 0
+    max_rows: int = 0
+    evict_every: int = 0
+    put_count: int = 0
+
+    def __init__(
+        self,
+        repo: TranslationCacheRepo,
+        memory_size: int = 1024,
+        memory_ttl: float = 3600,
+        ttl: float = 7 * 86400,
+        max_rows: int = 10000,
+        evict_every: int = 100,
+    ):
+        self.repo = repo
+        self.memory = TTLCache(max_size=memory_size, ttl=memory_ttl)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.evict_every = evict_every
+
+    def get(self, text: str) -> str:
+        key = normalize_text(text)
+        if len(key) > MAX_KEY_LENGTH:
+            return None
+        command = self.memory.get(key)
+        if command is not None:
+            translation_cache_counter.inc(result="memory_hit")
+            return command
+        try:
+            command = self.repo.get(key, time.time() - self.ttl)
+        except Exception as e:
+            _logger.exception(e)
+            command = None
+        if command is not None:
+            translation_cache_counter.inc(result="db_hit")
+            self.memory.set(key, command)
+            return command
+        translation_cache_counter.inc(result="miss")
+        return None
+
+    def put(self, text: str, command: str):
+        if not is_command(command):
+            return
+        key = normalize_text(text)
+        if len(key) > MAX_KEY_LENGTH:
+            return
+        command = command.strip()
+        self.memory.set(key, command)
+        try:
+            self.repo.put(key, command)
+            self.put_count += 1
+            if self.put_count % self.evict_every == 0:
+                self.repo.evict(self.max_rows, time.time() - self.ttl)
+        except Exception as e:
+            _logger.exception(e)